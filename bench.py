@@ -0,0 +1,388 @@
+"""
+Нагрузочный тест bot.py без обращения к настоящему Telegram.
+
+- Поднимает локальный сервер, имитирующий Bot API (задержка, доля ошибок, RetryAfter).
+- Запускает Flask-приложение из bot.py на свободном порту и направляет его бота
+  на локальный Bot API через TELEGRAM_BASE_URL.
+- Гоняет /post, /edit, /delete и /log с заданной параллельностью и формой payload.
+- Печатает (или сохраняет в файл) JSON: req/s, p50/p95/p99, ошибки и
+  число вызовов Telegram на один запрос — результаты разных запусков можно сравнивать.
+
+Пример:
+    python bench.py --scenarios post,log --requests 2000 --concurrency 32 --latency 0.05
+"""
+import argparse
+import http.client
+import itertools
+import json
+import os
+import random
+import socket
+import sys
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+BENCH_TOKEN = "123456:bench"
+BENCH_CHAT_ID = -1001234567890
+BENCH_TOPIC_ID = 42
+
+
+class FakeTelegramServer(ThreadingHTTPServer):
+    """
+    Локальная замена api.telegram.org.
+    - latency: задержка каждого ответа в секундах
+    - error_rate: доля ответов 500
+    - retry_after_rate: доля ответов 429 с retry_after секунд
+    """
+
+    daemon_threads = True
+
+    def __init__(self, latency=0.0, error_rate=0.0, retry_after_rate=0.0, retry_after=1):
+        super().__init__(("127.0.0.1", 0), FakeTelegramHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.retry_after_rate = retry_after_rate
+        self.retry_after = retry_after
+        self.calls = Counter()
+        self.lock = threading.Lock()
+        self.message_ids = itertools.count(1)
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/bot"
+
+    def total_calls(self):
+        with self.lock:
+            return sum(self.calls.values())
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.calls)
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name="fake-telegram", daemon=True).start()
+        return self
+
+
+class FakeTelegramHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        method = self.path.rsplit("/", 1)[-1]
+        if "json" in self.headers.get("Content-Type", ""):
+            params = json.loads(body or b"{}")
+        else:
+            params = {key: values[0] for key, values in parse_qs(body.decode()).items()}
+
+        with server.lock:
+            server.calls[method] += 1
+
+        if server.latency:
+            time.sleep(server.latency)
+
+        roll = random.random()
+        if method == "getMe":
+            status, payload = 200, {"ok": True, "result": {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}}
+        elif roll < server.retry_after_rate:
+            status, payload = 429, {
+                "ok": False, "error_code": 429,
+                "description": f"Too Many Requests: retry after {server.retry_after}",
+                "parameters": {"retry_after": server.retry_after},
+            }
+        elif roll < server.retry_after_rate + server.error_rate:
+            status, payload = 500, {"ok": False, "error_code": 500, "description": "Internal Server Error"}
+        else:
+            status, payload = 200, {"ok": True, "result": self._result(method, params)}
+
+        data = json.dumps(payload).encode()
+        # Заголовки и тело одной записью: иначе Nagle + delayed ACK добавляют ~40 мс к ответу
+        self.wfile.write(
+            f"HTTP/1.1 {status} X\r\nContent-Type: application/json\r\nContent-Length: {len(data)}\r\n\r\n".encode() + data
+        )
+
+    def _result(self, method, params):
+        chat = {"id": int(params.get("chat_id", BENCH_CHAT_ID)), "type": "supergroup", "title": "Bench"}
+        if method == "sendMessage":
+            return {"message_id": next(self.server.message_ids), "date": int(time.time()), "chat": chat, "text": params.get("text", "")}
+        if method == "editMessageText":
+            return {"message_id": int(params.get("message_id", 1)), "date": int(time.time()), "chat": chat, "text": params.get("text", "")}
+        if method == "getChat":
+            return chat
+        return True
+
+
+def make_payload(shape, size):
+    """
+    Тело запроса для /post и /log:
+    - text: {"text": ..., "message": ...} из size символов
+    - nested: вложенный JSON из size ключей, проходит через format_json_as_html целиком
+    """
+    if shape == "text":
+        text = ("x" * size)[:size] or "x"
+        return {"text": text, "message": text}
+    return {
+        "message": "bench",
+        "job": {"name": "nightly", "status": "failed", "attempt": 3},
+        "items": [f"item-{i}" for i in range(10)],
+        **{f"field_{i}": {"value": i, "note": f"note {i}", "empty": None} for i in range(size)},
+    }
+
+
+def make_template(shape, size):
+    """
+    Шаблон сообщения под форму payload из make_payload (для --template).
+    """
+    if shape == "text":
+        return "{text}"
+    return (
+        "<b>message:</b> {message}\n"
+        "<b>job:</b> {job.name} / {job.status} / {job.attempt}\n"
+        "<b>items:</b> {items}\n"
+        + "".join(f"<b>field_{i}:</b> {{field_{i}.value}} <i>{{field_{i}.note}}</i>\n" for i in range(size))
+    )
+
+
+def measure_formatter(bot, payload, iterations=2000):
+    """
+    Время одного форматирования payload в микросекундах: общий обход JSON и шаблон.
+    """
+    results = {}
+    for name, template in (("generic", None), ("template", "bench")):
+        started = time.perf_counter()
+        for _ in range(iterations):
+            bot.format_json_as_html_parts(payload, template=template)
+        results[f"{name}_us"] = round((time.perf_counter() - started) / iterations * 1e6, 2)
+    results["speedup"] = round(results["generic_us"] / results["template_us"], 2)
+    return results
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(round(q * (len(sorted_values) - 1))))]
+
+
+def wait_until_idle(fake, quiet=0.5, timeout=30):
+    """
+    Ждет, пока бот перестанет обращаться к Bot API (очереди, уведомления, склейка правок).
+    """
+    deadline = time.monotonic() + timeout
+    last = fake.total_calls()
+    while time.monotonic() < deadline:
+        time.sleep(quiet)
+        current = fake.total_calls()
+        if current == last:
+            return
+        last = current
+
+
+def run_scenario(scenario, host, port, fake, paths, args):
+    payload = make_payload(args.payload, args.payload_size)
+    if scenario == "edit":
+        # Текст отличается от отправленного в сценарии post, иначе правка пропускается как "not modified"
+        payload = {"text": "edited " + json.dumps(payload)}
+    body = json.dumps(payload).encode()
+    counter = itertools.count()
+    latencies = []
+    statuses = Counter()
+    lock = threading.Lock()
+
+    def worker():
+        conn = http.client.HTTPConnection(host, port, timeout=60)
+        local_latencies = []
+        local_statuses = Counter()
+        while True:
+            index = next(counter)
+            if index >= args.requests:
+                break
+            path = paths[scenario](index)
+            started = time.perf_counter()
+            try:
+                conn.request("POST", path, body=body if scenario in ("post", "log", "edit") else b"",
+                             headers={"Content-Type": "application/json"})
+                response = conn.getresponse()
+                response.read()
+                local_statuses[response.status] += 1
+            except Exception:
+                local_statuses["connection_error"] += 1
+                conn.close()
+                conn = http.client.HTTPConnection(host, port, timeout=60)
+            local_latencies.append(time.perf_counter() - started)
+        conn.close()
+        with lock:
+            latencies.extend(local_latencies)
+            statuses.update(local_statuses)
+
+    calls_before = fake.snapshot()
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    wait_until_idle(fake)
+    calls_after = fake.snapshot()
+    telegram_calls = {
+        method: calls_after.get(method, 0) - calls_before.get(method, 0)
+        for method in calls_after
+        if calls_after.get(method, 0) != calls_before.get(method, 0)
+    }
+
+    latencies.sort()
+    ms = lambda value: round(value * 1000, 3) if value is not None else None
+    return {
+        "scenario": scenario,
+        "requests": len(latencies),
+        "elapsed_s": round(elapsed, 3),
+        "req_per_s": round(len(latencies) / elapsed, 1) if elapsed else None,
+        "latency_ms": {
+            "p50": ms(percentile(latencies, 0.50)),
+            "p95": ms(percentile(latencies, 0.95)),
+            "p99": ms(percentile(latencies, 0.99)),
+            "max": ms(latencies[-1] if latencies else None),
+        },
+        "status_codes": {str(code): count for code, count in sorted(statuses.items(), key=str)},
+        "telegram_calls": telegram_calls,
+        "telegram_calls_per_request": round(sum(telegram_calls.values()) / len(latencies), 3) if latencies else None,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Нагрузочный тест bot.py с локальным Bot API")
+    parser.add_argument("--scenarios", default="post,edit,delete,log", help="через запятую: post, edit, delete, log")
+    parser.add_argument("--requests", type=int, default=1000, help="запросов на сценарий")
+    parser.add_argument("--concurrency", type=int, default=16, help="параллельных клиентов")
+    parser.add_argument("--payload", choices=("text", "nested"), default="text", help="форма тела запроса")
+    parser.add_argument("--payload-size", type=int, default=200, help="символов текста или ключей во вложенном JSON")
+    parser.add_argument("--async", dest="async_mode", action="store_true", help="/post и /log с ?async=1")
+    parser.add_argument("--latency", type=float, default=0.02, help="задержка ответа Bot API, секунд")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 500 от Bot API")
+    parser.add_argument("--retry-after-rate", type=float, default=0.0, help="доля ответов 429 (RetryAfter)")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after в ответах 429, секунд")
+    parser.add_argument("--template", action="store_true",
+                        help="/post и /log через зарегистрированный шаблон сообщения (?template=bench)")
+    parser.add_argument("--server", choices=("flask", "asgi"), default="flask", help="какой HTTP-сервер бота мерить")
+    parser.add_argument("--keep-limits", action="store_true",
+                        help="не отключать ограничитель запросов, склейку логов и правок бота")
+    parser.add_argument("--output", help="куда записать JSON (по умолчанию stdout)")
+    return parser.parse_args(argv)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(host, port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise SystemExit(f"Сервер бота не запустился на {host}:{port}")
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    fake = FakeTelegramServer(args.latency, args.error_rate, args.retry_after_rate, args.retry_after).start()
+
+    # Настройки бота задаются до импорта bot.py; заданные в окружении явно не перезаписываются
+    os.environ["TELEGRAM_BASE_URL"] = fake.base_url
+    os.environ.setdefault("BOT_TOKEN", BENCH_TOKEN)
+    os.environ.setdefault("RAILWAY_PUBLIC_DOMAIN", "bench.local")
+    os.environ.setdefault("OUTBOX_DB", "")
+    os.environ.setdefault("ADMIN_TOKEN", "bench")
+    if args.server == "asgi":
+        # ASGI-сервер бота слушает SERVER_PORT на всех интерфейсах
+        os.environ["SERVER_PORT"] = str(free_port())
+    if not args.keep_limits:
+        for name, value in {
+            "RATE_LIMIT_GLOBAL": "1000000", "RATE_LIMIT_GROUP_PER_MIN": "60000000",
+            "RATE_LIMIT_PRIVATE": "1000000", "RATE_LIMIT_CHAT_BURST": "1000000",
+            "LOG_COALESCE_WINDOW": "0", "EDIT_DEBOUNCE_WINDOW": "0",
+        }.items():
+            os.environ.setdefault(name, value)
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import logging
+    logging.disable(logging.INFO)
+    import bot
+    from werkzeug.serving import make_server
+
+    if args.server == "asgi":
+        server = None
+        threading.Thread(target=bot.run_asgi, name="bench-asgi", daemon=True).start()
+        host, port = "127.0.0.1", bot.PORT
+        wait_for_port(host, port)
+    else:
+        server = make_server("127.0.0.1", 0, bot.app, threaded=True)
+        threading.Thread(target=server.serve_forever, name="bench-flask", daemon=True).start()
+        host, port = server.server_address[:2]
+
+    encoded_topic = bot.encode_params(BENCH_CHAT_ID, str(BENCH_TOPIC_ID))
+    encoded_chat = bot.encode_params(BENCH_CHAT_ID)
+    query = []
+    if args.async_mode:
+        query.append("async=1")
+    if args.template:
+        query.append("template=bench")
+        conn = http.client.HTTPConnection(host, port, timeout=10)
+        conn.request("PUT", "/templates/bench", body=json.dumps({"template": make_template(args.payload, args.payload_size)}),
+                     headers={"Content-Type": "application/json", "Authorization": f"Bearer {os.environ['ADMIN_TOKEN']}"})
+        response = conn.getresponse()
+        if response.status != 200:
+            raise SystemExit(f"Не удалось зарегистрировать шаблон: {response.status} {response.read().decode()}")
+        conn.close()
+    suffix = f"?{'&'.join(query)}" if query else ""
+    paths = {
+        "post": lambda i: f"/post/{encoded_topic}{suffix}",
+        "log": lambda i: f"/log/error/{encoded_chat}{suffix}",
+        # Разные message_id, чтобы мерить сам путь правки/удаления, а не склейку
+        "edit": lambda i: f"/edit/{encoded_chat}/{i + 1}",
+        "delete": lambda i: f"/delete/{encoded_chat}/{i + 1}",
+    }
+
+    results = {
+        "config": {
+            "server": args.server, "requests": args.requests, "concurrency": args.concurrency,
+            "payload": args.payload, "payload_size": args.payload_size, "async": args.async_mode,
+            "api_latency_s": args.latency, "api_error_rate": args.error_rate,
+            "api_retry_after_rate": args.retry_after_rate, "keep_limits": args.keep_limits,
+            "template": args.template,
+        },
+        "scenarios": [],
+    }
+    if args.template:
+        results["formatter"] = measure_formatter(bot, make_payload(args.payload, args.payload_size))
+    for scenario in [name.strip() for name in args.scenarios.split(",") if name.strip()]:
+        if scenario not in paths:
+            raise SystemExit(f"Неизвестный сценарий: {scenario}")
+        results["scenarios"].append(run_scenario(scenario, host, port, fake, paths, args))
+
+    if server:
+        server.shutdown()
+    fake.shutdown()
+
+    output = json.dumps(results, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
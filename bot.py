@@ -1,218 +1,3093 @@
 import os
 import threading
 import asyncio
-from flask import Flask, request, jsonify
-from telegram import Bot
-from telegram.constants import ParseMode
+from flask import Flask, request, jsonify, g, Response
+from telegram import Bot, Update
+from telegram.constants import ChatType, MessageLimit, ParseMode
+from telegram.error import BadRequest, NetworkError, RetryAfter
+from telegram.request import HTTPXRequest
 from telegram.ext import Application, CommandHandler, ContextTypes
 import logging
+import logging.handlers
+import atexit
+import contextvars
+import json
+import io
+import html
+import string
 import base64
+import re
+import hashlib
+import bisect
+import hmac
+import time
+import uuid
+import math
+import random
+import queue
+import functools
+import heapq
+import itertools
+import sqlite3
+try:
+    import fcntl
+except ImportError:  # Windows: блокировки файлов для нескольких процессов недоступны
+    fcntl = None
+from collections import OrderedDict, deque
+from datetime import datetime, timezone
+from concurrent.futures import Future
+from urllib.parse import parse_qsl
+from werkzeug.datastructures import Headers, MultiDict
+from werkzeug.exceptions import RequestEntityTooLarge
 
 TOKEN = os.environ.get("BOT_TOKEN")
+# Дополнительные боты: "bot_id=токен" через запятую (например, "alerts=123:ABC,ops=456:DEF").
+# bot_id указывается при кодировании параметров, без него сообщения идут от основного бота (BOT_TOKEN)
+BOT_TOKENS = os.environ.get("BOT_TOKENS", "")
 SERVER_URL = os.environ.get("RAILWAY_PUBLIC_DOMAIN")
 PORT = int(os.environ.get("SERVER_PORT", 5000))
+# Адрес Bot API (можно указать локальный сервер, например для нагрузочного теста bench.py)
+TELEGRAM_BASE_URL = os.environ.get("TELEGRAM_BASE_URL", "https://api.telegram.org/bot")
+# Как получать обновления от Telegram: polling (по умолчанию) или webhook через тот же Flask-сервер
+UPDATE_MODE = os.environ.get("UPDATE_MODE", "polling").lower()
+WEBHOOK_PATH = "/telegram/webhook"
+# HTTP-сервер: flask (WSGI, по умолчанию) или asgi (uvicorn в общем event loop бота)
+SERVER_MODE = os.environ.get("SERVER_MODE", "flask").lower()
+# Размер пула keep-alive соединений к api.telegram.org
+POOL_SIZE = int(os.environ.get("BOT_POOL_SIZE", 32))
+# Сколько секунд ждать свободное соединение из пула
+POOL_TIMEOUT = float(os.environ.get("BOT_POOL_TIMEOUT", 5.0))
+# Дополнительные боты: размер пула соединений каждого и через сколько секунд простоя закрывать их клиент
+BOT_TENANT_POOL_SIZE = int(os.environ.get("BOT_TENANT_POOL_SIZE", 8))
+BOT_IDLE_TTL = float(os.environ.get("BOT_IDLE_TTL", 600))
+# Асинхронный режим (?async=1): размер очереди, число отправителей и сколько задач помнить для /status
+OUTBOUND_QUEUE_SIZE = int(os.environ.get("OUTBOUND_QUEUE_SIZE", 1000))
+OUTBOUND_WORKERS = int(os.environ.get("OUTBOUND_WORKERS", 8))
+JOB_HISTORY_SIZE = int(os.environ.get("JOB_HISTORY_SIZE", 10000))
+# Файл SQLite для постоянной очереди асинхронного режима (пустая строка — не сохранять на диск)
+OUTBOX_DB = os.environ.get("OUTBOX_DB", "outbox.db")
+# Максимум операций в одной транзакции SQLite
+OUTBOX_BATCH_SIZE = int(os.environ.get("OUTBOX_BATCH_SIZE", 500))
+# Лимиты Telegram: ~30 сообщений/с на бота, ~20 сообщений/мин в группу, ~1 сообщение/с в личный чат
+RATE_LIMIT_GLOBAL = float(os.environ.get("RATE_LIMIT_GLOBAL", 30))
+RATE_LIMIT_GROUP_PER_MIN = float(os.environ.get("RATE_LIMIT_GROUP_PER_MIN", 20))
+RATE_LIMIT_PRIVATE = float(os.environ.get("RATE_LIMIT_PRIVATE", 1))
+RATE_LIMIT_CHAT_BURST = float(os.environ.get("RATE_LIMIT_CHAT_BURST", 3))
+# Через сколько секунд простоя забывать bucket чата
+RATE_LIMIT_IDLE_TTL = float(os.environ.get("RATE_LIMIT_IDLE_TTL", 600))
+# Сколько раз повторять запрос после RetryAfter и сколько максимум ждать
+RETRY_AFTER_ATTEMPTS = int(os.environ.get("RETRY_AFTER_ATTEMPTS", 3))
+RETRY_AFTER_MAX_WAIT = float(os.environ.get("RETRY_AFTER_MAX_WAIT", 60))
+# Приоритеты отправки: за сколько секунд ожидания запрос поднимается на один класс выше,
+# чтобы поток ERROR-логов не останавливал массовые отправки совсем
+PRIORITY_AGING_SECONDS = float(os.environ.get("PRIORITY_AGING_SECONDS", 10))
+# Предохранитель вызовов Telegram: размыкается, если за CIRCUIT_WINDOW секунд из не менее чем CIRCUIT_MIN_CALLS
+# вызовов доля сетевых ошибок и таймаутов достигла CIRCUIT_FAILURE_RATE; пауза растет от CIRCUIT_OPEN_BASE
+# до CIRCUIT_OPEN_MAX секунд
+CIRCUIT_FAILURE_RATE = float(os.environ.get("CIRCUIT_FAILURE_RATE", 0.5))
+CIRCUIT_MIN_CALLS = int(os.environ.get("CIRCUIT_MIN_CALLS", 10))
+CIRCUIT_WINDOW = float(os.environ.get("CIRCUIT_WINDOW", 30))
+CIRCUIT_OPEN_BASE = float(os.environ.get("CIRCUIT_OPEN_BASE", 5))
+CIRCUIT_OPEN_MAX = float(os.environ.get("CIRCUIT_OPEN_MAX", 120))
+# Локальное хранилище отправленных сообщений для /get: размер LRU в памяти и файл SQLite (пусто — только память)
+MESSAGE_CACHE_SIZE = int(os.environ.get("MESSAGE_CACHE_SIZE", 10000))
+MESSAGE_STORE_DB = os.environ.get("MESSAGE_STORE_DB", "")
+# /edit: окно, в котором серия правок одного сообщения склеивается в одну (0 — без задержки),
+# и сколько хэшей последнего отправленного текста помнить для пропуска правок без изменений
+EDIT_DEBOUNCE_WINDOW = float(os.environ.get("EDIT_DEBOUNCE_WINDOW", 1.0))
+EDIT_HASH_CACHE_SIZE = int(os.environ.get("EDIT_HASH_CACHE_SIZE", 50000))
+# Фоновая отправка уведомлений log_and_notify: размер очереди и сколько уведомлений отправлять одновременно
+NOTIFY_QUEUE_SIZE = int(os.environ.get("NOTIFY_QUEUE_SIZE", 1000))
+NOTIFY_CONCURRENCY = int(os.environ.get("NOTIFY_CONCURRENCY", 4))
+# Склейка одинаковых логов: окно в секундах (0 — выключено), пауза перед правкой счетчика и размер таблицы отпечатков
+LOG_COALESCE_WINDOW = float(os.environ.get("LOG_COALESCE_WINDOW", 60))
+LOG_COALESCE_EDIT_DELAY = float(os.environ.get("LOG_COALESCE_EDIT_DELAY", 5))
+LOG_COALESCE_MAX_KEYS = int(os.environ.get("LOG_COALESCE_MAX_KEYS", 10000))
+# Сколько символов оставлять в последней части лога под счетчик "🔁 ×N за последние N с"
+LOG_COALESCE_SUFFIX_RESERVE = 64
+# /post_batch: максимум сообщений в одном запросе и сколько чатов/топиков обслуживать параллельно
+BATCH_MAX_ITEMS = int(os.environ.get("BATCH_MAX_ITEMS", 1000))
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", 16))
+# Шаблоны сообщений: JSON-файл {"имя": "шаблон"} и токен для управления ими через /templates (пусто — управление выключено)
+TEMPLATES_FILE = os.environ.get("TEMPLATES_FILE", "")
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")
+# Заголовок Idempotency-Key: сколько секунд помнить результат запроса и сколько ключей держать в памяти
+IDEMPOTENCY_TTL = float(os.environ.get("IDEMPOTENCY_TTL", 3600))
+IDEMPOTENCY_CACHE_SIZE = int(os.environ.get("IDEMPOTENCY_CACHE_SIZE", 10000))
+# Ограничение входящей нагрузки: сколько запросов каждого класса выполняется одновременно
+# (отправка: /post, /post_batch, /log; управление: /edit, /delete, /delete_batch, /get),
+# сколько ждут своей очереди и сколько секунд, а также максимальный размер тела запроса в байтах
+ADMISSION_SEND_LIMIT = int(os.environ.get("ADMISSION_SEND_LIMIT", 64))
+ADMISSION_MANAGE_LIMIT = int(os.environ.get("ADMISSION_MANAGE_LIMIT", 32))
+ADMISSION_QUEUE_SIZE = int(os.environ.get("ADMISSION_QUEUE_SIZE", 128))
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get("ADMISSION_QUEUE_TIMEOUT", 5))
+MAX_CONTENT_LENGTH = int(os.environ.get("MAX_CONTENT_LENGTH", 1024 * 1024))
+# Отложенные действия /post (?send_at=, ?delete_after=): максимум ожидающих таймеров, насколько далеко
+# вперед можно запланировать отправку (в секундах), предельный срок автоудаления в секундах (Telegram
+# не дает боту удалять сообщения старше 48 часов) и пауза перед повтором таймера, который не удалось
+# выполнить (очередь переполнена, Telegram недоступен)
+SCHEDULE_MAX_TIMERS = int(os.environ.get("SCHEDULE_MAX_TIMERS", 100000))
+SEND_AT_MAX = float(os.environ.get("SEND_AT_MAX", 366 * 24 * 3600))
+DELETE_AFTER_MAX = float(os.environ.get("DELETE_AFTER_MAX", 48 * 3600))
+SCHEDULE_RETRY_DELAY = float(os.environ.get("SCHEDULE_RETRY_DELAY", 5))
+# Логи: формат вывода (text или json), размер очереди фонового вывода (0 — писать прямо из потока запроса)
+# и сколько обычных INFO-записей в секунду выводить (0 — без ограничения; WARNING и ERROR выводятся всегда)
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text").lower()
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", 10000))
+LOG_INFO_RATE = float(os.environ.get("LOG_INFO_RATE", 200))
+# Несколько процессов (gunicorn, см. gunicorn.conf.py): файл блокировки, через который выбирается
+# процесс-лидер — он получает обновления Telegram и восстанавливает outbox
+LEADER_LOCK_FILE = os.environ.get("LEADER_LOCK_FILE", "bot.leader.lock")
+# Как часто лидер забирает из outbox задачи завершившихся процессов, секунд
+OUTBOX_RECOVERY_INTERVAL = float(os.environ.get("OUTBOX_RECOVERY_INTERVAL", 30))
 
 if not TOKEN:
     raise ValueError("BOT_TOKEN environment variable is not set!")
 if not SERVER_URL:
     raise ValueError("RAILWAY_PUBLIC_DOMAIN environment variable is not set!")
+if UPDATE_MODE not in ("polling", "webhook"):
+    raise ValueError("UPDATE_MODE must be 'polling' or 'webhook'!")
+if SERVER_MODE not in ("flask", "asgi"):
+    raise ValueError("SERVER_MODE must be 'flask' or 'asgi'!")
+if LOG_FORMAT not in ("text", "json"):
+    raise ValueError("LOG_FORMAT must be 'text' or 'json'!")
+
+# Идентификатор дополнительного бота: латиница, цифры, "_" и "-"
+BOT_ID_RE = re.compile(r"[A-Za-z0-9_-]{1,32}")
+
+
+def parse_bot_tokens(value):
+    """
+    Разбирает BOT_TOKENS в словарь bot_id → токен.
+    """
+    tokens = {}
+    for item in filter(None, (item.strip() for item in value.split(","))):
+        bot_id, _, token = item.partition("=")
+        bot_id, token = bot_id.strip(), token.strip()
+        if not BOT_ID_RE.fullmatch(bot_id) or not token:
+            raise ValueError(f"BOT_TOKENS: invalid entry '{bot_id}', expected bot_id=token")
+        if bot_id in tokens:
+            raise ValueError(f"BOT_TOKENS: duplicate bot_id '{bot_id}'")
+        tokens[bot_id] = token
+    return tokens
+
+
+BOT_TENANT_TOKENS = parse_bot_tokens(BOT_TOKENS)
+
+# Секрет, который Telegram присылает в заголовке каждого webhook-запроса.
+# По умолчанию выводится из токена, чтобы не меняться между рестартами.
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET") or hashlib.sha256(f"webhook:{TOKEN}".encode()).hexdigest()[:32]
+
+# Идентификатор процесса: им помечаются задачи в outbox, чтобы после падения
+# одного воркера лидер восстановил только его задачи
+PROCESS_ID = uuid.uuid4().hex
 
-global_bot = Bot(token=TOKEN)
 app = Flask(__name__)
+# Тело больше лимита не читается целиком даже без Content-Length
+app.config["MAX_CONTENT_LENGTH"] = MAX_CONTENT_LENGTH
+
+class JsonLogFormatter(logging.Formatter):
+    """
+    Запись лога одной строкой JSON: время (ISO 8601, UTC), уровень, логгер, сообщение и трейсбек, если есть.
+    """
+
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "pid": record.process,
+        }
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class LogSampler(logging.Filter):
+    """
+    Ограничивает поток обычных записей (INFO и ниже) до rate в секунду (token bucket с запасом на секунду).
+    - WARNING и ERROR проходят всегда.
+    - Лишние записи отбрасываются до форматирования; не чаще раза в секунду
+      выводится запись о том, сколько было пропущено.
+    rate=0 — без ограничения.
+    """
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.skipped = 0
+        self.reported = 0.0
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if not self.rate or record.levelno >= logging.WARNING or getattr(record, "sampler_report", False):
+            return True
+
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 1:
+                self.skipped += 1
+                self.dropped += 1
+                return False
+            self.tokens -= 1
+            # Отчет о пропущенных — не чаще раза в секунду
+            skipped = 0
+            if self.skipped and now - self.reported >= 1:
+                skipped, self.skipped, self.reported = self.skipped, 0, now
+
+        if skipped:
+            # Эта запись проходит фильтр без лимита (sampler_report)
+            logging.getLogger(__name__).info(
+                "⏭ Пропущено %d записей INFO (лимит LOG_INFO_RATE=%g в секунду)", skipped, self.rate, extra={"sampler_report": True}
+            )
+        return True
+
+
+class BackgroundLogHandler(logging.handlers.QueueHandler):
+    """
+    Кладет запись в очередь, а форматирует и пишет ее фоновый поток (QueueListener).
+    - Сообщение не форматируется в потоке запроса: в очередь уходит сама запись с аргументами
+      (записи не покидают процесс, поэтому стандартная подготовка QueueHandler не нужна).
+    - Если очередь заполнена (вывод не успевает), INFO-записи отбрасываются,
+      а WARNING и ERROR ждут места, чтобы не потеряться.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        if record.levelno >= logging.WARNING:
+            self.queue.put(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup_logging():
+    """
+    Настраивает корневой логгер: формат LOG_FORMAT, фоновый вывод через очередь (если LOG_QUEUE_SIZE > 0)
+    и ограничение потока INFO-записей (LOG_INFO_RATE). Возвращает (sampler, фоновый обработчик или None).
+    """
+    output = logging.StreamHandler()
+    if LOG_FORMAT == "json":
+        output.setFormatter(JsonLogFormatter())
+    else:
+        output.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+
+    handler, background = output, None
+    if LOG_QUEUE_SIZE > 0:
+        background = handler = BackgroundLogHandler(queue.Queue(LOG_QUEUE_SIZE))
+        listener = logging.handlers.QueueListener(background.queue, output)
+        listener.start()
+        # При выходе дописываем все, что осталось в очереди
+        atexit.register(listener.stop)
+
+    sampler = LogSampler(LOG_INFO_RATE)
+    handler.addFilter(sampler)
+    logging.basicConfig(level=logging.INFO, handlers=[handler])
+    return sampler, background
+
+
+# Настройка логгера
+log_sampler, log_background = setup_logging()
+logger = logging.getLogger(__name__)
+
+# Отключаем детальные HTTP-запросы из логов
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+# Единственный экземпляр бота с пулом соединений. Живет в фоновом event loop,
+# поэтому TCP/TLS-соединения к Telegram переиспользуются между запросами.
+global_bot = Bot(
+    token=TOKEN,
+    base_url=TELEGRAM_BASE_URL,
+    request=HTTPXRequest(connection_pool_size=POOL_SIZE, pool_timeout=POOL_TIMEOUT)
+)
+
+_bot_loop = None
+_bot_loop_lock = threading.Lock()
+
+
+def _bot_loop_worker(loop, ready):
+    """
+    Тело фонового потока: крутит общий event loop до завершения процесса.
+    """
+    asyncio.set_event_loop(loop)
+    loop.call_soon(ready.set)
+    loop.run_forever()
+
+
+def _on_bot_initialized(future):
+    if future.cancelled():
+        return
+    if future.exception():
+        logger.warning(f"⚠️ Не удалось инициализировать бота: {future.exception()}")
+    else:
+        logger.info(f"✅ Бот @{global_bot.username} инициализирован, пул соединений: {POOL_SIZE}")
+
+
+def get_bot_loop():
+    """
+    Возвращает общий event loop, в котором работает global_bot.
+    - Loop и его поток создаются один раз, при первом обращении.
+    - Инициализация бота (get_me) запускается в фоне и заодно прогревает соединение.
+    """
+    global _bot_loop
+    if _bot_loop is None:
+        with _bot_loop_lock:
+            if _bot_loop is None:
+                loop = asyncio.new_event_loop()
+                ready = threading.Event()
+                threading.Thread(
+                    target=_bot_loop_worker, args=(loop, ready), name="bot-loop", daemon=True
+                ).start()
+                ready.wait()
+                future = asyncio.run_coroutine_threadsafe(global_bot.initialize(), loop)
+                future.add_done_callback(_on_bot_initialized)
+                _bot_loop = loop
+    return _bot_loop
+
+
+def run_in_bot_loop(coro, timeout=None):
+    """
+    Выполняет корутину в общем event loop и синхронно ждет результат.
+    Используется Flask-обработчиками вместо создания нового loop на каждый запрос.
+    """
+    future = asyncio.run_coroutine_threadsafe(coro, get_bot_loop())
+    return future.result(timeout)
+
+
+# Гистограммы: границы корзин для времени (секунды) и размеров (байты)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (100, 1000, 4096, 16384, 65536, 262144, 1048576)
+
+
+class Metrics:
+    """
+    Счетчики и гистограммы в формате Prometheus.
+    Данные разложены по нескольким полосам со своими блокировками: каждый поток при первой записи
+    получает свою полосу по кругу, поэтому потоки почти не мешают друг другу.
+    При выдаче /metrics полосы суммируются.
+    """
+
+    STRIPES = 16
+
+    def __init__(self):
+        self._stripes = [({}, threading.Lock()) for _ in range(self.STRIPES)]
+        self._local = threading.local()
+        self._next_stripe = itertools.count()
+        self._meta = OrderedDict()  # name → (type, help, buckets)
+        self._collectors = []
+
+    def describe(self, name, metric_type, help_text, buckets=None):
+        self._meta[name] = (metric_type, help_text, buckets)
+
+    def add_collector(self, collector):
+        """
+        collector() возвращает [(name, labels, value)] — значения, которые считаются в момент выдачи
+        (глубина очередей, счетчики других компонентов).
+        """
+        self._collectors.append(collector)
+
+    def _stripe(self):
+        # threading.get_ident() — выровненный адрес стека, его младшие биты у всех потоков одинаковые,
+        # поэтому полоса выдается по кругу (next() у itertools.count атомарен под GIL)
+        stripe = getattr(self._local, "stripe", None)
+        if stripe is None:
+            stripe = self._local.stripe = self._stripes[next(self._next_stripe) % self.STRIPES]
+        return stripe
+
+    def inc(self, name, labels=(), value=1):
+        data, lock = self._stripe()
+        key = (name, labels)
+        with lock:
+            data[key] = data.get(key, 0) + value
+
+    def observe(self, name, value, labels=()):
+        buckets = self._meta[name][2]
+        data, lock = self._stripe()
+        key = (name, labels)
+        with lock:
+            histogram = data.get(key)
+            if histogram is None:
+                # Счетчики по корзинам (последняя — +Inf) и сумма значений
+                histogram = data[key] = [0] * (len(buckets) + 1) + [0.0]
+            histogram[bisect.bisect_left(buckets, value)] += 1
+            histogram[-1] += value
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = tuple(labels) + tuple(extra)
+        if not pairs:
+            return ""
+        escaped = []
+        for key, value in pairs:
+            value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            escaped.append(f'{key}="{value}"')
+        return "{" + ",".join(escaped) + "}"
+
+    def render(self):
+        """
+        Возвращает все метрики в текстовом формате Prometheus.
+        """
+        merged = {}
+        for data, lock in self._stripes:
+            with lock:
+                items = [(key, list(value) if isinstance(value, list) else value) for key, value in data.items()]
+            for key, value in items:
+                if isinstance(value, list):
+                    total = merged.setdefault(key, [0] * len(value))
+                    for i, part in enumerate(value):
+                        total[i] += part
+                else:
+                    merged[key] = merged.get(key, 0) + value
+
+        for collector in self._collectors:
+            try:
+                for name, labels, value in collector():
+                    merged[(name, tuple(labels))] = value
+            except Exception as e:
+                logger.warning(f"⚠️ Ошибка при сборе метрик: {str(e)}")
+
+        lines = []
+        for name, (metric_type, help_text, buckets) in self._meta.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for (key_name, labels), value in sorted(merged.items(), key=lambda item: str(item[0])):
+                if key_name != name:
+                    continue
+                if metric_type == "histogram":
+                    cumulative = 0
+                    for bound, count in zip(buckets + ("+Inf",), value[:-1]):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{self._labels(labels, (('le', bound),))} {cumulative}")
+                    lines.append(f"{name}_sum{self._labels(labels)} {value[-1]}")
+                    lines.append(f"{name}_count{self._labels(labels)} {cumulative}")
+                else:
+                    lines.append(f"{name}{self._labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+metrics.describe("bot_http_requests_total", "counter", "HTTP requests by route, method and status code")
+metrics.describe("bot_http_request_duration_seconds", "histogram", "HTTP request latency by route", LATENCY_BUCKETS)
+metrics.describe("bot_http_request_size_bytes", "histogram", "HTTP request body size by route", SIZE_BUCKETS)
+metrics.describe("bot_telegram_requests_total", "counter", "Telegram Bot API calls by method and result")
+metrics.describe("bot_telegram_request_duration_seconds", "histogram", "Telegram Bot API call latency by method", LATENCY_BUCKETS)
+metrics.describe("bot_circuit_state", "gauge", "Telegram circuit breaker state: 0 closed, 1 half-open, 2 open")
+metrics.describe("bot_circuit_transitions_total", "counter", "Telegram circuit breaker state changes by new state")
+metrics.describe("bot_rate_limiter_wait_seconds", "histogram", "Time spent waiting for the rate limiter", LATENCY_BUCKETS)
+metrics.describe("bot_outbound_queue_depth", "gauge", "Messages waiting in the async mode queue")
+metrics.describe("bot_lane_depth", "gauge", "Outbound requests waiting by priority lane and stage (outbound_queue, rate_limiter)")
+metrics.describe("bot_lane_wait_seconds", "histogram", "Time outbound requests waited by priority lane and stage", LATENCY_BUCKETS)
+metrics.describe("bot_clients_open", "gauge", "Telegram bot clients with an open connection pool (the primary bot and active extra bots)")
+metrics.describe("bot_client_requests_total", "counter", "Telegram Bot API calls by bot and result (ok, error, retry_after, circuit_open)")
+metrics.describe("bot_notify_queue_depth", "gauge", "Notifications waiting to be sent")
+metrics.describe("bot_notifications_total", "counter", "log_and_notify notifications by result (submitted, sent, failed, dropped)")
+metrics.describe("bot_idempotency_requests_total", "counter", "Requests with Idempotency-Key by result (new, replayed, joined, conflict)")
+metrics.describe("bot_idempotency_keys", "gauge", "Idempotency keys kept in memory")
+metrics.describe("bot_log_records_dropped_total", "counter", "Log records not written by reason (sampled, queue_full)")
+metrics.describe("bot_scheduled_timers", "gauge", "Pending scheduled actions (send_at, delete_after) by action")
+metrics.describe("bot_admission_active", "gauge", "HTTP requests being served by route class")
+metrics.describe("bot_admission_waiting", "gauge", "HTTP requests waiting for a free slot by route class")
+metrics.describe("bot_admission_rejected_total", "counter", "HTTP requests rejected by route class and reason (queue_full, timeout, too_large)")
+
+
+class TokenBucket:
+    """
+    Token bucket для одного лимита Telegram.
+    Работает только внутри общего event loop, поэтому обходится без блокировок.
+    - rate: сколько токенов в секунду восстанавливается
+    - capacity: максимальный размер всплеска
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return now
+
+    def reserve(self):
+        """
+        Забирает токен (можно в долг) и возвращает, сколько секунд нужно подождать.
+        """
+        now = self._refill()
+        self.tokens -= 1
+
+        delay = max(0.0, self.blocked_until - now)
+        if self.tokens < 0:
+            delay = max(delay, -self.tokens / self.rate)
+        return delay
+
+    def available_in(self):
+        """
+        Через сколько секунд появится целый токен (0 — уже есть). Токен не забирает.
+        """
+        now = self._refill()
+        delay = max(0.0, self.blocked_until - now)
+        if self.tokens < 1:
+            delay = max(delay, (1 - self.tokens) / self.rate)
+        return delay
+
+    def take(self):
+        self.tokens -= 1
+
+    def block(self, seconds):
+        """
+        Запрещает отправку на seconds секунд (ответ Telegram RetryAfter).
+        """
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def is_idle(self, now):
+        return now >= self.blocked_until and self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+
+# Классы приоритета исходящих запросов, от высшего к низшему:
+# ERROR-логи, WARNING-логи, ответы на команды бота, все остальное (/post, /edit, /delete, пакеты)
+DISPATCH_LANES = ("error", "warning", "command", "bulk")
+_LANE_RANK = {lane: rank for rank, lane in enumerate(DISPATCH_LANES)}
+
+
+def pick_lane(heads, now):
+    """
+    Выбирает класс, чей запрос обслужить следующим. heads: класс → время постановки первого запроса в нем.
+    Каждые PRIORITY_AGING_SECONDS ожидания поднимают запрос на один класс, поэтому низкий класс не голодает.
+    При равенстве выигрывает более высокий класс.
+    """
+    return min(heads, key=lambda lane: (_LANE_RANK[lane] - (now - heads[lane]) / PRIORITY_AGING_SECONDS, _LANE_RANK[lane]))
+
+
+class LaneScheduler:
+    """
+    Раздает общий бюджет запросов бота (bucket) по классам приоритета.
+    - Пока никто не ждет и токен есть, запрос проходит сразу.
+    - Иначе запрос встает в очередь своего класса, и диспетчер выдает токены по мере
+      их появления: сначала высшим классам, с учетом старения (см. pick_lane).
+    Работает только внутри общего event loop.
+    """
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.waiters = {lane: deque() for lane in DISPATCH_LANES}  # класс → [(время постановки, future)]
+        self.dispatcher = None
+
+    async def acquire(self, lane):
+        """
+        Ждет токен общего бюджета. Возвращает время ожидания в секундах.
+        """
+        if self.dispatcher is None and self.bucket.available_in() == 0:
+            self.bucket.take()
+            metrics.observe("bot_lane_wait_seconds", 0.0, (("lane", lane), ("stage", "rate_limiter")))
+            return 0.0
+
+        started = time.monotonic()
+        future = asyncio.get_running_loop().create_future()
+        self.waiters[lane].append((started, future))
+        if self.dispatcher is None:
+            self.dispatcher = asyncio.ensure_future(self._dispatch())
+        await future
+
+        waited = time.monotonic() - started
+        metrics.observe("bot_lane_wait_seconds", waited, (("lane", lane), ("stage", "rate_limiter")))
+        return waited
+
+    async def _dispatch(self):
+        try:
+            while True:
+                heads = {}
+                for lane, waiters in self.waiters.items():
+                    # Запросы, которые перестали ждать (отмененные), токен не получают
+                    while waiters and waiters[0][1].done():
+                        waiters.popleft()
+                    if waiters:
+                        heads[lane] = waiters[0][0]
+                if not heads:
+                    return
+
+                delay = self.bucket.available_in()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                    continue
+
+                _, future = self.waiters[pick_lane(heads, time.monotonic())].popleft()
+                self.bucket.take()
+                future.set_result(None)
+        finally:
+            self.dispatcher = None
+
+    def depths(self):
+        return {lane: len(waiters) for lane, waiters in self.waiters.items()}
+
+
+class RateLimiter:
+    """
+    Ограничитель запросов к Telegram: общий bucket на бота, который раздается
+    по классам приоритета (LaneScheduler), и лениво создаваемые bucket'ы на каждый чат
+    с вытеснением простаивающих.
+    """
+
+    def __init__(self):
+        self.global_bucket = TokenBucket(RATE_LIMIT_GLOBAL, RATE_LIMIT_GLOBAL)
+        self.scheduler = LaneScheduler(self.global_bucket)
+        self.chat_buckets = {}
+        self.last_sweep = time.monotonic()
+
+    def _chat_bucket(self, chat_id):
+        chat_id = str(chat_id)
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            # Отрицательный chat_id — группа или канал, положительный — личный чат
+            if chat_id.startswith("-"):
+                bucket = TokenBucket(RATE_LIMIT_GROUP_PER_MIN / 60, RATE_LIMIT_CHAT_BURST)
+            else:
+                bucket = TokenBucket(RATE_LIMIT_PRIVATE, RATE_LIMIT_CHAT_BURST)
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+
+    def _sweep(self):
+        now = time.monotonic()
+        if now - self.last_sweep < RATE_LIMIT_IDLE_TTL:
+            return
+        self.last_sweep = now
+        idle = [chat_id for chat_id, bucket in self.chat_buckets.items()
+                if now - bucket.updated > RATE_LIMIT_IDLE_TTL and bucket.is_idle(now)]
+        for chat_id in idle:
+            del self.chat_buckets[chat_id]
+
+    async def acquire(self, chat_id, lane="bulk"):
+        """
+        Ждет, пока отправка в чат уложится и в лимит чата, и в общий лимит бота
+        (в общем лимите — с приоритетом класса lane).
+        Возвращает суммарное время ожидания в секундах.
+        """
+        self._sweep()
+        waited = 0.0
+
+        # Сначала лимит чата, чтобы не тратить общий бюджет на ожидающий чат
+        delay = self._chat_bucket(chat_id).reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+            waited += delay
+
+        waited += await self.scheduler.acquire(lane)
+        return waited
+
+    def penalize(self, chat_id, seconds):
+        self._chat_bucket(chat_id).block(seconds)
+
+
+rate_limiter = RateLimiter()
+
+# Бот, от имени которого выполняется текущий код: "" — основной (BOT_TOKEN), иначе bot_id из BOT_TOKENS.
+# Обработчики HTTP API берут его из закодированных параметров (см. decode_target), а фоновые задачи
+# (очередь, таймеры, уведомления) хранят bot_id вместе с задачей и выставляют перед вызовами Telegram
+current_bot_id = contextvars.ContextVar("current_bot_id", default="")
+
+
+class BotClient:
+    """
+    Клиент одного бота: экземпляр Bot со своим пулом соединений, свой бюджет запросов (RateLimiter)
+    и счетчики вызовов по результату.
+    """
+
+    def __init__(self, bot_id, bot, limiter, stats, request=None):
+        self.bot_id = bot_id
+        self.bot = bot
+        self.rate_limiter = limiter
+        self.stats = stats
+        self.request = request  # пул соединений, который закрывается при вытеснении клиента
+        self.active = 0
+        self.last_used = time.monotonic()
+
+    def is_idle(self, now):
+        return not self.active and self.rate_limiter.scheduler.dispatcher is None and now - self.last_used >= BOT_IDLE_TTL
+
+
+class BotRegistry:
+    """
+    Боты, которых обслуживает процесс.
+    - Основной бот ("", BOT_TOKEN) — global_bot с общим rate_limiter: он же получает обновления
+      и отвечает на команды, поэтому живет все время.
+    - Дополнительные боты (BOT_TOKENS) создаются лениво, при первом вызове от их имени:
+      у каждого свой пул соединений (BOT_TENANT_POOL_SIZE) и свои лимиты Telegram (лимиты считаются на бота).
+    - Клиент, к которому не обращались BOT_IDLE_TTL секунд, закрывается; следующий вызов создаст его заново.
+      Счетчики вызовов переживают вытеснение.
+    Клиенты создаются и закрываются только внутри общего event loop.
+    """
+
+    RESULTS = ("ok", "error", "retry_after", "circuit_open")
+
+    def __init__(self, tokens, primary_bot, primary_limiter):
+        self.tokens = tokens
+        self.stats = {"": dict.fromkeys(self.RESULTS, 0)}  # bot_id → результат → число вызовов
+        self.clients = {"": BotClient("", primary_bot, primary_limiter, self.stats[""])}
+        self.sweeper = None
+        self.lock = threading.Lock()  # для чтения клиентов и счетчиков из /metrics
+
+    def __contains__(self, bot_id):
+        return not bot_id or bot_id in self.tokens
+
+    def get(self, bot_id):
+        """
+        Возвращает клиент бота, при необходимости создавая его. Неизвестный bot_id — KeyError.
+        """
+        client = self.clients.get(bot_id)
+        if client is None:
+            if bot_id not in self.tokens:
+                raise KeyError(f"Unknown bot '{bot_id}'")
+            # Дополнительные боты не получают обновления: без get_updates_request Bot создал бы второй
+            # HTTPX-клиент, который никто не закрывает, поэтому оба запроса идут через один пул
+            request = HTTPXRequest(connection_pool_size=BOT_TENANT_POOL_SIZE, pool_timeout=POOL_TIMEOUT)
+            tenant_bot = Bot(token=self.tokens[bot_id], base_url=TELEGRAM_BASE_URL, request=request, get_updates_request=request)
+            with self.lock:
+                stats = self.stats.setdefault(bot_id, dict.fromkeys(self.RESULTS, 0))
+                client = self.clients[bot_id] = BotClient(bot_id, tenant_bot, RateLimiter(), stats, request)
+            logger.info("🤖 Создан клиент бота %s, пул соединений: %d", bot_id, BOT_TENANT_POOL_SIZE)
+            if self.sweeper is None:
+                self.sweeper = asyncio.get_running_loop().call_later(BOT_IDLE_TTL, self._sweep)
+        client.last_used = time.monotonic()
+        return client
+
+    def _sweep(self):
+        self.sweeper = None
+        now = time.monotonic()
+        with self.lock:
+            idle = [client for bot_id, client in self.clients.items() if bot_id and client.is_idle(now)]
+            for client in idle:
+                del self.clients[client.bot_id]
+        for client in idle:
+            asyncio.ensure_future(client.request.shutdown())
+            logger.info("💤 Клиент бота %s закрыт после %d с простоя", client.bot_id, BOT_IDLE_TTL)
+        if len(self.clients) > 1:
+            self.sweeper = asyncio.get_running_loop().call_later(BOT_IDLE_TTL, self._sweep)
+
+    def collect(self):
+        with self.lock:
+            stats = [(bot_id or "default", dict(counts)) for bot_id, counts in self.stats.items()]
+            limiters = [client.rate_limiter for client in self.clients.values()]
+        samples = [("bot_clients_open", (), len(limiters))]
+        for bot_id, counts in stats:
+            samples.extend(("bot_client_requests_total", (("bot_id", bot_id), ("result", result)), value) for result, value in counts.items())
+        for lane in DISPATCH_LANES:
+            depth = sum(limiter.scheduler.depths()[lane] for limiter in limiters)
+            samples.append(("bot_lane_depth", (("lane", lane), ("stage", "rate_limiter")), depth))
+        return samples
+
+
+bot_registry = BotRegistry(BOT_TENANT_TOKENS, global_bot, rate_limiter)
+metrics.add_collector(bot_registry.collect)
+
+
+class CircuitOpenError(Exception):
+    """
+    Вызов Telegram не выполнялся: предохранитель разомкнут. retry_after — через сколько секунд пробовать снова.
+    """
+
+    def __init__(self, retry_after):
+        super().__init__(f"Telegram API is unavailable, retry in {math.ceil(retry_after)} s")
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    Предохранитель для всех вызовов Telegram Bot API.
+    - closed: вызовы идут как обычно, исходы за последние window секунд запоминаются.
+      Если вызовов не меньше min_calls, а доля сбоев (сетевые ошибки и таймауты) не меньше failure_rate,
+      предохранитель размыкается.
+    - open: вызовы сразу получают CircuitOpenError, не дожидаясь таймаута.
+      Пауза растет вдвое при каждом размыкании подряд (до max_delay), со случайным разбросом,
+      чтобы процессы не возвращались к Telegram одновременно.
+    - half_open: после паузы пропускается один пробный вызов; успех замыкает предохранитель, сбой — снова размыкает.
+    Ошибки запроса (BadRequest, Forbidden) и RetryAfter сбоем не считаются: Telegram отвечает.
+    Работает только внутри общего event loop.
+    """
+
+    CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+
+    def __init__(self, failure_rate, min_calls, window, base_delay, max_delay):
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.window = window
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.state = self.CLOSED
+        self.outcomes = deque()  # (время, был ли сбой) за последние window секунд
+        self.failures = 0
+        self.opened_in_row = 0
+        self.open_until = 0.0
+        self.probing = False
+
+    @staticmethod
+    def is_failure(e):
+        return isinstance(e, NetworkError) and not isinstance(e, BadRequest)
+
+    def _transition(self, state):
+        self.state = state
+        metrics.inc("bot_circuit_transitions_total", (("state", state),))
+
+    def check(self):
+        """
+        Бросает CircuitOpenError, если вызов сейчас заведомо не пройдет. Пробный вызов не забирает.
+        """
+        if self.state == self.CLOSED:
+            return
+        now = time.monotonic()
+        if self.state == self.OPEN and now < self.open_until:
+            raise CircuitOpenError(self.open_until - now)
+        if self.probing:
+            raise CircuitOpenError(self.base_delay)
+
+    def before_call(self):
+        """
+        Разрешает вызов или бросает CircuitOpenError. Возвращает True, если вызов пробный.
+        Вызывается непосредственно перед запросом к Telegram, после ожидания в ограничителе.
+        """
+        if self.state == self.CLOSED:
+            return False
+        now = time.monotonic()
+        if self.state == self.OPEN:
+            if now < self.open_until:
+                raise CircuitOpenError(self.open_until - now)
+            self._transition(self.HALF_OPEN)
+            logger.info("🔌 Предохранитель Telegram: пробный вызов")
+        if self.probing:
+            raise CircuitOpenError(self.base_delay)
+        self.probing = True
+        return True
+
+    def release_probe(self):
+        # Пробный вызов прервался, не дав результата (отмена) — пропускаем следующий
+        self.probing = False
+
+    def record(self, failed):
+        now = time.monotonic()
+        if self.state == self.HALF_OPEN:
+            self.probing = False
+            if failed:
+                self._open(now)
+            else:
+                self.opened_in_row = 0
+                self._transition(self.CLOSED)
+                logger.info("✅ Предохранитель Telegram замкнут: Telegram снова отвечает")
+            return
+        if self.state == self.OPEN:
+            return  # вызов начался до размыкания
+
+        self.outcomes.append((now, failed))
+        self.failures += failed
+        while self.outcomes and self.outcomes[0][0] < now - self.window:
+            self.failures -= self.outcomes.popleft()[1]
+        if len(self.outcomes) >= self.min_calls and self.failures >= self.failure_rate * len(self.outcomes):
+            self._open(now)
+
+    def _open(self, now):
+        delay = min(self.max_delay, self.base_delay * 2 ** self.opened_in_row)
+        delay = delay / 2 + random.uniform(0, delay / 2)
+        self.opened_in_row += 1
+        self.open_until = now + delay
+        self.outcomes.clear()
+        self.failures = 0
+        self._transition(self.OPEN)
+        logger.warning(f"🔌 Предохранитель Telegram разомкнут на {delay:.1f} с: слишком много сбоев вызовов API")
+
+    def retry_after(self):
+        """
+        Сколько секунд осталось до пробного вызова (0, если предохранитель замкнут или пауза прошла).
+        """
+        return max(0.0, self.open_until - time.monotonic()) if self.state == self.OPEN else 0.0
+
+    def state_value(self):
+        return {self.CLOSED: 0, self.HALF_OPEN: 1, self.OPEN: 2}[self.state]
+
+
+circuit_breaker = CircuitBreaker(CIRCUIT_FAILURE_RATE, CIRCUIT_MIN_CALLS, CIRCUIT_WINDOW, CIRCUIT_OPEN_BASE, CIRCUIT_OPEN_MAX)
+metrics.add_collector(lambda: [("bot_circuit_state", (), circuit_breaker.state_value())])
+
+
+# Методы, на которые распространяются лимиты Telegram на отправку
+RATE_LIMITED_METHODS = ("send_message", "edit_message_text", "delete_message", "delete_messages")
+
+
+async def _call_bot(client, method, chat_id, lane, kwargs):
+    """
+    Вызов метода через клиент бота с учетом лимитов, RetryAfter и предохранителя (см. telegram_call).
+    """
+    for attempt in range(RETRY_AFTER_ATTEMPTS + 1):
+        try:
+            # Пока Telegram недоступен, не ждем в ограничителе; пробный вызов забираем только
+            # перед самим запросом, иначе он застрял бы в лимите чата и держал 503 для всех остальных
+            circuit_breaker.check()
+            if method in RATE_LIMITED_METHODS:
+                metrics.observe("bot_rate_limiter_wait_seconds", await client.rate_limiter.acquire(chat_id, lane))
+            probe = circuit_breaker.before_call()
+        except CircuitOpenError:
+            metrics.inc("bot_telegram_requests_total", (("method", method), ("result", "circuit_open")))
+            client.stats["circuit_open"] += 1
+            raise
+
+        try:
+            started = time.perf_counter()
+            try:
+                result = await getattr(client.bot, method)(chat_id=chat_id, **kwargs)
+            except RetryAfter as e:
+                circuit_breaker.record(False)
+                metrics.observe("bot_telegram_request_duration_seconds", time.perf_counter() - started, (("method", method),))
+                metrics.inc("bot_telegram_requests_total", (("method", method), ("result", "retry_after")))
+                client.stats["retry_after"] += 1
+                if attempt == RETRY_AFTER_ATTEMPTS or e.retry_after > RETRY_AFTER_MAX_WAIT:
+                    raise
+                client.rate_limiter.penalize(chat_id, e.retry_after)
+                logger.warning(f"⚠️ Telegram просит подождать {e.retry_after} с ({method}, чат {chat_id}), попытка {attempt + 1}")
+                continue
+            except Exception as e:
+                circuit_breaker.record(CircuitBreaker.is_failure(e))
+                metrics.observe("bot_telegram_request_duration_seconds", time.perf_counter() - started, (("method", method),))
+                metrics.inc("bot_telegram_requests_total", (("method", method), ("result", "error")))
+                client.stats["error"] += 1
+                raise
+            circuit_breaker.record(False)
+        finally:
+            if probe and circuit_breaker.probing:
+                circuit_breaker.release_probe()
+
+        metrics.observe("bot_telegram_request_duration_seconds", time.perf_counter() - started, (("method", method),))
+        metrics.inc("bot_telegram_requests_total", (("method", method), ("result", "ok")))
+        client.stats["ok"] += 1
+        return result
+
+
+async def telegram_call(method, chat_id, lane="bulk", **kwargs):
+    """
+    Вызывает метод бота current_bot_id (send_message, edit_message_text, delete_message, get_chat).
+    - Отправка и правка идут через ограничитель запросов этого бота с приоритетом класса lane (см. DISPATCH_LANES).
+    - При RetryAfter ждет указанное Telegram время и повторяет запрос вместо ошибки.
+    - Пока предохранитель разомкнут (см. CircuitBreaker), сразу бросает CircuitOpenError.
+    - Успешные вызовы обновляют локальное хранилище текстов сообщений (для /get).
+    - Время каждого вызова и ожидания в ограничителе попадает в /metrics.
+    """
+    client = bot_registry.get(current_bot_id.get())
+    client.active += 1
+    try:
+        result = await _call_bot(client, method, chat_id, lane, kwargs)
+    finally:
+        client.active -= 1
+        client.last_used = time.monotonic()
+
+    if method == "send_message":
+        message_store.put(chat_id, result.message_id, kwargs["text"])
+        rendered_cache.remember(chat_id, result.message_id, kwargs["text"])
+    elif method == "edit_message_text":
+        message_store.put(chat_id, kwargs["message_id"], kwargs["text"])
+        rendered_cache.remember(chat_id, kwargs["message_id"], kwargs["text"])
+    elif method == "delete_message":
+        message_store.delete(chat_id, kwargs["message_id"])
+        rendered_cache.forget(chat_id, kwargs["message_id"])
+    elif method == "delete_messages":
+        for message_id in kwargs["message_ids"]:
+            message_store.delete(chat_id, message_id)
+            rendered_cache.forget(chat_id, message_id)
+    return result
+
+
+async def send_message_parts(chat_id, parts, thread_id=None, lane="bulk", message_ids=None):
+    """
+    Отправляет части одного длинного сообщения строго по порядку и возвращает их message_id.
+    message_ids — список уже отправленных частей: они пропускаются, а новые дописываются в него же,
+    поэтому после ошибки на середине повтор продолжит с первой неотправленной части.
+    """
+    message_ids = [] if message_ids is None else message_ids
+    for text in parts[len(message_ids):]:
+        sent_message = await telegram_call(
+            "send_message", chat_id, lane=lane, text=text, parse_mode=ParseMode.HTML, message_thread_id=thread_id
+        )
+        message_ids.append(sent_message.message_id)
+    return message_ids
+
+
+# Числа, hex-строки и идентификаторы не влияют на отпечаток лога:
+# "timeout after 31 ms" и "timeout after 57 ms" считаются одной ошибкой
+_FINGERPRINT_NOISE = re.compile(r"0x[0-9a-f]+|\b[0-9a-f]{8,}\b|\d+")
+
+
+def log_fingerprint(text):
+    """
+    Возвращает короткий отпечаток нормализованного текста лога.
+    """
+    normalized = _FINGERPRINT_NOISE.sub("#", " ".join(str(text).lower().split()))
+    return hashlib.blake2b(normalized.encode(), digest_size=8).hexdigest()
+
+
+class LogCoalescer:
+    """
+    Склеивает повторяющиеся логи.
+    Ключ — (бот, chat_id, topic_id, log_type, отпечаток текста). В пределах окна
+    LOG_COALESCE_WINDOW отправляется только первое сообщение, а повторы
+    дописываются в него счетчиком "×N за последние N с" (правкой не чаще раза
+    в LOG_COALESCE_EDIT_DELAY). Таблица ограничена по размеру и времени жизни.
+    """
+
+    def __init__(self, window, edit_delay, max_keys):
+        self.window = window
+        self.edit_delay = edit_delay
+        self.max_keys = max_keys
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def register(self, chat_id, topic_id, log_type, text):
+        """
+        Учитывает очередной лог и возвращает (entry, is_first).
+        Если is_first — лог нужно отправить и сообщить message_id через sent().
+        Иначе это повтор: счетчик уже увеличен, правка будет запланирована.
+        """
+        entry, is_first, _ = self._register(chat_id, topic_id, log_type, text, wait=False)
+        return entry, is_first
+
+    async def register_request(self, chat_id, topic_id, log_type, text):
+        """
+        Как register(), но для запроса /log, которому нужен ответ.
+        Повтор, пришедший, пока первое сообщение еще отправляется, ждет его результата
+        (как повтор с тем же Idempotency-Key) и склеивается, только когда сообщение или задача
+        уже есть. Если первое сообщение отправить не удалось, повтор сам становится первым.
+        """
+        while True:
+            entry, is_first, ready = self._register(chat_id, topic_id, log_type, text, wait=True)
+            if ready is None:
+                return entry, is_first
+            await asyncio.shield(ready)
+
+    def _register(self, chat_id, topic_id, log_type, text, wait):
+        if not self.window:
+            return None, True, None
+
+        bot_id = current_bot_id.get()
+        key = (bot_id, str(chat_id), str(topic_id) if topic_id else None, log_type, log_fingerprint(text))
+        now = time.monotonic()
+        with self.lock:
+            self._evict(now)
+            entry = self.entries.get(key)
+            if entry is None or now - entry["first_seen"] > self.window:
+                entry = {
+                    "key": key, "bot_id": bot_id, "chat_id": chat_id, "count": 1, "first_seen": now,
+                    "message_id": None, "job_id": None, "text": None, "flush_scheduled": False, "ready": None,
+                }
+                self.entries[key] = entry
+                self.entries.move_to_end(key)
+                return entry, True, None
+
+            if wait and entry["message_id"] is None and entry["job_id"] is None:
+                # Первое сообщение еще отправляется: повтор не учитываем, пока не станет известен результат
+                if entry["ready"] is None:
+                    entry["ready"] = asyncio.get_running_loop().create_future()
+                return entry, False, entry["ready"]
+
+            entry["count"] += 1
+            schedule = not entry["flush_scheduled"]
+            entry["flush_scheduled"] = True
+
+        if schedule:
+            asyncio.run_coroutine_threadsafe(self._flush(entry), get_bot_loop())
+        return entry, False, None
+
+    def sent(self, entry, text, message_id=None, job_id=None):
+        """
+        Запоминает отправленное первое сообщение (или задачу асинхронного режима).
+        """
+        if entry is None:
+            return
+        with self.lock:
+            entry["text"] = text
+            entry["message_id"] = message_id
+            entry["job_id"] = job_id
+            ready, entry["ready"] = entry["ready"], None
+        self._wake(ready)
+
+    def forget(self, entry):
+        """
+        Убирает запись, если первое сообщение отправить не удалось.
+        """
+        if entry is None:
+            return
+        with self.lock:
+            if self.entries.get(entry["key"]) is entry:
+                del self.entries[entry["key"]]
+            ready, entry["ready"] = entry["ready"], None
+        self._wake(ready)
+
+    @staticmethod
+    def _wake(ready):
+        # Повторы, ждущие первого сообщения, регистрируются заново (sent и forget бывают и из других потоков)
+        if ready is not None:
+            ready.get_loop().call_soon_threadsafe(lambda: ready.done() or ready.set_result(None))
+
+    def _evict(self, now):
+        # Сначала устаревшие записи (они в начале словаря), затем лишние по размеру
+        while self.entries:
+            oldest = next(iter(self.entries.values()))
+            if now - oldest["first_seen"] <= self.window and len(self.entries) < self.max_keys:
+                break
+            self.entries.popitem(last=False)
+
+    async def _flush(self, entry):
+        await asyncio.sleep(self.edit_delay)
+
+        with self.lock:
+            entry["flush_scheduled"] = False
+            message_id = entry["message_id"]
+            job = {}
+            if message_id is None and entry["job_id"]:
+                # Счетчик дописывается в последнюю часть лога
+                job = get_job(entry["job_id"]) or {}
+                message_id = entry["message_id"] = (job.get("message_ids") or [None])[-1]
+            count = entry["count"]
+            text = entry["text"]
+            elapsed = int(time.monotonic() - entry["first_seen"])
+            pending = entry["text"] is None or job.get("status") == "queued"
+            if message_id is None and pending and self.entries.get(entry["key"]) is entry:
+                # Первое сообщение (или задача асинхронного режима) еще отправляется — попробуем позже
+                entry["flush_scheduled"] = True
+                asyncio.ensure_future(self._flush(entry))
+                return
+
+        if message_id is None:
+            if entry["job_id"]:
+                logger.warning(f"⚠️ Счетчик повторов лога не дописан: задача {entry['job_id']} в чате {entry['chat_id']} не отправлена")
+            return
+
+        # Счетчик дописывает тот же бот, что отправил первое сообщение
+        current_bot_id.set(entry["bot_id"])
+        try:
+            await telegram_call(
+                "edit_message_text",
+                entry["chat_id"],
+                message_id=int(message_id),
+                text=f"{text}\n\n🔁 ×{count} за последние {max(elapsed, 1)} с",
+                parse_mode=ParseMode.HTML
+            )
+            logger.info("🔁 Лог в чате %s повторился %s раз, сообщение %s обновлено", entry["chat_id"], count, message_id)
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось обновить счетчик повторов лога {message_id} в чате {entry['chat_id']}: {str(e)}")
+
+
+log_coalescer = LogCoalescer(LOG_COALESCE_WINDOW, LOG_COALESCE_EDIT_DELAY, LOG_COALESCE_MAX_KEYS)
+
+
+class Notifier:
+    """
+    Фоновая отправка уведомлений log_and_notify.
+    - submit() только ставит уведомление в очередь и сразу возвращает управление.
+    - Очередь ограничена NOTIFY_QUEUE_SIZE: лишние уведомления отбрасываются и считаются.
+    - Отправитель работает в общем event loop через бота, от имени которого шел запрос,
+      и его ограничитель запросов, не больше NOTIFY_CONCURRENCY уведомлений одновременно.
+    """
+
+    def __init__(self, capacity, concurrency):
+        self.capacity = capacity
+        self.concurrency = concurrency
+        self.queue = asyncio.Queue()
+        self.sender = None
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.stats = {"submitted": 0, "sent": 0, "failed": 0, "dropped": 0}
+
+    def submit(self, chat_id, thread_id, text, entry=None, lane="error"):
+        """
+        Ставит уведомление в очередь. Возвращает False, если очередь переполнена.
+        lane — класс приоритета отправки ("error" или "warning").
+        """
+        with self.lock:
+            if self.pending >= self.capacity:
+                self.stats["dropped"] += 1
+                dropped = self.stats["dropped"]
+            else:
+                dropped = 0
+                self.pending += 1
+                self.stats["submitted"] += 1
+
+        if dropped:
+            # Не засоряем консоль: предупреждаем о первом и каждом сотом отброшенном уведомлении
+            if dropped % 100 == 1:
+                logger.warning(f"⚠️ Очередь уведомлений переполнена ({self.capacity}), отброшено уведомлений: {dropped}")
+            return False
+
+        get_bot_loop().call_soon_threadsafe(self._enqueue, (current_bot_id.get(), chat_id, thread_id, text, entry, lane))
+        return True
+
+    def _enqueue(self, item):
+        if self.sender is None:
+            self.sender = asyncio.ensure_future(self._run())
+        self.queue.put_nowait(item)
+
+    async def _run(self):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        while True:
+            item = await self.queue.get()
+            with self.lock:
+                self.pending -= 1
+            await semaphore.acquire()
+            task = asyncio.ensure_future(self._send(*item))
+            task.add_done_callback(lambda _: semaphore.release())
+
+    async def _send(self, bot_id, chat_id, thread_id, text, entry, lane):
+        current_bot_id.set(bot_id)
+        try:
+            sent_message = await telegram_call(
+                "send_message",
+                chat_id,
+                lane=lane,
+                message_thread_id=thread_id,
+                text=text,
+                parse_mode=ParseMode.HTML
+            )
+            log_coalescer.sent(entry, text, sent_message.message_id)
+            with self.lock:
+                self.stats["sent"] += 1
+            logger.info("✅ Уведомление отправлено в чат %s", chat_id)
+        except Exception as e:
+            # Здесь нельзя вызывать log_and_notify: ошибка уведомления породила бы новое уведомление
+            log_coalescer.forget(entry)
+            with self.lock:
+                self.stats["failed"] += 1
+            logger.error(f"❌ Ошибка при отправке уведомления в чат {chat_id}: {str(e)}")
+
+
+notifier = Notifier(NOTIFY_QUEUE_SIZE, NOTIFY_CONCURRENCY)
+
+
+def log_and_notify(level, message, chat_id=None, topic_id=None):
+    """
+    Логирует сообщение и отправляет его в тот же чат или топик, где произошла ошибка.
+    
+    level: уровень логирования (logging.ERROR, logging.WARNING)
+    message: текст ошибки/предупреждения
+    chat_id: ID чата (если известен)
+    topic_id: ID топика (если известен)
+    """
+    log_type = "error" if level == logging.ERROR else "warning"
+
+    if level == logging.ERROR:
+        logger.error(message)
+    else:
+        logger.warning(message)
+
+    # Если chat_id неизвестен, логируем только в консоль
+    if not chat_id:
+        logger.warning("⚠️ Логирование в Telegram пропущено: chat_id не задан.")
+        return
+
+    log_label = "🔴 ERROR" if log_type == "error" else "🟡 WARNING"
+    log_message = f"{log_label}\n📝 {message}"
+
+    # Повторы той же ошибки не отправляем отдельными сообщениями, а дописываем счетчиком в первое
+    entry, is_first = log_coalescer.register(chat_id, topic_id, log_type, message)
+    if not is_first:
+        return
+
+    # Уведомление ставится в фоновую очередь: вызывающий не ждет ответа Telegram
+    thread_id = topic_id if topic_id and str(topic_id).isdigit() else None
+    if not notifier.submit(chat_id, thread_id, log_message, entry, log_type):
+        log_coalescer.forget(entry)
+
+
+# HTML-тег в тексте сообщения: "/" у закрывающего тега, имя тега и "/" у самозакрывающегося
+HTML_TAG_RE = re.compile(r"<(/?)([a-zA-Z][a-zA-Z0-9-]*)[^>]*?(/?)>")
+
+
+class MessageParts:
+    """
+    Собирает HTML-текст сообщения по кусочкам и делит его на части не длиннее limit символов.
+    - Длина текущей части считается по ходу: текст не склеивается и не пересчитывается заново.
+    - Кусочек, не влезающий в текущую часть, начинает новую. Слишком длинный кусочек режется
+      по строкам, длинная строка — по пробелам, в крайнем случае по символам;
+      теги и HTML-сущности (&amp; и т.п.) не разрезаются.
+    - Теги, открытые на месте разреза (<b>, <i>, ...), закрываются в конце части
+      и открываются заново в начале следующей.
+    limit=None — без деления, всегда одна часть.
+    """
+
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.parts = []
+        self._chunks = []
+        self._length = 0
+        self._has_content = False
+        self._open_tags = []  # [(имя, открывающий тег)]
+        self._closing_length = 0  # сколько займут закрывающие теги для открытых тегов
+
+    def add(self, text):
+        if self.limit is None:
+            self._chunks.append(text)
+            return
+
+        while text:
+            room = self._room()
+            if self._fits(text, room):
+                self._append_whole(text)
+                return
+
+            # Не влезает в текущую часть, но целиком влезет в новую — начинаем новую
+            if self._has_content and self._fits(text.lstrip("\n"), self._new_part_room()):
+                self._flush()
+                self._append_whole(text.lstrip("\n"))
+                return
+
+            # Дописываем столько целых строк, сколько влезает
+            cut = text.rfind("\n", 0, room + 1)
+            while cut > 0 and not self._fits(text[:cut], room):
+                cut = text.rfind("\n", 0, cut)
+            if cut > 0:
+                self._append_whole(text[:cut])
+                self._flush()
+                text = text[cut + 1:]
+                continue
+
+            # Первая строка сама по себе не влезает: переносим ее в новую часть или режем
+            line_end = text.find("\n", 1)
+            if line_end == -1:
+                line_end = len(text)
+            line = text[:line_end]
+            if self._has_content and self._fits(line.lstrip("\n"), self._new_part_room()):
+                self._flush()
+                self._append_whole(line.lstrip("\n"))
+            else:
+                self._add_tokens(line, split=True)
+            text = text[line_end:]
+
+    def finish(self):
+        """
+        Возвращает список частей (пустой, если текста нет).
+        """
+        if self.limit is None:
+            text = "".join(self._chunks).strip()
+            return [text] if text else []
+        if self._has_content:
+            self._flush()
+        return self.parts
+
+    def _room(self):
+        return self.limit - self._length - self._closing_length
+
+    def _new_part_room(self):
+        return self.limit - sum(len(tag) for _, tag in self._open_tags) - self._closing_length
+
+    def _fits(self, text, room):
+        # Кроме самого кусочка нужно место под закрывающие теги, которые он оставит открытыми
+        if len(text) > room or "<" not in text:
+            return len(text) <= room
+        names = [name for name, _ in self._open_tags]
+        closing_length = self._closing_length
+        for match in HTML_TAG_RE.finditer(text):
+            closing, name, self_closing = match.groups()
+            name = name.lower()
+            if closing:
+                if name in names:
+                    del names[len(names) - 1 - names[::-1].index(name)]
+                    closing_length -= len(name) + 3
+            elif not self_closing:
+                names.append(name)
+                closing_length += len(name) + 3
+        return len(text) + closing_length - self._closing_length <= room
+
+    def _append(self, chunk):
+        self._chunks.append(chunk)
+        self._length += len(chunk)
+        # Содержимым считается только видимый текст: часть из одних тегов Telegram не примет
+        visible = HTML_TAG_RE.sub("", chunk) if "<" in chunk else chunk
+        if visible.strip():
+            self._has_content = True
+
+    def _flush(self):
+        if not self._has_content:
+            # В части пока одни теги (или пробелы) — отправлять нечего, продолжаем ее заполнять
+            return
+        closing = "".join(f"</{name}>" for name, _ in reversed(self._open_tags))
+        part = ("".join(self._chunks) + closing).strip()
+        if part:
+            self.parts.append(part)
+        self._chunks = [tag for _, tag in self._open_tags]
+        self._length = sum(len(tag) for tag in self._chunks)
+        self._has_content = False
+
+    def _append_whole(self, text):
+        # Кусочек целиком влезает в часть: дописываем одним куском, теги только учитываем
+        self._append(text)
+        # Теги проходим всегда: "</b>\n<i>" закрывает один тег и открывает другой, хотя по числу тегов сбалансирован
+        if "<" not in text:
+            return
+        for match in HTML_TAG_RE.finditer(text):
+            closing, name, self_closing = match.groups()
+            name = name.lower()
+            if closing:
+                self._close_tag(name)
+            elif not self_closing:
+                self._open_tags.append((name, match.group(0)))
+                self._closing_length += len(name) + 3
+
+    def _close_tag(self, name):
+        for index in range(len(self._open_tags) - 1, -1, -1):
+            if self._open_tags[index][0] == name:
+                del self._open_tags[index]
+                self._closing_length -= len(name) + 3
+                return
+
+    def _add_tokens(self, text, split=False):
+        position = 0
+        for match in HTML_TAG_RE.finditer(text):
+            self._add_text(text[position:match.start()], split)
+            self._add_tag(match.group(0), match.group(1), match.group(2).lower(), match.group(3))
+            position = match.end()
+        self._add_text(text[position:], split)
+
+    def _add_tag(self, tag, closing, name, self_closing):
+        if closing:
+            self._close_tag(name)
+            self._append(tag)
+            return
+
+        reserve = 0 if self_closing else len(name) + 3
+        if len(tag) + reserve > self._room() and self._has_content:
+            self._flush()
+        self._append(tag)
+        if not self_closing:
+            self._open_tags.append((name, tag))
+            self._closing_length += reserve
+
+    def _add_text(self, text, split):
+        while text:
+            room = self._room()
+            if len(text) <= room or not split:
+                self._append(text)
+                return
+
+            cut, skip = text[:room + 1].rfind(" "), 1
+            if cut <= 0:
+                word = text.lstrip(" ").split(" ", 1)[0]
+                if self._has_content and (room <= 0 or len(word) <= self._new_part_room()):
+                    # Слово целиком влезет в новую часть (или в текущей не осталось места) — переносим его туда
+                    self._flush()
+                    continue
+                cut, skip = max(room, 1), 0
+                # Не разрезаем HTML-сущность
+                ampersand = text.rfind("&", 0, cut)
+                if ampersand > 0 and text.find(";", ampersand, cut) == -1 and cut - ampersand < 10:
+                    cut = ampersand
+
+            self._append(text[:cut])
+            self._flush()
+            text = text[cut + skip:]
+
+
+def _format_value(key, value, depth=0):
+    """
+    Форматирует одно поле JSON (рекурсивно для вложенных структур).
+    Строки собираются списком и склеиваются один раз на уровень вложенности.
+    """
+    indent = "  " * depth  # Отступы для читаемости
+
+    if value is None or value == "":
+        return ""  # Пропускаем пустые значения
+
+    if isinstance(value, dict):
+        lines = [f"<b>{key}:</b>\n"]
+        for sub_key, sub_value in value.items():
+            processed = _format_value(sub_key, sub_value, depth + 1)
+            if processed:
+                lines.append(f"{indent}  <i>{sub_key}:</i> {processed}\n")
+        return "".join(lines).strip()
+
+    elif isinstance(value, list):
+        list_items = [str(item).strip() for item in value if item]  # Убираем пустые
+        return f"<b>{key}:</b> " + ", ".join(list_items)
+
+    else:
+        return f"<b>{key}:</b> {str(value).strip()}"
+
+
+def format_json_as_html_parts(data, limit=MessageLimit.MAX_TEXT_LENGTH, prefix="", template=None):
+    """
+    Преобразует JSON в HTML-формат для Telegram и делит результат на сообщения не длиннее limit.
+    Убирает пустые строки, None и форматирует вложенные структуры.
+    - prefix (например, метка лога) ставится в начало первой части.
+    - Если выбран зарегистрированный шаблон (аргумент template или поле "template" в JSON),
+      текст строится по нему, без обхода всего JSON.
+    - Возвращает список частей (пустой, если выводить нечего).
+    """
+    if not data:
+        logger.info("⚠️ Пустой JSON передан в format_json_as_html()")
+        return []
+
+    parts = MessageParts(limit)
+    if prefix:
+        parts.add(prefix)
+
+    compiled = payload_templates.select(data, template)
+    if compiled is not None:
+        parts.add(compiled.render(data).strip())
+        return parts.finish()
+
+    if "text" in data and isinstance(data["text"], str) and data["text"].strip():
+        logger.info("📝 Форматируем текстовое сообщение: %d символов", len(data["text"]))
+        parts.add(data["text"].strip())
+        return parts.finish()
+
+    length = 0
+    for key, value in data.items():
+        processed = _format_value(key, value)
+        if processed:
+            parts.add(f"\n{processed}" if length else processed)
+            length += len(processed) + 1
+
+    if not length:
+        logger.info("⚠️ JSON содержит только пустые значения!")
+        return parts.finish()
+
+    result = parts.finish()
+    logger.info("✅ JSON успешно преобразован в HTML, длина: %d символов, сообщений: %d", length - 1, len(result))
+    return result
+
+
+def format_json_as_html(data, template=None):
+    """
+    Преобразует JSON в HTML-формат для Telegram одним сообщением (без деления на части).
+    """
+    parts = format_json_as_html_parts(data, limit=None, template=template)
+    return parts[0] if parts else ""
+
+
+def _template_getter(path):
+    """
+    Функция, достающая значение по пути из полей ("job", "status") или None.
+    """
+    if len(path) == 1:
+        key = path[0]
+        return lambda data: data.get(key)
+
+    def getter(data):
+        for key in path:
+            if isinstance(data, dict):
+                data = data.get(key)
+            elif isinstance(data, list) and key.isdigit() and int(key) < len(data):
+                data = data[int(key)]
+            else:
+                return None
+        return data
+
+    return getter
+
+
+def _template_value(value):
+    if value is None:
+        return ""
+    if type(value) is not str:
+        if isinstance(value, list):
+            value = ", ".join(str(item).strip() for item in value if item)
+        elif isinstance(value, dict):
+            value = json.dumps(value, ensure_ascii=False)
+        else:
+            value = str(value)
+    return html.escape(value, quote=False)
+
+
+class PayloadTemplate:
+    """
+    Шаблон сообщения, скомпилированный один раз при регистрации.
+    - Поля: {message}, вложенные — {job.status}, элементы списков — {items.0}.
+    - Текст шаблона — готовый HTML, подставляемые значения экранируются.
+    - Отсутствующие поля и None дают пустую строку, списки — значения через запятую.
+    """
+
+    def __init__(self, name, source):
+        self.name = name
+        self.source = source
+        pieces = []
+        self._getters = []
+        for literal, field, spec, conversion in string.Formatter().parse(source):
+            pieces.append(literal.replace("{", "{{").replace("}", "}}"))
+            if field is None:
+                continue
+            if not field or spec or conversion:
+                raise ValueError(f"Unsupported placeholder in template '{name}': {{{field}}}")
+            pieces.append("{}")
+            self._getters.append(_template_getter(tuple(field.split("."))))
+        self._format = "".join(pieces).format
+
+    def render(self, data):
+        return self._format(*[_template_value(get(data)) for get in self._getters])
+
+
+class TemplateRegistry:
+    """
+    Реестр шаблонов сообщений: имя → PayloadTemplate.
+    - Загружается из JSON-файла TEMPLATES_FILE ({"имя": "шаблон", ...}) и дополняется через /templates.
+    - Если файл задан, изменения через /templates записываются в него, а остальные процессы
+      подхватывают их по времени изменения файла (проверка не чаще раза в секунду).
+    """
+
+    def __init__(self, path=""):
+        self.path = path
+        self.templates = {}
+        self.lock = threading.Lock()
+        self._mtime = None
+        self._checked_at = 0.0
+        if path:
+            self._reload()
+
+    def _reload(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime == self._mtime:
+            return
+        with open(self.path, encoding="utf-8") as f:
+            sources = json.load(f)
+        templates = {}
+        for name, source in sources.items():
+            try:
+                templates[name] = PayloadTemplate(name, source)
+            except ValueError as e:
+                logger.error(f"❌ Шаблон '{name}' из {self.path} пропущен: {str(e)}")
+        with self.lock:
+            self.templates = templates
+            self._mtime = mtime
+        logger.info(f"✅ Загружено шаблонов сообщений: {len(templates)} ({self.path})")
+
+    def _maybe_reload(self):
+        now = time.monotonic()
+        if not self.path or now - self._checked_at < 1:
+            return
+        self._checked_at = now
+        try:
+            self._reload()
+        except Exception as e:
+            logger.error(f"❌ Не удалось перечитать шаблоны из {self.path}: {str(e)}")
+
+    def _save(self):
+        # Запись через временный файл: другие процессы не прочитают файл наполовину
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({name: compiled.source for name, compiled in self.templates.items()}, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.path)
+        self._mtime = os.stat(self.path).st_mtime_ns
+
+    def get(self, name):
+        self._maybe_reload()
+        return self.templates.get(name)
+
+    def select(self, data, name=None):
+        """
+        Шаблон для запроса: по имени из параметра запроса или из поля "template" в JSON.
+        None — шаблон не выбран (или не найден), используется общий обход JSON.
+        """
+        if not name:
+            name = data.get("template") if isinstance(data, dict) else None
+            if not isinstance(name, str):
+                return None
+            return self.get(name)
+
+        compiled = self.get(name)
+        if compiled is None:
+            logger.warning(f"⚠️ Шаблон '{name}' не найден, используется обычное форматирование")
+        return compiled
+
+    def register(self, name, source):
+        compiled = PayloadTemplate(name, source)
+        with self.lock:
+            self.templates = {**self.templates, name: compiled}
+            if self.path:
+                self._save()
+        return compiled
+
+    def remove(self, name):
+        with self.lock:
+            if name not in self.templates:
+                return False
+            self.templates = {key: value for key, value in self.templates.items() if key != name}
+            if self.path:
+                self._save()
+        return True
+
+    def sources(self):
+        self._maybe_reload()
+        return {name: compiled.source for name, compiled in self.templates.items()}
+
+
+payload_templates = TemplateRegistry(TEMPLATES_FILE)
+
+
+def encode_params(chat_id, topic_id=None, bot_id=None):
+    """
+    Кодирует chat_id и topic_id в Base64.
+    - Если topic_id указан, кодируем chat_id + topic_id (для отправки сообщений в топик).
+    - Если topic_id НЕ указан, кодируем ТОЛЬКО chat_id (для редактирования, удаления, получения текста).
+    - Если указан bot_id (дополнительный бот из BOT_TOKENS), он ставится в начало: "<bot_id>/<chat_id>[:<topic_id>]".
+    """
+    try:
+        # Преобразуем chat_id и topic_id в строки (на случай, если они int)
+        chat_id = str(chat_id).strip()
+        topic_id = str(topic_id).strip() if topic_id is not None else None
+
+        # Проверяем, является ли chat_id корректным числом
+        if not chat_id.lstrip("-").isdigit():
+            raise ValueError(f"Некорректный chat_id: {chat_id}")
+
+        if bot_id and bot_id not in bot_registry:
+            raise ValueError(f"Неизвестный бот: {bot_id}")
+
+        # Создаем строку для кодирования
+        raw_string = f"{chat_id}:{topic_id}" if topic_id else chat_id
+        if bot_id:
+            raw_string = f"{bot_id}/{raw_string}"
+        encoded_string = base64.urlsafe_b64encode(raw_string.encode()).decode()
+
+        logger.info("✅ Кодировано: bot_id=%s, chat_id=%s, topic_id=%s → %s", bot_id or None, chat_id, topic_id or None, encoded_string)
+        return encoded_string
+
+    except Exception as e:
+        error_message = f"❌ Ошибка кодирования: chat_id={chat_id}, topic_id={topic_id if topic_id else 'None'} → {str(e)}"
+        log_and_notify(logging.ERROR, error_message, chat_id, topic_id)
+        return None
+
+
+def decode_target(encoded_string):
+    """
+    Декодирует Base64 в bot_id, chat_id и topic_id.
+    - bot_id — "" для основного бота (в строке нет префикса "<bot_id>/").
+    - Если код содержит ДВА параметра (chat_id:topic_id), то возвращает оба.
+    - Если ОДИН параметр (chat_id), значит, topic_id не передавался.
+    - В случае ошибки (в том числе незарегистрированный бот) логирует проблему и возвращает ("", None, None).
+    """
+    chat_id, topic_id = None, None
+
+    if not encoded_string:
+        log_and_notify(logging.WARNING, "⚠️ Пустая строка передана в decode_params()", chat_id, topic_id)
+        return "", None, None
+
+    try:
+        # Проверяем, является ли строка корректным Base64
+        padded_encoded = encoded_string + "=" * (-len(encoded_string) % 4)  # Делаем длину кратной 4
+        decoded = base64.urlsafe_b64decode(padded_encoded).decode().strip()
+
+        bot_id, separator, decoded = decoded.rpartition("/")
+        if separator and (not BOT_ID_RE.fullmatch(bot_id) or bot_id not in bot_registry):
+            raise ValueError(f"Неизвестный бот: {bot_id}")
+
+        if ":" in decoded:
+            chat_id, topic_id = decoded.split(":", 1)  # Ограничиваем split на 2 части
+        else:
+            chat_id, topic_id = decoded, None  # Если topic_id нет
+
+        # Проверяем, является ли chat_id корректным числом (Telegram chat_id всегда число)
+        if not chat_id.lstrip("-").isdigit():
+            raise ValueError(f"Некорректный chat_id: {chat_id}")
+
+        logger.info("✅ Декодирован bot_id=%s, chat_id=%s, topic_id=%s", bot_id or None, chat_id, topic_id or None)
+        return bot_id, chat_id, topic_id
+
+    except Exception as e:
+        error_message = f"❌ Ошибка декодирования Base64 ({encoded_string}): {str(e)}"
+        log_and_notify(logging.ERROR, error_message, chat_id, topic_id)
+        return "", None, None
+
+
+def decode_params(encoded_string):
+    """
+    Декодирует Base64 в chat_id и topic_id (бот не возвращается, см. decode_target).
+    В случае ошибки возвращает (None, None).
+    """
+    _, chat_id, topic_id = decode_target(encoded_string)
+    return chat_id, topic_id
+
+
+def use_target(encoded_string):
+    """
+    Декодирует параметры запроса (см. decode_target) и выполняет остаток запроса от имени их бота.
+    Возвращает (chat_id, topic_id).
+    """
+    bot_id, chat_id, topic_id = decode_target(encoded_string)
+    current_bot_id.set(bot_id)
+    return chat_id, topic_id
+
+
+
+class SQLiteWriter:
+    """
+    Основа для хранилищ в SQLite (WAL).
+    - Все записи делает один фоновый поток: накопившиеся операции
+      фиксируются одной транзакцией (group commit).
+    - synchronous=NORMAL в режиме WAL: без fsync на каждую запись.
+    - Чтение идет через отдельные соединения (по одному на поток) и не ждет записи.
+    """
+
+    schema = ""
+    name = "sqlite"
+
+    def __init__(self, path):
+        self.path = path
+        self._ops = queue.Queue()
+        self._local = threading.local()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(self.schema)
+        self._migrate()
+        threading.Thread(target=self._writer, name=f"{self.name}-writer", daemon=True).start()
+
+    def _migrate(self):
+        """
+        Доводит схему существующего файла до текущей версии (вызывается до запуска потока записи).
+        """
+
+    def _write(self, sql, params, future=None):
+        self._ops.put((sql, params, future))
+
+    def _read(self, sql, params=()):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(self.path)
+        return conn.execute(sql, params).fetchall()
+
+    def _writer(self):
+        while True:
+            # Ждем первую операцию, затем забираем все, что успело накопиться
+            batch = [self._ops.get()]
+            while len(batch) < OUTBOX_BATCH_SIZE:
+                try:
+                    batch.append(self._ops.get_nowait())
+                except queue.Empty:
+                    break
+
+            error = None
+            try:
+                self._conn.execute("BEGIN")
+                for sql, params, _ in batch:
+                    self._conn.execute(sql, params)
+                self._conn.execute("COMMIT")
+            except Exception as e:
+                error = e
+                logger.error(f"❌ Ошибка записи в {self.name} ({len(batch)} операций): {str(e)}")
+                if self._conn.in_transaction:
+                    self._conn.execute("ROLLBACK")
+
+            for _, _, future in batch:
+                if future is None:
+                    continue
+                if error:
+                    future.set_exception(error)
+                else:
+                    future.set_result(None)
+
+
+class Outbox(SQLiteWriter):
+    """
+    Постоянная очередь задач асинхронного режима.
+    Задача записывается до отправки и удаляется после ответа Telegram.
+    В том же файле хранятся таймеры отложенных действий (таблица timers, см. Scheduler).
+    - Каждая задача и каждый таймер помечены процессом-владельцем (PROCESS_ID).
+    - Пока процесс жив, он держит блокировку на файле-метке <outbox>.<PROCESS_ID>.owner;
+      блокировку снимает ядро, когда процесс завершается (в том числе аварийно).
+    """
+
+    schema = (
+        "CREATE TABLE IF NOT EXISTS outbox ("
+        "job_id TEXT PRIMARY KEY, kind TEXT, chat_id, thread_id, text TEXT, created_at REAL, owner TEXT, parts TEXT, lane TEXT, "
+        "delete_after REAL, bot_id TEXT);"
+        "CREATE TABLE IF NOT EXISTS timers ("
+        "timer_id TEXT PRIMARY KEY, action TEXT, fire_at REAL, chat_id, thread_id, payload TEXT, owner TEXT)"
+    )
+    name = "outbox"
+
+    def __init__(self, path):
+        super().__init__(path)
+        self._owner_fd = self._lock_owner(PROCESS_ID)
+
+    def _migrate(self):
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(outbox)")]
+        for column, column_type in (("owner", "TEXT"), ("parts", "TEXT"), ("lane", "TEXT"), ("delete_after", "REAL"), ("bot_id", "TEXT")):
+            if column not in columns:
+                self._conn.execute(f"ALTER TABLE outbox ADD COLUMN {column} {column_type}")
+
+    def _owner_file(self, owner):
+        return f"{self.path}.{owner}.owner"
+
+    def _lock_owner(self, owner):
+        """
+        Создает и блокирует файл-метку процесса. Файл появляется под своим именем
+        уже заблокированным, поэтому лидер не примет только что запущенный процесс за завершившийся.
+        """
+        if fcntl is None:
+            return None
+        path = self._owner_file(owner)
+        fd = os.open(f"{path}.tmp", os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        os.rename(f"{path}.tmp", path)
+        return fd
+
+    def _owner_alive(self, owner):
+        if owner is None or fcntl is None:
+            return False
+        try:
+            fd = os.open(self._owner_file(owner), os.O_RDWR)
+        except FileNotFoundError:
+            return False
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+        finally:
+            os.close(fd)
+        return False
+
+    def add(self, job):
+        """
+        Записывает задачу. Возвращает Future, который завершается с фиксацией транзакции.
+        Сообщение из одной части хранится в text, из нескольких — еще и списком в parts (JSON).
+        """
+        parts = job["parts"]
+        future = Future()
+        self._write(
+            "INSERT OR REPLACE INTO outbox (job_id, kind, chat_id, thread_id, text, created_at, owner, parts, lane, delete_after, bot_id) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (job["job_id"], job["kind"], job["chat_id"], job["thread_id"], "\n".join(parts), job["created_at"],
+             PROCESS_ID, json.dumps(parts, ensure_ascii=False) if len(parts) > 1 else None, job["lane"],
+             job.get("delete_after"), job.get("bot_id") or None),
+            future
+        )
+        return future
+
+    def add_timer(self, timer):
+        """
+        Записывает таймер. Возвращает Future, который завершается с фиксацией транзакции.
+        Данные действия (части сообщения, message_id для удаления и т. п.) хранятся в payload (JSON).
+        """
+        payload = {key: value for key, value in timer.items() if key not in ("timer_id", "action", "fire_at", "chat_id", "thread_id")}
+        future = Future()
+        self._write(
+            "INSERT OR REPLACE INTO timers (timer_id, action, fire_at, chat_id, thread_id, payload, owner) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (timer["timer_id"], timer["action"], timer["fire_at"], timer["chat_id"], timer["thread_id"],
+             json.dumps(payload, ensure_ascii=False), PROCESS_ID),
+            future
+        )
+        return future
+
+    def remove_timer(self, timer_id):
+        """
+        Удаляет сработавший таймер. Не ждет записи на диск.
+        """
+        self._write("DELETE FROM timers WHERE timer_id = ?", (timer_id,))
+
+    def mark_done(self, job_id):
+        """
+        Отмечает задачу выполненной (удаляет из очереди). Не ждет записи на диск.
+        """
+        self._write("DELETE FROM outbox WHERE job_id = ?", (job_id,))
+
+    def claim_orphaned(self, timeout=5):
+        """
+        Забирает себе незавершенные задачи и таймеры процессов, которых больше нет
+        (прошлый запуск или упавший воркер). Возвращает (задачи в порядке поступления, таймеры).
+        Задачи и таймеры живых процессов не трогает.
+        """
+        owners = {owner for (owner,) in self._read("SELECT DISTINCT owner FROM outbox UNION SELECT DISTINCT owner FROM timers")}
+        # Метки процессов, завершившихся без задач в очереди, тоже подчищаем
+        directory, prefix = os.path.split(os.path.abspath(self.path))
+        owners.update(
+            name[len(prefix) + 1:-len(".owner")]
+            for name in os.listdir(directory)
+            if name.startswith(prefix + ".") and name.endswith(".owner")
+        )
+        orphaned = [owner for owner in owners if owner != PROCESS_ID and not self._owner_alive(owner)]
+        if not orphaned:
+            return [], []
+
+        placeholders = ", ".join("?" * len(orphaned))
+        rows = self._read(
+            "SELECT job_id, kind, chat_id, thread_id, text, created_at, parts, lane, delete_after, bot_id FROM outbox "
+            f"WHERE owner IS NULL OR owner IN ({placeholders}) ORDER BY created_at",
+            orphaned
+        )
+        timer_rows = self._read(
+            "SELECT timer_id, action, fire_at, chat_id, thread_id, payload FROM timers "
+            f"WHERE owner IS NULL OR owner IN ({placeholders})",
+            orphaned
+        )
+        future = Future()
+        self._write(
+            f"UPDATE outbox SET owner = ? WHERE owner IS NULL OR owner IN ({placeholders})",
+            (PROCESS_ID, *orphaned)
+        )
+        self._write(
+            f"UPDATE timers SET owner = ? WHERE owner IS NULL OR owner IN ({placeholders})",
+            (PROCESS_ID, *orphaned),
+            future
+        )
+        future.result(timeout)
+
+        for owner in orphaned:
+            if owner is not None:
+                try:
+                    os.remove(self._owner_file(owner))
+                except FileNotFoundError:
+                    pass
+
+        jobs = [
+            {
+                "job_id": job_id, "kind": kind, "chat_id": chat_id, "thread_id": thread_id,
+                "parts": json.loads(parts) if parts else [text], "created_at": created_at,
+                "lane": lane if lane in _LANE_RANK else "bulk", "delete_after": delete_after, "bot_id": bot_id or "",
+            }
+            for job_id, kind, chat_id, thread_id, text, created_at, parts, lane, delete_after, bot_id in rows
+        ]
+        timers = [
+            {**json.loads(payload), "timer_id": timer_id, "action": action, "fire_at": fire_at, "chat_id": chat_id, "thread_id": thread_id}
+            for timer_id, action, fire_at, chat_id, thread_id, payload in timer_rows
+        ]
+        return jobs, timers
+
+
+outbox = Outbox(OUTBOX_DB) if OUTBOX_DB else None
+
+
+class MessageDB(SQLiteWriter):
+    """
+    Тексты отправленных сообщений на диске (второй уровень после LRU в памяти).
+    """
+
+    schema = (
+        "CREATE TABLE IF NOT EXISTS messages ("
+        "chat_id TEXT, message_id INTEGER, text TEXT, updated_at REAL, PRIMARY KEY (chat_id, message_id))"
+    )
+    name = "messages"
+
+    def put(self, chat_id, message_id, text):
+        self._write("INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?)", (chat_id, message_id, text, time.time()))
+
+    def delete(self, chat_id, message_id):
+        self._write("DELETE FROM messages WHERE chat_id = ? AND message_id = ?", (chat_id, message_id))
+
+    def get(self, chat_id, message_id):
+        rows = self._read("SELECT text FROM messages WHERE chat_id = ? AND message_id = ?", (chat_id, message_id))
+        return rows[0][0] if rows else None
+
+
+class MessageStore:
+    """
+    Тексты сообщений, отправленных или отредактированных через бота, по ключу (chat_id, message_id).
+    Telegram API не умеет возвращать текст сообщения, поэтому /get отвечает отсюда.
+    - В памяти — LRU на MESSAGE_CACHE_SIZE записей.
+    - Если задан MESSAGE_STORE_DB — дополнительно на диске (запись в фоне).
+    """
+
+    def __init__(self, capacity, path=None):
+        self.capacity = capacity
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.disk = MessageDB(path) if path else None
+
+    def _remember(self, key, text):
+        with self.lock:
+            self.cache[key] = text
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.capacity:
+                self.cache.popitem(last=False)
+
+    def put(self, chat_id, message_id, text):
+        key = (str(chat_id), int(message_id))
+        self._remember(key, text)
+        if self.disk:
+            self.disk.put(*key, text)
+
+    def delete(self, chat_id, message_id):
+        key = (str(chat_id), int(message_id))
+        with self.lock:
+            self.cache.pop(key, None)
+        if self.disk:
+            self.disk.delete(*key)
+
+    def get(self, chat_id, message_id):
+        """
+        Возвращает текст сообщения или None, если бот его не отправлял (или он вытеснен).
+        """
+        key = (str(chat_id), int(message_id))
+        with self.lock:
+            text = self.cache.get(key)
+            if text is not None:
+                self.cache.move_to_end(key)
+                return text
+
+        if self.disk:
+            text = self.disk.get(*key)
+            if text is not None:
+                self._remember(key, text)
+        return text
+
+
+message_store = MessageStore(MESSAGE_CACHE_SIZE, MESSAGE_STORE_DB or None)
+
+
+class RenderedTextCache:
+    """
+    Хэши последнего текста, отправленного в каждое сообщение (chat_id, message_id).
+    Позволяет не вызывать Telegram, если правка ничего не меняет.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.hashes = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _digest(text):
+        return hashlib.blake2b(text.encode(), digest_size=16).digest()
+
+    def remember(self, chat_id, message_id, text):
+        key = (str(chat_id), int(message_id))
+        with self.lock:
+            self.hashes[key] = self._digest(text)
+            self.hashes.move_to_end(key)
+            while len(self.hashes) > self.capacity:
+                self.hashes.popitem(last=False)
+
+    def forget(self, chat_id, message_id):
+        with self.lock:
+            self.hashes.pop((str(chat_id), int(message_id)), None)
+
+    def matches(self, chat_id, message_id, text):
+        with self.lock:
+            return self.hashes.get((str(chat_id), int(message_id))) == self._digest(text)
+
+
+rendered_cache = RenderedTextCache(EDIT_HASH_CACHE_SIZE)
+
+
+class EditDebouncer:
+    """
+    Склеивает частые правки одного сообщения.
+    - Первая правка уходит сразу, следующие — не чаще раза в EDIT_DEBOUNCE_WINDOW.
+    - Пока правка ждет своей очереди, новые запросы только подменяют ее текст
+      и получают общий результат: в Telegram уходит последний текст.
+    - Если текст совпадает с уже отправленным, запрос к Telegram не делается.
+    Работает внутри общего event loop.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self.states = {}
+
+    async def edit(self, chat_id, message_id, text):
+        """
+        Возвращает "edited" или "not_modified".
+        """
+        # Править сообщение может только отправивший его бот
+        key = (current_bot_id.get(), str(chat_id), int(message_id))
+        state = self.states.get(key)
+        if state is not None and state["batch"] is not None:
+            # Правка уже ждет отправки — подменяем текст на последний
+            state["batch"]["text"] = text
+            return await asyncio.shield(state["batch"]["future"])
+
+        # Ничего не ждет и не отправляется, а текст совпадает с отправленным — отвечаем сразу
+        idle = state is None or not state["lock"].locked()
+        if idle and rendered_cache.matches(chat_id, message_id, text):
+            return "not_modified"
+
+        if state is None:
+            state = self.states[key] = {"lock": asyncio.Lock(), "batch": None, "last_sent": 0.0}
+
+        batch = state["batch"] = {"text": text, "future": asyncio.get_running_loop().create_future()}
+        asyncio.ensure_future(self._flush(key, state, batch))
+        return await asyncio.shield(batch["future"])
+
+    async def _flush(self, key, state, batch):
+        delay = state["last_sent"] + self.window - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        async with state["lock"]:
+            if state["batch"] is batch:
+                state["batch"] = None
+            try:
+                result = await self._apply(key, batch["text"])
+                batch["future"].set_result(result)
+            except Exception as e:
+                batch["future"].set_exception(e)
+            state["last_sent"] = time.monotonic()
+
+        # Забываем состояние сообщения, если за окно не пришло новых правок
+        asyncio.get_running_loop().call_later(self.window, self._cleanup, key, state)
+
+    def _cleanup(self, key, state):
+        if (self.states.get(key) is state and state["batch"] is None and not state["lock"].locked()
+                and time.monotonic() - state["last_sent"] >= self.window):
+            del self.states[key]
+
+    async def _apply(self, key, text):
+        _, chat_id, message_id = key
+        if rendered_cache.matches(chat_id, message_id, text):
+            return "not_modified"
+
+        try:
+            await telegram_call(
+                "edit_message_text",
+                chat_id,
+                message_id=message_id,
+                text=text,
+                parse_mode=ParseMode.HTML
+            )
+        except BadRequest as e:
+            # Текст не изменился, а мы об этом не знали (например, после рестарта)
+            if "message is not modified" not in str(e).lower():
+                raise
+            rendered_cache.remember(chat_id, message_id, text)
+            return "not_modified"
+        return "edited"
+
 
-# Настройка логгера
-logging.basicConfig(
-    format="%(asctime)s - %(levelname)s - %(message)s",
-    level=logging.INFO
-)
-logger = logging.getLogger(__name__)
+edit_debouncer = EditDebouncer(EDIT_DEBOUNCE_WINDOW)
 
-# Отключаем детальные HTTP-запросы из логов
-logging.getLogger("httpx").setLevel(logging.WARNING)
 
+class IdempotencyCache:
+    """
+    Результаты запросов с заголовком Idempotency-Key (/post, /log, /edit).
+    - Первый запрос с ключом выполняется, его ответ (message_id или ошибка) хранится IDEMPOTENCY_TTL секунд.
+    - Повтор, пришедший во время отправки, ждет ее результата, а не отправляет второе сообщение.
+    - Повтор после отправки получает сохраненный ответ без обращения к Telegram.
+    - Ответы "попробуйте позже" (429, 503) не сохраняются: повтор выполнит запрос заново.
+    Ключи действуют в пределах маршрута; не больше capacity ключей, старые вытесняются.
+    Работает внутри общего event loop.
+    """
 
-def log_and_notify(level, message, chat_id=None, topic_id=None):
+    MAX_KEY_LENGTH = 255
+    RETRYABLE_STATUSES = (429, 503)
+
+    def __init__(self, capacity, ttl):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.entries = OrderedDict()  # (маршрут, ключ) → {"future", "fingerprint", "expires"}
+
+    @staticmethod
+    def fingerprint(req, data):
+        """
+        Отпечаток запроса: тело и параметры. Тот же ключ с другим запросом — ошибка клиента.
+        """
+        source = json.dumps([data, sorted(req.args.items(multi=True)), is_async_request(req)], sort_keys=True, default=str)
+        return hashlib.blake2b(source.encode(), digest_size=16).digest()
+
+    def _expire(self, now):
+        while self.entries:
+            entry = next(iter(self.entries.values()))
+            if entry["expires"] > now and len(self.entries) <= self.capacity:
+                break
+            self.entries.popitem(last=False)
+
+    async def run(self, scope, key, fingerprint, handler):
+        """
+        Выполняет handler() (корутину api_*) не больше одного раза на ключ и возвращает его результат.
+        Без ключа просто вызывает handler().
+        """
+        if not key:
+            return await handler()
+        if len(key) > self.MAX_KEY_LENGTH:
+            return {"error": f"Idempotency-Key is longer than {self.MAX_KEY_LENGTH} characters"}, 400
+
+        cache_key = (scope, key)
+        while True:
+            self._expire(time.monotonic())
+            entry = self.entries.get(cache_key)
+            if entry is None:
+                break
+            if entry["fingerprint"] != fingerprint:
+                metrics.inc("bot_idempotency_requests_total", (("result", "conflict"),))
+                return {"error": "Idempotency-Key was already used with a different request"}, 422
+
+            metrics.inc("bot_idempotency_requests_total", (("result", "replayed" if entry["future"].done() else "joined"),))
+            try:
+                body, status, *rest = await asyncio.shield(entry["future"])
+            except asyncio.CancelledError:
+                # Первый запрос прервался, не получив ответа — выполняем запрос сами
+                if entry["future"].cancelled():
+                    continue
+                raise
+            headers = dict(rest[0]) if rest else {}
+            headers["Idempotent-Replayed"] = "true"
+            return body, status, headers
+
+        metrics.inc("bot_idempotency_requests_total", (("result", "new"),))
+        future = asyncio.get_running_loop().create_future()
+        # Пока запрос выполняется, запись не устаревает
+        entry = self.entries[cache_key] = {"future": future, "fingerprint": fingerprint, "expires": float("inf")}
+        try:
+            result = await handler()
+        except BaseException:
+            if self.entries.get(cache_key) is entry:
+                del self.entries[cache_key]
+            future.cancel()
+            raise
+
+        if self.entries.get(cache_key) is entry:
+            if result[1] in self.RETRYABLE_STATUSES:
+                del self.entries[cache_key]
+            else:
+                entry["expires"] = time.monotonic() + self.ttl
+                self.entries.move_to_end(cache_key)
+                self._expire(time.monotonic())
+        future.set_result(result)
+        return result
+
+    def __len__(self):
+        return len(self.entries)
+
+
+idempotency_cache = IdempotencyCache(IDEMPOTENCY_CACHE_SIZE, IDEMPOTENCY_TTL)
+
+
+def idempotent(req, data, handler, *args):
     """
-    Логирует сообщение и отправляет его в тот же чат или топик, где произошла ошибка.
-    
-    level: уровень логирования (logging.ERROR, logging.WARNING)
-    message: текст ошибки/предупреждения
-    chat_id: ID чата (если известен)
-    topic_id: ID топика (если известен)
+    Корутина, выполняющая handler(*args) с учетом заголовка Idempotency-Key запроса req (Flask или AsgiRequest).
     """
-    log_type = "error" if level == logging.ERROR else "warning"
+    key = req.headers.get("Idempotency-Key")
+    fingerprint = idempotency_cache.fingerprint(req, data) if key else None
+    return idempotency_cache.run(req.path, key, fingerprint, functools.partial(handler, *args))
 
-    if level == logging.ERROR:
-        logger.error(message)
-    else:
-        logger.warning(message)
 
-    # Если chat_id неизвестен, логируем только в консоль
-    if not chat_id:
-        logger.warning("⚠️ Логирование в Telegram пропущено: chat_id не задан.")
-        return
+# Очередь исходящих сообщений для асинхронного режима (?async=1).
+# HTTP-обработчик только кладет задачу в очередь и сразу отвечает 202,
+# а отправкой в Telegram занимаются воркеры в общем event loop.
+class LaneQueue(asyncio.Queue):
+    """
+    Очередь задач с классами приоритета: get() выдает задачу из высшего класса
+    с учетом старения (см. pick_lane), внутри класса — по порядку поступления.
+    """
 
-    log_label = "🔴 ERROR" if log_type == "error" else "🟡 WARNING"
-    log_message = f"{log_label}\n📝 {message}"
+    def _init(self, maxsize):
+        self._lanes = {lane: deque() for lane in DISPATCH_LANES}  # класс → [(время постановки, задача)]
+
+    def qsize(self):
+        return sum(len(jobs) for jobs in self._lanes.values())
+
+    def empty(self):
+        return not any(self._lanes.values())
+
+    def _put(self, job):
+        self._lanes[job["lane"]].append((time.monotonic(), job))
+
+    def _get(self):
+        now = time.monotonic()
+        lane = pick_lane({lane: jobs[0][0] for lane, jobs in self._lanes.items() if jobs}, now)
+        queued_at, job = self._lanes[lane].popleft()
+        metrics.observe("bot_lane_wait_seconds", now - queued_at, (("lane", lane), ("stage", "outbound_queue")))
+        return job
+
+    def depths(self):
+        return {lane: len(jobs) for lane, jobs in self._lanes.items()}
+
+
+_outbound_queue = LaneQueue(maxsize=OUTBOUND_QUEUE_SIZE)
+_outbound_workers = []
+_jobs = OrderedDict()
+_jobs_lock = threading.Lock()
 
+
+def is_async_request(req):
+    """
+    Проверяет, просит ли клиент асинхронный режим:
+    - параметр запроса ?async=1 (или true/yes),
+    - либо заголовок Prefer: respond-async.
+    req — запрос Flask или AsgiRequest.
+    """
+    if req.args.get("async", "").lower() in ("1", "true", "yes"):
+        return True
+    return "respond-async" in req.headers.get("Prefer", "").lower()
+
+
+def _update_job(job_id, **fields):
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+        if job is not None:
+            job.update(fields)
+
+
+def get_job(job_id):
+    """
+    Возвращает копию состояния задачи или None, если задача неизвестна (или уже вытеснена).
+    """
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+        return dict(job) if job is not None else None
+
+
+async def _park_job(job, delay):
+    await asyncio.sleep(delay)
+    await _outbound_queue.put(job)
+
+
+async def _send_job(job):
+    """
+    Отправляет одну задачу из очереди и записывает результат в реестр задач.
+    Пока Telegram недоступен (предохранитель разомкнут), задача откладывается и возвращается в очередь позже.
+    """
+    current_bot_id.set(job.get("bot_id", ""))
     try:
-        # Получаем текущий event loop
-        loop = asyncio.get_event_loop()
-
-        # Создаем экземпляр бота
-        local_bot = Bot(token=TOKEN)
-
-        # Если event loop уже запущен, используем ensure_future
-        if loop.is_running():
-            if topic_id:
-                # Если topic_id есть, отправляем в топик
-                future = asyncio.ensure_future(local_bot.send_message(
-                    chat_id=chat_id,
-                    message_thread_id=topic_id,
-                    text=log_message,
-                    parse_mode=ParseMode.HTML
-                ))
-            else:
-                # Если topic_id нет, отправляем просто в чат
-                future = asyncio.ensure_future(local_bot.send_message(
-                    chat_id=chat_id,
-                    text=log_message,
-                    parse_mode=ParseMode.HTML
-                ))
-            future.add_done_callback(lambda fut: logger.info(f"✅ Лог ({log_type.upper()}) отправлен в чат {chat_id}"))
+        message_ids = await send_message_parts(
+            job["chat_id"], job["parts"], job["thread_id"], job["lane"], job.setdefault("message_ids", [])
+        )
+        _update_job(job["job_id"], status="sent", message_id=message_ids[0], message_ids=message_ids, finished_at=time.time())
+        logger.info("✅ Задача %s (%s): сообщения %s отправлены в чат %s", job["job_id"], job["kind"], message_ids, job["chat_id"])
+        if job.get("delete_after"):
+            await scheduler.schedule_delete(job["chat_id"], job["thread_id"], message_ids, job["delete_after"])
+    except Exception as e:
+        # Telegram недоступен (или этот сбой разомкнул предохранитель) — задача остается в outbox
+        # и в статусе queued, а в очередь возвращается после паузы
+        if isinstance(e, CircuitOpenError) or CircuitBreaker.is_failure(e) and circuit_breaker.state == CircuitBreaker.OPEN:
+            delay = (e.retry_after if isinstance(e, CircuitOpenError) else circuit_breaker.retry_after()) + random.uniform(0, 1)
+            asyncio.ensure_future(_park_job(job, delay))
+            logger.info(f"⏸ Задача {job['job_id']} отложена на {math.ceil(delay)} с: Telegram недоступен")
+            return
+
+        _update_job(job["job_id"], status="failed", error=str(e), finished_at=time.time())
+        log_and_notify(logging.ERROR, f"❌ Ошибка при отправке задачи {job['job_id']} ({job['kind']}) в чат {job['chat_id']}: {str(e)}", job["chat_id"], job["thread_id"])
+
+    # Ответ Telegram получен (успех или окончательная ошибка) — повторять задачу после рестарта не нужно
+    if outbox:
+        outbox.mark_done(job["job_id"])
+
+
+async def _outbound_worker():
+    while True:
+        job = await _outbound_queue.get()
+        try:
+            await _send_job(job)
+        finally:
+            _outbound_queue.task_done()
+
+
+def _start_outbound_workers():
+    # Воркеры запускаются при первой задаче, уже внутри общего event loop
+    if not _outbound_workers:
+        for _ in range(OUTBOUND_WORKERS):
+            _outbound_workers.append(asyncio.ensure_future(_outbound_worker()))
+
+
+async def _put_job(job):
+    _start_outbound_workers()
+    _outbound_queue.put_nowait(job)
+
+
+def _register_job(job):
+    with _jobs_lock:
+        _jobs[job["job_id"]] = {"status": "queued", "kind": job["kind"], "chat_id": job["chat_id"], "created_at": job["created_at"]}
+        while len(_jobs) > JOB_HISTORY_SIZE:
+            _jobs.popitem(last=False)
+
+
+async def enqueue_message(kind, chat_id, parts, thread_id=None, lane="bulk", delete_after=None):
+    """
+    Ставит сообщение (список частей, см. format_json_as_html_parts) в очередь класса lane
+    (см. DISPATCH_LANES) на отправку и возвращает job_id.
+    delete_after — через сколько секунд после отправки удалить сообщение (см. Scheduler).
+    Если очередь переполнена, возвращает None — вызывающий отвечает 503.
+    """
+    job = {
+        "job_id": uuid.uuid4().hex,
+        "kind": kind,
+        "chat_id": chat_id,
+        "thread_id": thread_id,
+        "parts": parts,
+        "lane": lane,
+        "delete_after": delete_after,
+        "bot_id": current_bot_id.get(),
+        "created_at": time.time(),
+    }
+    _register_job(job)
+
+    # Сначала фиксируем задачу на диске, чтобы она пережила рестарт
+    if outbox:
+        try:
+            await asyncio.wait_for(asyncio.wrap_future(outbox.add(job)), 5)
+        except Exception as e:
+            # Диск недоступен — не теряем запрос, а отправляем без сохранения
+            logger.error(f"❌ Не удалось сохранить задачу {job['job_id']} в outbox: {str(e)}")
+
+    try:
+        await _put_job(job)
+    except asyncio.QueueFull:
+        with _jobs_lock:
+            _jobs.pop(job["job_id"], None)
+        if outbox:
+            outbox.mark_done(job["job_id"])
+        logger.warning(f"⚠️ Очередь исходящих сообщений переполнена ({OUTBOUND_QUEUE_SIZE}), задача для чата {chat_id} отклонена")
+        return None
+
+    return job["job_id"]
+
+
+class Scheduler:
+    """
+    Отложенные действия: отправка в момент send_at и удаление сообщения через delete_after секунд.
+    - Таймеры лежат в min-куче по времени срабатывания: добавление и извлечение — O(log n),
+      отдельных потоков и задач asyncio на каждый таймер нет.
+    - В общем event loop бота взведен один call_at — на ближайший таймер кучи.
+    - Таймеры сохраняются в outbox (таблица timers) и после рестарта восстанавливаются лидером
+      вместе с задачами (см. replay_outbox); просроченные за время простоя срабатывают сразу.
+    - Сработавший таймер идет обычным путем: отправка — через очередь асинхронного режима
+      (лимиты, приоритеты, outbox), удаление — через telegram_call.
+    Все методы, кроме счетчиков для метрик, вызываются только из общего event loop.
+    """
+
+    ACTIONS = ("post", "delete")
+
+    def __init__(self):
+        self.heap = []  # (время срабатывания, порядковый номер, timer_id)
+        self.timers = {}
+        self.counts = dict.fromkeys(self.ACTIONS, 0)
+        self.seq = 0
+        self.handle = None
+        self.handle_at = None
+
+    def __len__(self):
+        return len(self.timers)
+
+    def _push(self, timer):
+        if timer["timer_id"] not in self.timers:
+            self.counts[timer["action"]] += 1
+        self.timers[timer["timer_id"]] = timer
+        self.seq += 1
+        heapq.heappush(self.heap, (timer["fire_at"], self.seq, timer["timer_id"]))
+        self._arm()
+
+    def _arm(self):
+        """
+        Перевзводит call_at, если ближайший таймер раньше уже взведенного.
+        Время в куче — по часам системы (переживает рестарт), call_at — по монотонным часам loop.
+        """
+        if not self.heap:
+            return
+        fire_at = self.heap[0][0]
+        if self.handle is not None:
+            if self.handle_at <= fire_at:
+                return
+            self.handle.cancel()
+        loop = asyncio.get_running_loop()
+        self.handle_at = fire_at
+        self.handle = loop.call_at(loop.time() + max(0.0, fire_at - time.time()), self._fire)
+
+    def _fire(self):
+        self.handle = None
+        now = time.time()
+        while self.heap and self.heap[0][0] <= now:
+            _, _, timer_id = heapq.heappop(self.heap)
+            timer = self.timers.pop(timer_id, None)
+            if timer is not None:
+                self.counts[timer["action"]] -= 1
+                asyncio.ensure_future(self._run(timer))
+        self._arm()
+
+    async def add(self, action, fire_at, chat_id, thread_id=None, **payload):
+        """
+        Создает таймер, фиксирует его на диске и ставит в кучу. Возвращает timer_id
+        или None, если ожидающих таймеров уже SCHEDULE_MAX_TIMERS.
+        """
+        if len(self.timers) >= SCHEDULE_MAX_TIMERS:
+            logger.warning(f"⚠️ Слишком много отложенных действий ({SCHEDULE_MAX_TIMERS}), действие {action} для чата {chat_id} отклонено")
+            return None
+
+        timer = {
+            "timer_id": uuid.uuid4().hex, "action": action, "fire_at": fire_at, "chat_id": chat_id, "thread_id": thread_id,
+            "bot_id": current_bot_id.get(), **payload,
+        }
+        if outbox:
+            try:
+                await asyncio.wait_for(asyncio.wrap_future(outbox.add_timer(timer)), 5)
+            except Exception as e:
+                # Диск недоступен — таймер сработает, но рестарт не переживет
+                logger.error(f"❌ Не удалось сохранить таймер {timer['timer_id']} в outbox: {str(e)}")
+        self._push(timer)
+        return timer["timer_id"]
+
+    async def schedule_delete(self, chat_id, thread_id, message_ids, delete_after):
+        timer_id = await self.add("delete", time.time() + delete_after, chat_id, thread_id, message_ids=message_ids)
+        if timer_id is None:
+            logger.warning(f"⚠️ Сообщения {message_ids} в чате {chat_id} не будут удалены автоматически")
+        return timer_id
+
+    def restore(self, timers):
+        for timer in timers:
+            if timer["action"] in self.ACTIONS:
+                self._push(timer)
+
+    async def _run(self, timer):
+        current_bot_id.set(timer.get("bot_id", ""))
+        try:
+            done = await (self._post(timer) if timer["action"] == "post" else self._delete(timer))
+        except Exception as e:
+            logger.error(f"❌ Ошибка отложенного действия {timer['action']} {timer['timer_id']} (чат {timer['chat_id']}): {str(e)}")
+            done = True
+
+        if done:
+            if outbox:
+                outbox.remove_timer(timer["timer_id"])
         else:
-            # Если event loop не работает, используем run_until_complete
-            if topic_id:
-                loop.run_until_complete(local_bot.send_message(
-                    chat_id=chat_id,
-                    message_thread_id=topic_id,
-                    text=log_message,
-                    parse_mode=ParseMode.HTML
-                ))
+            timer["fire_at"] = time.time() + SCHEDULE_RETRY_DELAY + random.uniform(0, 1)
+            self._push(timer)
+
+    async def _post(self, timer):
+        job_id = await enqueue_message(
+            "post", timer["chat_id"], timer["parts"], timer["thread_id"], timer.get("lane", "bulk"), timer.get("delete_after")
+        )
+        if job_id is None:
+            logger.warning(f"⚠️ Отложенная отправка {timer['timer_id']}: очередь переполнена, повтор через {SCHEDULE_RETRY_DELAY:g} с")
+            return False
+        logger.info("⏰ Отложенная отправка %s: сообщение для чата %s поставлено в очередь (задача %s)", timer["timer_id"], timer["chat_id"], job_id)
+        return True
+
+    async def _delete(self, timer):
+        results = [await _delete_one(timer["chat_id"], message_id) for message_id in timer["message_ids"]]
+        # Лимит или недоступность Telegram — повторяем позже только неудаленные сообщения
+        retry = [result["message_id"] for result in results if result["status"] in ("rate_limited", "unavailable")]
+        if retry:
+            timer["message_ids"] = retry
+            logger.info(f"⏸ Автоудаление сообщений {retry} в чате {timer['chat_id']} отложено: Telegram не принял запрос")
+            return False
+        for result in results:
+            if result["status"] == "deleted":
+                logger.info("🗑 Сообщение %s в чате %s удалено по таймеру", result["message_id"], timer["chat_id"])
+            elif result["status"] == "not_found":
+                logger.info("🗑 Сообщение %s в чате %s уже удалено", result["message_id"], timer["chat_id"])
             else:
-                loop.run_until_complete(local_bot.send_message(
-                    chat_id=chat_id,
-                    text=log_message,
-                    parse_mode=ParseMode.HTML
-                ))
+                logger.warning(f"⚠️ Не удалось удалить сообщение {result['message_id']} в чате {timer['chat_id']} по таймеру: {result.get('error')}")
+        return True
 
-    except Exception as e:
-        logger.error(f"❌ Ошибка при отправке лога ({log_type.upper()}) в Telegram: {str(e)}")
+
+scheduler = Scheduler()
+
+
+async def _replay_jobs(jobs):
+    _start_outbound_workers()
+    for job in jobs:
+        await _outbound_queue.put(job)
 
 
+async def _restore_timers(timers):
+    scheduler.restore(timers)
 
-def format_json_as_html(data):
+
+def replay_outbox():
     """
-    Преобразует JSON в HTML-формат для Telegram.
-    Убирает пустые строки, None и форматирует вложенные структуры.
+    Ставит в очередь задачи, не отправленные до рестарта процесса или завершившимися воркерами,
+    и возвращает в планировщик их отложенные действия.
+    Вызывается при старте (при нескольких процессах — лидером, см. start_worker).
     """
-    if not data:
-        logger.info("⚠️ Пустой JSON передан в format_json_as_html()")
-        return ""
+    if not outbox:
+        return
 
-    if "text" in data and isinstance(data["text"], str) and data["text"].strip():
-        logger.info(f"📝 Форматируем текстовое сообщение: {len(data['text'])} символов")
-        return data["text"].strip()
+    jobs, timers = outbox.claim_orphaned()
+    if timers:
+        asyncio.run_coroutine_threadsafe(_restore_timers(timers), get_bot_loop())
+        logger.info(f"🔁 Из outbox восстановлено {len(timers)} отложенных действий")
+    if not jobs:
+        return
 
-    formatted_text = ""
-    
-    # Рекурсивная обработка вложенных структур
-    def process_value(key, value, depth=0):
-        indent = "  " * depth  # Отступы для читаемости
-        
-        if value is None or value == "":
-            return ""  # Пропускаем пустые значения
-        
-        if isinstance(value, dict):
-            sub_text = f"<b>{key}:</b>\n"
-            for sub_key, sub_value in value.items():
-                processed = process_value(sub_key, sub_value, depth + 1)
-                if processed:
-                    sub_text += f"{indent}  <i>{sub_key}:</i> {processed}\n"
-            return sub_text.strip()
-
-        elif isinstance(value, list):
-            list_items = [str(item).strip() for item in value if item]  # Убираем пустые
-            return f"<b>{key}:</b> " + ", ".join(list_items)
+    for job in jobs:
+        _register_job(job)
+    # Очередь ограничена, поэтому дозаполняем ее в фоне, не блокируя старт
+    asyncio.run_coroutine_threadsafe(_replay_jobs(jobs), get_bot_loop())
+    logger.info(f"🔁 Из outbox восстановлено {len(jobs)} неотправленных задач")
 
-        else:
-            return f"<b>{key}:</b> {str(value).strip()}"
 
-    for key, value in data.items():
-        processed = process_value(key, value)
-        if processed:
-            formatted_text += processed + "\n"
+def accepted_response(job_id):
+    """
+    Ответ 202 для асинхронного режима (или 503, если задачу не удалось поставить в очередь).
+    """
+    if job_id is None:
+        return {"error": "Outbound queue is full"}, 503
+    return {"success": "Message accepted", "job_id": job_id, "status_url": f"/status/{job_id}"}, 202
 
-    formatted_text = formatted_text.strip()
 
-    if not formatted_text:
-        logger.info("⚠️ JSON содержит только пустые значения!")
-        return ""
+def scheduled_response(timer_id, fire_at):
+    """
+    Ответ 202 для отложенной отправки (или 503, если таймеров слишком много).
+    """
+    if timer_id is None:
+        return {"error": "Too many scheduled actions"}, 503
+    return {"success": "Message scheduled", "timer_id": timer_id, "send_at": fire_at}, 202
 
-    logger.info(f"✅ JSON успешно преобразован в HTML, длина: {len(formatted_text)} символов")
-    return formatted_text
 
-def encode_params(chat_id, topic_id=None):
+def parse_send_at(value):
     """
-    Кодирует chat_id и topic_id в Base64.
-    - Если topic_id указан, кодируем chat_id + topic_id (для отправки сообщений в топик).
-    - Если topic_id НЕ указан, кодируем ТОЛЬКО chat_id (для редактирования, удаления, получения текста).
+    Время отложенной отправки: unix-время в секундах или ISO 8601 (без часового пояса — UTC).
+    Не дальше SEND_AT_MAX секунд от текущего момента: миллисекунды вместо секунд (Date.now() в JS),
+    inf и nan отклоняются, а не превращаются в таймер, который никогда не сработает.
     """
     try:
-        # Преобразуем chat_id и topic_id в строки (на случай, если они int)
-        chat_id = str(chat_id).strip()
-        topic_id = str(topic_id).strip() if topic_id is not None else None
+        fire_at = float(value)
+    except ValueError:
+        try:
+            moment = datetime.fromisoformat(value.replace("Z", "+00:00"))
+        except ValueError:
+            raise ValueError("send_at must be a unix timestamp or an ISO 8601 date")
+        if moment.tzinfo is None:
+            moment = moment.replace(tzinfo=timezone.utc)
+        fire_at = moment.timestamp()
+    if not math.isfinite(fire_at) or fire_at > time.time() + SEND_AT_MAX:
+        raise ValueError(f"send_at must be a unix timestamp in seconds at most {SEND_AT_MAX:g} seconds ahead")
+    return fire_at
 
-        # Проверяем, является ли chat_id корректным числом
-        if not chat_id.lstrip("-").isdigit():
-            raise ValueError(f"Некорректный chat_id: {chat_id}")
 
-        # Создаем строку для кодирования
-        raw_string = f"{chat_id}:{topic_id}" if topic_id else chat_id
-        encoded_string = base64.urlsafe_b64encode(raw_string.encode()).decode()
+def parse_delete_after(value):
+    """
+    Задержка автоудаления в секундах: больше нуля и не больше DELETE_AFTER_MAX.
+    """
+    try:
+        seconds = float(value)
+    except ValueError:
+        raise ValueError("delete_after must be a number of seconds")
+    if not 0 < seconds <= DELETE_AFTER_MAX:
+        raise ValueError(f"delete_after must be between 0 and {DELETE_AFTER_MAX:g} seconds")
+    return seconds
 
-        logger.info(f"✅ Кодировано: chat_id={chat_id}, topic_id={topic_id if topic_id else 'None'} → {encoded_string}")
-        return encoded_string
 
-    except Exception as e:
-        error_message = f"❌ Ошибка кодирования: chat_id={chat_id}, topic_id={topic_id if topic_id else 'None'} → {str(e)}"
-        log_and_notify(logging.ERROR, error_message, chat_id, topic_id)
+def topic_to_thread_id(topic_id):
+    """
+    Преобразует topic_id из закодированных параметров в message_thread_id.
+    - Нет topic_id или "general" → None (отправка в General).
+    - Число → int.
+    - Иначе ValueError.
+    """
+    if not topic_id or topic_id.lower() == "general":
         return None
+    if not topic_id.isdigit():
+        raise ValueError(f"Некорректный topic_id: {topic_id}")
+    return int(topic_id)
 
 
-def decode_params(encoded_string):
+def retry_after_response(e):
     """
-    Декодирует Base64 в chat_id и topic_id.
-    - Если код содержит ДВА параметра (chat_id:topic_id), то возвращает оба.
-    - Если ОДИН параметр (chat_id), значит, topic_id не передавался.
-    - В случае ошибки логирует проблему и возвращает (None, None).
+    Ответ 429, если Telegram продолжает требовать паузу после всех повторов.
     """
-    if not encoded_string:
-        log_and_notify(logging.WARNING, "⚠️ Пустая строка передана в decode_params()", chat_id, topic_id)
-        return None, None
+    return {"error": "Too Many Requests", "retry_after": e.retry_after}, 429, {"Retry-After": str(int(e.retry_after))}
+
+
+def circuit_open_response(e):
+    """
+    Ответ 503, пока предохранитель вызовов Telegram разомкнут: запрос отклонен сразу, без обращения к Telegram.
+    """
+    retry_after = math.ceil(e.retry_after)
+    return {"error": "Telegram API is unavailable", "retry_after": retry_after}, 503, {"Retry-After": str(retry_after)}
+
+
+def flask_response(result):
+    """
+    Превращает результат обработчика API — (тело, код) или (тело, код, заголовки) — в ответ Flask.
+    """
+    body, *rest = result
+    return (jsonify(body), *rest)
+
+
+class AdmissionGate:
+    """
+    Ограничение одновременных HTTP-запросов одного класса маршрутов.
+    - Не больше limit запросов выполняются одновременно.
+    - Еще не больше queue_size ждут освобождения места, каждый не дольше timeout секунд.
+    - Остальные сразу получают отказ (429): память и время ответа не растут вместе с нагрузкой.
+    Потоки Flask ждут на threading.Condition, корутины ASGI — на future в своем event loop;
+    освободившееся место сначала передается ждущим корутинам.
+    """
+
+    def __init__(self, route_class, limit, queue_size, timeout):
+        self.route_class = route_class
+        self.limit = limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.active = 0
+        self.waiting = 0  # ждущие потоки
+        self.async_waiters = deque()  # (event loop, future) ждущих корутин
+        self.cond = threading.Condition()
+
+    def _reject(self, reason):
+        metrics.inc("bot_admission_rejected_total", (("route_class", self.route_class), ("reason", reason)))
+        return False
+
+    def enter(self):
+        """
+        Занимает место для запроса потока Flask. Возвращает False, если запрос нужно отклонить.
+        """
+        with self.cond:
+            if self.active < self.limit and not self.waiting and not self.async_waiters:
+                self.active += 1
+                return True
+            if self.waiting + len(self.async_waiters) >= self.queue_size:
+                return self._reject("queue_full")
+            self.waiting += 1
+            admitted = self.cond.wait_for(lambda: self.active < self.limit, self.timeout)
+            self.waiting -= 1
+            if not admitted:
+                return self._reject("timeout")
+            self.active += 1
+            return True
+
+    async def enter_async(self):
+        """
+        То же для корутины ASGI-обработчика.
+        """
+        with self.cond:
+            if self.active < self.limit and not self.waiting and not self.async_waiters:
+                self.active += 1
+                return True
+            if self.waiting + len(self.async_waiters) >= self.queue_size:
+                return self._reject("queue_full")
+            loop = asyncio.get_running_loop()
+            waiter = (loop, loop.create_future())
+            self.async_waiters.append(waiter)
+
+        try:
+            await asyncio.wait_for(waiter[1], self.timeout)
+            return True
+        except asyncio.TimeoutError:
+            with self.cond:
+                if waiter in self.async_waiters:
+                    self.async_waiters.remove(waiter)
+            return self._reject("timeout")
+
+    def leave(self):
+        with self.cond:
+            if self.async_waiters:
+                # Место переходит ждущей корутине, счетчик active не меняется
+                loop, future = self.async_waiters.popleft()
+                loop.call_soon_threadsafe(self._wake, future)
+                return
+            self.active -= 1
+            self.cond.notify()
+
+    def _wake(self, future):
+        if future.done():
+            # Корутина перестала ждать (таймаут), пока место передавалось ей
+            self.leave()
+        else:
+            future.set_result(None)
+
+
+# Классы маршрутов с ограничением одновременных запросов; остальные маршруты (/status, /metrics, ...) не ограничены
+ADMISSION_ROUTES = {
+    "/post/<encoded_params>": "send",
+    "/post_batch": "send",
+    "/log/<log_type>/<encoded_chat>": "send",
+    "/edit/<encoded_params>/<message_id>": "manage",
+    "/delete/<encoded_params>/<message_id>": "manage",
+    "/delete_batch/<encoded_params>": "manage",
+    "/get/<encoded_params>/<message_id>": "manage",
+}
+admission_gates = {
+    "send": AdmissionGate("send", ADMISSION_SEND_LIMIT, ADMISSION_QUEUE_SIZE, ADMISSION_QUEUE_TIMEOUT),
+    "manage": AdmissionGate("manage", ADMISSION_MANAGE_LIMIT, ADMISSION_QUEUE_SIZE, ADMISSION_QUEUE_TIMEOUT),
+}
+
+
+def too_large_response(route):
+    metrics.inc("bot_admission_rejected_total", (("route_class", ADMISSION_ROUTES.get(route, "other")), ("reason", "too_large")))
+    logger.warning(f"⚠️ Запрос к {route} отклонен: тело больше {MAX_CONTENT_LENGTH} байт")
+    return {"error": f"Request body is larger than {MAX_CONTENT_LENGTH} bytes"}, 413
+
+
+def overloaded_response(gate):
+    """
+    Ответ 429, если все места и очередь класса маршрутов заняты.
+    """
+    retry_after = max(1, math.ceil(gate.timeout))
+    return {"error": "Too Many Requests", "retry_after": retry_after}, 429, {"Retry-After": str(retry_after)}
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.before_request
+def admit_request():
+    """
+    Отклоняет слишком большие запросы до чтения тела и ограничивает число одновременных запросов
+    (см. AdmissionGate). Место освобождается в release_admission.
+    """
+    route = request.url_rule.rule if request.url_rule else None
+
+    environ = request.environ
+    if not environ.get("CONTENT_LENGTH") and environ.get("wsgi.input_terminated"):
+        # Тело без Content-Length (chunked) Werkzeug читает без ограничения — читаем не больше лимита сами
+        chunks, size = [], 0
+        while size <= MAX_CONTENT_LENGTH:
+            chunk = environ["wsgi.input"].read(MAX_CONTENT_LENGTH + 1 - size)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            size += len(chunk)
+        if size > MAX_CONTENT_LENGTH:
+            return flask_response(too_large_response(route))
+        environ.pop("wsgi.input_terminated")
+        environ.pop("HTTP_TRANSFER_ENCODING", None)
+        environ.update({"wsgi.input": io.BytesIO(b"".join(chunks)), "CONTENT_LENGTH": str(size)})
+
+    if (request.content_length or 0) > MAX_CONTENT_LENGTH:
+        return flask_response(too_large_response(route))
+
+    gate = admission_gates.get(ADMISSION_ROUTES.get(route))
+    if gate is None:
+        return None
+    if not gate.enter():
+        return flask_response(overloaded_response(gate))
+    g.admission_gate = gate
+    return None
+
+
+@app.teardown_request
+def release_admission(exc):
+    gate = g.pop("admission_gate", None)
+    if gate is not None:
+        gate.leave()
 
+
+@app.errorhandler(RequestEntityTooLarge)
+def request_too_large(e):
+    return flask_response(too_large_response(request.url_rule.rule if request.url_rule else None))
+
+
+@app.after_request
+def record_request_metrics(response):
+    """
+    Учитывает каждый HTTP-запрос в /metrics: счетчик по коду ответа, время и размер тела.
+    В метку идет шаблон маршрута, а не URL, чтобы закодированные параметры не плодили метки.
+    """
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    metrics.inc("bot_http_requests_total", (("route", route), ("method", request.method), ("status", response.status_code)))
+    if "request_started" in g:
+        metrics.observe("bot_http_request_duration_seconds", time.perf_counter() - g.request_started, (("route", route),))
+    metrics.observe("bot_http_request_size_bytes", request.content_length or 0, (("route", route),))
+    return response
+
+
+def _collect_queue_metrics():
+    with notifier.lock:
+        stats = dict(notifier.stats)
+        pending = notifier.pending
+    samples = [
+        ("bot_outbound_queue_depth", (), _outbound_queue.qsize()),
+        *(("bot_lane_depth", (("lane", lane), ("stage", "outbound_queue")), depth) for lane, depth in _outbound_queue.depths().items()),
+        ("bot_notify_queue_depth", (), pending),
+        ("bot_idempotency_keys", (), len(idempotency_cache)),
+        *(("bot_scheduled_timers", (("action", action),), count) for action, count in scheduler.counts.items()),
+        ("bot_log_records_dropped_total", (("reason", "sampled"),), log_sampler.dropped),
+        ("bot_log_records_dropped_total", (("reason", "queue_full"),), log_background.dropped if log_background else 0),
+        *(("bot_admission_active", (("route_class", name),), gate.active) for name, gate in admission_gates.items()),
+        *(("bot_admission_waiting", (("route_class", name),), gate.waiting + len(gate.async_waiters)) for name, gate in admission_gates.items()),
+    ]
+    samples.extend(("bot_notifications_total", (("result", result),), value) for result, value in stats.items())
+    return samples
+
+
+metrics.add_collector(_collect_queue_metrics)
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """
+    Отдает метрики в текстовом формате Prometheus.
+    """
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+async def api_post(encoded_params, data, async_mode=False, template=None, send_at=None, delete_after=None):
+    """
+    Отправляет сообщение в указанный чат или топик.
+    send_at — когда отправить (см. parse_send_at), delete_after — через сколько секунд удалить (см. Scheduler).
+    Общий обработчик для Flask и ASGI: возвращает (тело, код[, заголовки]).
+    """
+    # Декодируем бота, chat_id и topic_id
+    chat_id, topic_id = use_target(encoded_params)
+    if not chat_id:
+        log_and_notify(logging.WARNING, f"⚠️ Ошибка декодирования: некорректные параметры ({encoded_params})", chat_id, topic_id)
+        return {"error": "Invalid parameters"}, 400
+
+    if not data:
+        log_and_notify(logging.WARNING, f"⚠️ Ошибка отправки: пустой JSON (chat_id={chat_id})", chat_id, topic_id)
+        return {"error": "Invalid JSON"}, 400
+
+    # Длинный текст делится на несколько сообщений по лимиту Telegram
+    parts = format_json_as_html_parts(data, template=template)
+    if not parts:
+        log_and_notify(logging.WARNING, f"⚠️ Ошибка отправки: в JSON нет данных для сообщения (chat_id={chat_id})", chat_id, topic_id)
+        return {"error": "Message is empty"}, 400
+
+    # Определяем, куда отправлять (General или топик)
     try:
-        # Проверяем, является ли строка корректным Base64
-        padded_encoded = encoded_string + "=" * (-len(encoded_string) % 4)  # Делаем длину кратной 4
-        decoded = base64.urlsafe_b64decode(padded_encoded).decode().strip()
+        thread_id = topic_to_thread_id(topic_id)
+    except ValueError:
+        log_and_notify(logging.WARNING, f"⚠️ Некорректный topic_id '{topic_id}' (chat_id={chat_id})", chat_id, topic_id)
+        return {"error": "Invalid topic_id"}, 400
 
-        if ":" in decoded:
-            chat_id, topic_id = decoded.split(":", 1)  # Ограничиваем split на 2 части
+    try:
+        fire_at = parse_send_at(send_at) if send_at else None
+        delete_after = parse_delete_after(delete_after) if delete_after else None
+    except ValueError as e:
+        log_and_notify(logging.WARNING, f"⚠️ Ошибка отправки: {str(e)} (chat_id={chat_id})", chat_id, topic_id)
+        return {"error": str(e)}, 400
+
+    # Отложенная отправка: таймер сработает в send_at (время в прошлом — отправляем сразу)
+    if fire_at is not None and fire_at > time.time():
+        fire_at_iso = datetime.fromtimestamp(fire_at, timezone.utc).isoformat()
+        timer_id = await scheduler.add("post", fire_at, chat_id, thread_id, parts=parts, lane="bulk", delete_after=delete_after)
+        if timer_id is not None:
+            logger.info("⏰ Сообщение для чата %s запланировано на %s (таймер %s)", chat_id, fire_at_iso, timer_id)
+        return scheduled_response(timer_id, fire_at)
+
+    # Асинхронный режим: ставим в очередь и сразу отвечаем 202
+    if async_mode:
+        return accepted_response(await enqueue_message("post", chat_id, parts, thread_id, delete_after=delete_after))
+
+    try:
+        message_ids = await send_message_parts(chat_id, parts, thread_id)
+        if thread_id is None:
+            logger.info("✅ Сообщения %s отправлены в General-чат %s", message_ids, chat_id)
         else:
-            chat_id, topic_id = decoded, None  # Если topic_id нет
+            logger.info("✅ Сообщения %s отправлены в топик %s (чат %s)", message_ids, thread_id, chat_id)
 
-        # Проверяем, является ли chat_id корректным числом (Telegram chat_id всегда число)
-        if not chat_id.lstrip("-").isdigit():
-            raise ValueError(f"Некорректный chat_id: {chat_id}")
+        response = {
+            "success": "Message sent",
+            "message_id": message_ids[0],
+            "message_ids": message_ids,
+            "chat_id": chat_id,
+            "thread_id": thread_id if thread_id else None
+        }
+        if delete_after and await scheduler.schedule_delete(chat_id, thread_id, message_ids, delete_after):
+            response["delete_at"] = time.time() + delete_after
+        return response, 200
 
-        logger.info(f"✅ Декодирован chat_id={chat_id}, topic_id={topic_id if topic_id else 'None'}")
-        return chat_id, topic_id
+    except RetryAfter as e:
+        logger.warning(f"⚠️ Лимит Telegram исчерпан для чата {chat_id}, повтор через {e.retry_after} с")
+        return retry_after_response(e)
 
-    except Exception as e:
-        error_message = f"❌ Ошибка декодирования Base64 ({encoded_string}): {str(e)}"
-        log_and_notify(logging.ERROR, error_message, chat_id, topic_id)
-        return None, None
+    except CircuitOpenError as e:
+        logger.warning(f"⚠️ Telegram недоступен, запрос для чата {chat_id} отклонен: {str(e)}")
+        return circuit_open_response(e)
 
+    except Exception as e:
+        log_and_notify(logging.ERROR, f"❌ Ошибка при отправке сообщения в чат {chat_id}: {str(e)}", chat_id, topic_id)
+        return {"error": str(e)}, 500
 
 
 @app.route('/post/<encoded_params>', methods=['POST'])
@@ -220,282 +3095,574 @@ def post_to_chat(encoded_params):
     """
     Отправляет сообщение в указанный чат или топик.
     """
-    # Игнорируем GET-запросы
-    if request.method == "GET":
-        logger.info(f"⚠️ Игнорируем GET-запрос на /post/{encoded_params}")
-        return jsonify({"error": "Method Not Allowed"}), 405
-    
-    # Декодируем chat_id и topic_id
-    chat_id, topic_id = decode_params(encoded_params)
-    if not chat_id:
-        log_and_notify(logging.WARNING, f"⚠️ Ошибка декодирования: некорректные параметры ({encoded_params})", chat_id, topic_id)
-        return jsonify({"error": "Invalid parameters"}), 400
+    data = request.get_json(silent=True)
+    return flask_response(run_in_bot_loop(idempotent(
+        request, data, api_post, encoded_params, data, is_async_request(request), request.args.get("template"),
+        request.args.get("send_at"), request.args.get("delete_after")
+    )))
+
+
+async def _send_batch(groups, results):
+    """
+    Отправляет сообщения пакета: чаты/топики обслуживаются параллельно
+    (не больше BATCH_CONCURRENCY одновременно), внутри одного чата/топика — строго по порядку.
+    """
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    async def send_group(bot_id, chat_id, thread_id, items):
+        # Группа выполняется в своей задаче, поэтому бот выставляется только для нее
+        current_bot_id.set(bot_id)
+        async with semaphore:
+            for index, text in items:
+                try:
+                    sent_message = await telegram_call(
+                        "send_message",
+                        chat_id,
+                        text=text,
+                        parse_mode=ParseMode.HTML,
+                        message_thread_id=thread_id
+                    )
+                    results[index] = {"index": index, "message_id": sent_message.message_id, "chat_id": chat_id, "thread_id": thread_id}
+                except Exception as e:
+                    results[index] = {"index": index, "error": str(e), "chat_id": chat_id, "thread_id": thread_id}
+
+    await asyncio.gather(*(
+        send_group(bot_id, chat_id, thread_id, items) for (bot_id, chat_id, thread_id), items in groups.items()
+    ))
+
+
+async def api_post_batch(data):
+    """
+    Отправляет много сообщений одним HTTP-запросом.
+    Тело: список (или {"items": [...]}) элементов {"target": <encoded_params>, "payload": {...}}.
+    - Каждый target декодируется один раз.
+    - Сообщения в один чат/топик уходят в порядке следования в запросе.
+    - Возвращает результат по каждому элементу (message_id или error).
+    """
+    items = data.get("items") if isinstance(data, dict) else data
+    if not isinstance(items, list) or not items:
+        logger.warning("⚠️ Ошибка пакетной отправки: ожидается непустой список сообщений")
+        return {"error": "Invalid JSON, list of items is required"}, 400
+
+    if len(items) > BATCH_MAX_ITEMS:
+        logger.warning(f"⚠️ Слишком большой пакет: {len(items)} сообщений (максимум {BATCH_MAX_ITEMS})")
+        return {"error": f"Too many items, maximum is {BATCH_MAX_ITEMS}"}, 413
+
+    results = [None] * len(items)
+    targets = {}  # encoded_params → (bot_id, chat_id, thread_id) или None, если target некорректный
+    groups = OrderedDict()  # (bot_id, chat_id, thread_id) → [(index, text), ...]
 
-    # Получаем JSON-данные
-    data = request.get_json()
-    if not data:
-        log_and_notify(logging.WARNING, f"⚠️ Ошибка отправки: пустой JSON (chat_id={chat_id})", chat_id, topic_id)
-        return jsonify({"error": "Invalid JSON"}), 400
+    for index, item in enumerate(items):
+        target = item.get("target") if isinstance(item, dict) else None
+        payload = item.get("payload") if isinstance(item, dict) else None
 
-    message = format_json_as_html(data)
+        if not isinstance(target, str):
+            results[index] = {"index": index, "error": "Invalid item, 'target' is required"}
+            continue
 
-    # Определяем, куда отправлять (General или топик)
-    thread_id = None
-    if topic_id and topic_id.lower() != "general":
-        if topic_id.isdigit():
-            thread_id = int(topic_id)
-        else:
-            log_and_notify(logging.WARNING, f"⚠️ Некорректный topic_id '{topic_id}' (chat_id={chat_id})", chat_id, topic_id)
-            return jsonify({"error": "Invalid topic_id"}), 400
+        if target not in targets:
+            bot_id, chat_id, topic_id = decode_target(target)
+            try:
+                targets[target] = (bot_id, chat_id, topic_to_thread_id(topic_id)) if chat_id else None
+            except ValueError:
+                targets[target] = None
+        if targets[target] is None:
+            results[index] = {"index": index, "error": "Invalid target"}
+            continue
 
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    try:
-        local_bot = Bot(token=TOKEN)
+        text = format_json_as_html(payload) if isinstance(payload, dict) else ""
+        if not text:
+            results[index] = {"index": index, "error": "Invalid payload"}
+            continue
 
-        if thread_id is None:
-            # Отправка в General
-            sent_message = loop.run_until_complete(
-                local_bot.send_message(chat_id=chat_id, text=message, parse_mode=ParseMode.HTML)
-            )
-            logger.info(f"✅ Сообщение {sent_message.message_id} отправлено в General-чат {chat_id}")
-        else:
-            # Отправка в топик
-            sent_message = loop.run_until_complete(
-                local_bot.send_message(chat_id=chat_id, text=message, parse_mode=ParseMode.HTML, message_thread_id=thread_id)
-            )
-            logger.info(f"✅ Сообщение {sent_message.message_id} отправлено в топик {thread_id} (чат {chat_id})")
+        groups.setdefault(targets[target], []).append((index, text))
 
-        return jsonify({
-            "success": "Message sent",
-            "message_id": sent_message.message_id,
-            "chat_id": chat_id,
-            "thread_id": thread_id if thread_id else None
-        })
+    if groups:
+        await _send_batch(groups, results)
 
-    except Exception as e:
-        log_and_notify(logging.ERROR, f"❌ Ошибка при отправке сообщения в чат {chat_id}: {str(e)}", chat_id, topic_id)
-        return jsonify({"error": str(e)}), 500
+    failed = sum(1 for result in results if "error" in result)
+    if failed:
+        logger.warning(f"⚠️ Пакетная отправка: {failed} из {len(items)} сообщений не отправлено")
+    logger.info("✅ Пакетная отправка: %d сообщений в %d чатов/топиков", len(items) - failed, len(groups))
 
-    finally:
-        loop.close()
+    return {"success": "Batch processed", "sent": len(items) - failed, "failed": failed, "results": results}, 200
 
 
-@app.route('/edit/<encoded_params>/<message_id>', methods=['POST'])
-def edit_message(encoded_params, message_id):
+@app.route('/post_batch', methods=['POST'])
+def post_batch():
     """
-    Редактирует сообщение в указанном чате или топике.
+    Отправляет много сообщений одним HTTP-запросом.
     """
-    # Игнорируем GET-запросы
-    if request.method == "GET":
-        logger.info(f"⚠️ Игнорируем GET-запрос на /edit/{encoded_params}/{message_id}")
-        return jsonify({"error": "Method Not Allowed"}), 405
+    return flask_response(run_in_bot_loop(api_post_batch(request.get_json(silent=True))))
 
-    # Декодируем chat_id (topic_id не используется)
-    chat_id, _ = decode_params(encoded_params)
+
+async def api_edit(encoded_params, message_id, data, template=None):
+    """
+    Редактирует сообщение в указанном чате или топике.
+    """
+    # Декодируем бота и chat_id (topic_id не используется)
+    chat_id, _ = use_target(encoded_params)
     if not chat_id:
         log_and_notify(logging.WARNING, f"⚠️ Ошибка декодирования: некорректные параметры ({encoded_params})", chat_id, None)
-        return jsonify({"error": "Invalid parameters"}), 400
+        return {"error": "Invalid parameters"}, 400
 
     # Проверяем message_id
     if not message_id.isdigit():
         log_and_notify(logging.WARNING, f"⚠️ Некорректный message_id '{message_id}' (chat_id={chat_id})", chat_id, None)
-        return jsonify({"error": "Invalid message_id"}), 400
+        return {"error": "Invalid message_id"}, 400
 
-    # Получаем JSON-данные
-    data = request.get_json()
     if not data or "text" not in data:
         log_and_notify(logging.WARNING, f"⚠️ Ошибка редактирования: отсутствует 'text' (message_id={message_id}, chat_id={chat_id})", chat_id, None)
-        return jsonify({"error": "Invalid JSON, 'text' is required"}), 400
+        return {"error": "Invalid JSON, 'text' is required"}, 400
 
-    new_message = format_json_as_html(data)
+    new_message = format_json_as_html(data, template)
 
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
     try:
-        local_bot = Bot(token=TOKEN)
+        # Частые правки одного сообщения склеиваются: в Telegram уходит последний текст,
+        # а правка без изменений вообще не доходит до Telegram
+        result = await edit_debouncer.edit(chat_id, message_id, new_message)
+        if result == "not_modified":
+            logger.info("⚠️ Сообщение %s в чате %s не изменилось, правка пропущена", message_id, chat_id)
+            return {"success": "Message not modified", "message_id": message_id}, 200
 
-        loop.run_until_complete(
-            local_bot.edit_message_text(
-                chat_id=chat_id,
-                message_id=int(message_id),
-                text=new_message,
-                parse_mode=ParseMode.HTML
-            )
-        )
-        logger.info(f"✅ Сообщение {message_id} отредактировано в чате {chat_id}")
-        return jsonify({"success": "Message edited", "message_id": message_id})
+        logger.info("✅ Сообщение %s отредактировано в чате %s", message_id, chat_id)
+        return {"success": "Message edited", "message_id": message_id}, 200
+
+    except RetryAfter as e:
+        logger.warning(f"⚠️ Лимит Telegram исчерпан для чата {chat_id}, повтор через {e.retry_after} с")
+        return retry_after_response(e)
+
+    except CircuitOpenError as e:
+        logger.warning(f"⚠️ Telegram недоступен, запрос для чата {chat_id} отклонен: {str(e)}")
+        return circuit_open_response(e)
 
     except Exception as e:
         log_and_notify(logging.ERROR, f"❌ Ошибка при редактировании сообщения {message_id} в чате {chat_id}: {str(e)}", chat_id, None)
-        return jsonify({"error": str(e)}), 500
+        return {"error": str(e)}, 500
 
-    finally:
-        loop.close()
 
+@app.route('/edit/<encoded_params>/<message_id>', methods=['POST'])
+def edit_message(encoded_params, message_id):
+    """
+    Редактирует сообщение в указанном чате или топике.
+    """
+    data = request.get_json(silent=True)
+    return flask_response(run_in_bot_loop(idempotent(
+        request, data, api_edit, encoded_params, message_id, data, request.args.get("template")
+    )))
 
-@app.route('/delete/<encoded_params>/<message_id>', methods=['POST'])
-def delete_message(encoded_params, message_id):
+
+async def api_delete(encoded_params, message_id):
     """
     Удаляет сообщение в указанном чате.
     """
-    # Игнорируем GET-запросы
-    if request.method == "GET":
-        logger.info(f"⚠️ Игнорируем GET-запрос на /delete/{encoded_params}/{message_id}")
-        return jsonify({"error": "Method Not Allowed"}), 405
-
-    # Декодируем chat_id (topic_id не используется)
-    chat_id, _ = decode_params(encoded_params)
+    # Декодируем бота и chat_id (topic_id не используется)
+    chat_id, _ = use_target(encoded_params)
     if not chat_id:
         log_and_notify(logging.WARNING, f"⚠️ Ошибка декодирования: некорректные параметры ({encoded_params})", chat_id, None)
-        return jsonify({"error": "Invalid parameters"}), 400
+        return {"error": "Invalid parameters"}, 400
 
     # Проверяем message_id
     if not message_id.isdigit():
         log_and_notify(logging.WARNING, f"⚠️ Некорректный message_id '{message_id}' (chat_id={chat_id})", chat_id, None)
-        return jsonify({"error": "Invalid message_id"}), 400
+        return {"error": "Invalid message_id"}, 400
 
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
     try:
-        local_bot = Bot(token=TOKEN)
-
-        loop.run_until_complete(
-            local_bot.delete_message(
-                chat_id=chat_id,
-                message_id=int(message_id)
-            )
+        await telegram_call(
+            "delete_message",
+            chat_id,
+            message_id=int(message_id)
         )
-        logger.info(f"✅ Сообщение {message_id} удалено в чате {chat_id}")
-        return jsonify({"success": f"Message {message_id} deleted"})
+        logger.info("✅ Сообщение %s удалено в чате %s", message_id, chat_id)
+        return {"success": f"Message {message_id} deleted"}, 200
+
+    except RetryAfter as e:
+        logger.warning(f"⚠️ Лимит Telegram исчерпан для чата {chat_id}, повтор через {e.retry_after} с")
+        return retry_after_response(e)
+
+    except CircuitOpenError as e:
+        logger.warning(f"⚠️ Telegram недоступен, запрос для чата {chat_id} отклонен: {str(e)}")
+        return circuit_open_response(e)
 
     except Exception as e:
         error_message = str(e)
-        if "message to delete not found" in error_message:
+        reason = delete_error_reason(e)
+        if reason == "not_found":
+            message_store.delete(chat_id, message_id)
             log_and_notify(logging.WARNING, f"⚠️ Сообщение {message_id} уже удалено или не найдено в чате {chat_id}.", chat_id, None)
-            return jsonify({"warning": f"Message {message_id} already deleted or not found"}), 200
-        elif "Message can't be deleted" in error_message:
+            return {"warning": f"Message {message_id} already deleted or not found"}, 200
+        elif reason == "cant_delete":
             log_and_notify(logging.ERROR, f"⚠️ Сообщение {message_id} не может быть удалено в чате {chat_id}.\nБыло опубликовано более 48 часов назад.\nУдалите вручную!", chat_id, None)
-            return jsonify({"error": f"Message {message_id} can't be deleted"}), 200
+            return {"error": f"Message {message_id} can't be deleted"}, 200
         else:
             log_and_notify(logging.ERROR, f"❌ Ошибка при удалении сообщения {message_id} в чате {chat_id}: {error_message}", chat_id, None)
-            return jsonify({"error": error_message}), 500
+            return {"error": error_message}, 500
 
-    finally:
-        loop.close()
+
+@app.route('/delete/<encoded_params>/<message_id>', methods=['POST'])
+def delete_message(encoded_params, message_id):
+    """
+    Удаляет сообщение в указанном чате.
+    """
+    return flask_response(run_in_bot_loop(api_delete(encoded_params, message_id)))
 
 
-@app.route('/get/<encoded_params>/<message_id>', methods=['GET'])
-def get_message_text(encoded_params, message_id):
+def delete_error_reason(e):
+    """
+    Ожидаемые ошибки удаления: "not_found" (сообщение уже удалено или не существует),
+    "cant_delete" (например, опубликовано более 48 часов назад) или None для прочих ошибок.
+    """
+    error_message = str(e).lower()
+    if "message to delete not found" in error_message:
+        return "not_found"
+    if "message can't be deleted" in error_message:
+        return "cant_delete"
+    return None
+
+
+# Сколько сообщений Telegram удаляет одним вызовом deleteMessages
+DELETE_MESSAGES_CHUNK = 100
+
+
+async def _delete_one(chat_id, message_id):
+    """
+    Удаляет одно сообщение пакета и возвращает его итог (без уведомлений в чат).
+    """
+    try:
+        await telegram_call("delete_message", chat_id, message_id=message_id)
+        return {"message_id": message_id, "status": "deleted"}
+    except RetryAfter as e:
+        return {"message_id": message_id, "status": "rate_limited", "retry_after": e.retry_after}
+    except CircuitOpenError as e:
+        return {"message_id": message_id, "status": "unavailable", "retry_after": math.ceil(e.retry_after)}
+    except Exception as e:
+        reason = delete_error_reason(e)
+        if reason == "not_found":
+            message_store.delete(chat_id, message_id)
+        return {"message_id": message_id, "status": reason or "error", "error": str(e)}
+
+
+async def _delete_chunk(chat_id, message_ids, semaphore):
+    """
+    Удаляет часть пакета. Если версия python-telegram-bot умеет deleteMessages — одним вызовом,
+    иначе (или если вызов не прошел целиком) — по одному сообщению, не больше BATCH_CONCURRENCY одновременно.
+    """
+    if hasattr(Bot, "delete_messages"):
+        try:
+            async with semaphore:
+                await telegram_call("delete_messages", chat_id, message_ids=message_ids)
+            # deleteMessages молча пропускает ненайденные и слишком старые сообщения и не говорит, какие именно,
+            # поэтому исход каждого сообщения неизвестен: оно удалено или его уже нельзя удалить
+            return [{"message_id": message_id, "status": "unknown"} for message_id in message_ids]
+        except RetryAfter as e:
+            return [{"message_id": message_id, "status": "rate_limited", "retry_after": e.retry_after} for message_id in message_ids]
+        except CircuitOpenError as e:
+            return [{"message_id": message_id, "status": "unavailable", "retry_after": math.ceil(e.retry_after)} for message_id in message_ids]
+        except Exception as e:
+            logger.warning(f"⚠️ Пакетное удаление {len(message_ids)} сообщений в чате {chat_id} не прошло ({str(e)}), удаляем по одному")
+
+    async def delete(message_id):
+        async with semaphore:
+            return await _delete_one(chat_id, message_id)
+
+    return await asyncio.gather(*(delete(message_id) for message_id in message_ids))
+
+
+async def api_delete_batch(encoded_params, data):
+    """
+    Удаляет много сообщений одного чата одним HTTP-запросом.
+    Тело: список message_id (или {"message_ids": [...]}).
+    - Ненайденные и слишком старые (48 часов) сообщения не считаются ошибкой запроса
+      и не порождают уведомлений в чат — они только отмечаются в итоге по каждому message_id.
+    - Возвращает статус каждого message_id: deleted, not_found, cant_delete, unknown, rate_limited, unavailable, invalid или error.
+      unknown — сообщение ушло в успешный вызов deleteMessages: Telegram не сообщает, было ли оно удалено или пропущено.
+    """
+    chat_id, _ = use_target(encoded_params)
+    if not chat_id:
+        log_and_notify(logging.WARNING, f"⚠️ Ошибка декодирования: некорректные параметры ({encoded_params})", chat_id, None)
+        return {"error": "Invalid parameters"}, 400
+
+    items = data.get("message_ids") if isinstance(data, dict) else data
+    if not isinstance(items, list) or not items:
+        logger.warning(f"⚠️ Ошибка пакетного удаления: ожидается непустой список message_id (chat_id={chat_id})")
+        return {"error": "Invalid JSON, list of message_ids is required"}, 400
+
+    if len(items) > BATCH_MAX_ITEMS:
+        logger.warning(f"⚠️ Слишком большой пакет на удаление: {len(items)} сообщений (максимум {BATCH_MAX_ITEMS})")
+        return {"error": f"Too many items, maximum is {BATCH_MAX_ITEMS}"}, 413
+
+    results = {}
+    message_ids = []
+    for item in items:
+        if isinstance(item, int) and not isinstance(item, bool) and item > 0 or isinstance(item, str) and item.isdigit():
+            message_id = int(item)
+            if message_id not in results:
+                results[message_id] = None
+                message_ids.append(message_id)
+        else:
+            results[str(item)] = {"message_id": item, "status": "invalid"}
+
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+    chunks = await asyncio.gather(*(
+        _delete_chunk(chat_id, message_ids[i:i + DELETE_MESSAGES_CHUNK], semaphore)
+        for i in range(0, len(message_ids), DELETE_MESSAGES_CHUNK)
+    ))
+    for chunk in chunks:
+        for result in chunk:
+            results[result["message_id"]] = result
+
+    summary = {}
+    for result in results.values():
+        summary[result["status"]] = summary.get(result["status"], 0) + 1
+    logger.info("🗑 Пакетное удаление в чате %s: %s", chat_id, summary)
+
+    # Одно уведомление на весь пакет и только о неожиданных ошибках
+    errors = [result for result in results.values() if result["status"] == "error"]
+    if errors:
+        log_and_notify(logging.ERROR, f"❌ Пакетное удаление в чате {chat_id}: {len(errors)} из {len(results)} сообщений не удалено ({errors[0]['error']})", chat_id, None)
+
+    return {"success": "Batch processed", "summary": summary, "results": list(results.values())}, 200
+
+
+@app.route('/delete_batch/<encoded_params>', methods=['POST'])
+def delete_batch(encoded_params):
+    """
+    Удаляет много сообщений одного чата одним HTTP-запросом.
+    """
+    return flask_response(run_in_bot_loop(api_delete_batch(encoded_params, request.get_json(silent=True))))
+
+
+async def api_get(encoded_params, message_id):
     """
     Получает текст сообщения из Telegram по message_id.
     """
-    # Декодируем chat_id (topic_id не используется)
-    chat_id, _ = decode_params(encoded_params)
+    # Декодируем бота и chat_id (topic_id не используется)
+    chat_id, _ = use_target(encoded_params)
     if not chat_id:
         log_and_notify(logging.WARNING, f"⚠️ Ошибка декодирования: некорректные параметры ({encoded_params})", chat_id, None)
-        return jsonify({"error": "Invalid parameters"}), 400
+        return {"error": "Invalid parameters"}, 400
 
     # Проверяем message_id
     if not message_id.isdigit():
         log_and_notify(logging.WARNING, f"⚠️ Некорректный message_id '{message_id}' (chat_id={chat_id})", chat_id, None)
-        return jsonify({"error": "Invalid message_id"}), 400
+        return {"error": "Invalid message_id"}, 400
 
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
+    # Сообщения, отправленные или отредактированные через бота, отдаем из локального хранилища
+    message_text = message_store.get(chat_id, message_id)
+    if message_text is not None:
+        logger.info("✅ Текст сообщения %s (чат %s) найден в локальном хранилище", message_id, chat_id)
+        return {"text": message_text, "message_id": message_id, "chat_id": chat_id}, 200
 
     try:
-        local_bot = Bot(token=TOKEN)
-
         # Попытка получить информацию о чате (Telegram API не позволяет напрямую получать текст сообщения)
-        chat = loop.run_until_complete(local_bot.get_chat(chat_id))
+        chat = await telegram_call("get_chat", chat_id)
 
         if not chat:
             log_and_notify(logging.WARNING, f"⚠️ Чат {chat_id} не найден.", chat_id, None)
-            return jsonify({"error": "Chat not found"}), 404
+            return {"error": "Chat not found"}, 404
 
         # Здесь нужно использовать правильный API метод, forward_message не подходит
         message_text = f"⚠️ Получение сообщения {message_id} невозможно через API."  
         log_and_notify(logging.WARNING, f"⚠️ API Telegram не позволяет получить текст сообщения {message_id}.", chat_id, None)
 
-        return jsonify({"text": message_text})
+        return {"text": message_text}, 200
+
+    except CircuitOpenError as e:
+        logger.warning(f"⚠️ Telegram недоступен, запрос для чата {chat_id} отклонен: {str(e)}")
+        return circuit_open_response(e)
 
     except Exception as e:
         error_message = str(e)
         if "message to get not found" in error_message:
             log_and_notify(logging.WARNING, f"⚠️ Сообщение {message_id} не найдено в чате {chat_id}", chat_id, None)
-            return jsonify({"error": "Message not found"}), 404
+            return {"error": "Message not found"}, 404
         else:
             log_and_notify(logging.ERROR, f"❌ Ошибка при получении текста сообщения {message_id} в чате {chat_id}: {error_message}", chat_id, None)
-            return jsonify({"error": error_message}), 500
+            return {"error": error_message}, 500
 
-    finally:
-        loop.close()
+
+@app.route('/get/<encoded_params>/<message_id>', methods=['GET'])
+def get_message_text(encoded_params, message_id):
+    """
+    Получает текст сообщения из Telegram по message_id.
+    """
+    return flask_response(run_in_bot_loop(api_get(encoded_params, message_id)))
 
 
-@app.route('/log/<log_type>/<encoded_chat>', methods=['POST'])
-def log_message(log_type, encoded_chat):
+async def api_log(log_type, encoded_chat, data, async_mode=False, template=None):
     """
     Получает логи от Google Apps Script или других сервисов и отправляет их в нужный чат/топик.
     - Если лог пришел из топика → он отправляется в этот же топик.
     - Если топика нет → отправляем просто в чат.
     """
-    # Игнорируем GET-запросы
-    if request.method == "GET":
-        logger.info(f"⚠️ Игнорируем GET-запрос на /log/{log_type}/{encoded_chat}")
-        return jsonify({"error": "Method Not Allowed"}), 405
-
-    # Декодируем chat_id и topic_id (если он есть)
-    chat_id, topic_id = decode_params(encoded_chat)
+    # Декодируем бота, chat_id и topic_id (если он есть)
+    chat_id, topic_id = use_target(encoded_chat)
     if not chat_id:
         log_and_notify(logging.WARNING, f"⚠️ Ошибка декодирования chat_id ({encoded_chat})", chat_id, topic_id)
-        return jsonify({"error": "Invalid parameters"}), 400
+        return {"error": "Invalid parameters"}, 400
 
-    # Получаем JSON-данные
-    data = request.get_json()
     if not data or "message" not in data:
         log_and_notify(logging.WARNING, f"⚠️ Ошибка логирования: пустой JSON (chat_id={chat_id})", chat_id, topic_id)
-        return jsonify({"error": "Invalid JSON, 'message' is required"}), 400
+        return {"error": "Invalid JSON, 'message' is required"}, 400
 
-    log_text = format_json_as_html(data)
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
+    # Если лог пришел из топика, отправляем его обратно в этот же топик.
+    # Длинный лог делится на несколько сообщений; в последнем оставляем место для счетчика повторов.
+    log_label = "🔴 ERROR" if log_type.lower() == "error" else "🟡 WARNING"
+    lane = "error" if log_type.lower() == "error" else "warning"
+    log_parts = format_json_as_html_parts(
+        data, MessageLimit.MAX_TEXT_LENGTH - LOG_COALESCE_SUFFIX_RESERVE, f"{log_label}\n📝 ", template
+    )
 
-    try:
-        local_bot = Bot(token=TOKEN)
+    # Повтор недавнего лога: новое сообщение не отправляем, только увеличиваем счетчик в первом
+    entry, is_first = await log_coalescer.register_request(chat_id, topic_id, log_type.lower(), "".join(log_parts))
+    if not is_first:
+        logger.info("🔁 Лог (%s) в чате %s повторился %s раз, отправка пропущена", log_type.upper(), chat_id, entry["count"])
+        response = {"success": "Log coalesced", "message_id": entry["message_id"], "count": entry["count"]}
+        if entry["job_id"]:
+            # Первый лог еще в очереди асинхронного режима: его судьбу можно узнать по status_url
+            response.update(job_id=entry["job_id"], status_url=f"/status/{entry['job_id']}")
+        # Код ответа тот же, что и у первого лога: асинхронный клиент ждет 202, синхронный — 200
+        return response, 202 if async_mode else 200
 
-        # Если лог пришел из топика, отправляем его обратно в этот же топик
-        log_label = "🔴 ERROR" if log_type.lower() == "error" else "🟡 WARNING"
-        log_message_text = f"{log_label}\n📝 {log_text}"
+    # Асинхронный режим: ставим в очередь и сразу отвечаем 202
+    if async_mode:
+        job_id = await enqueue_message("log", chat_id, log_parts, topic_id, lane)
+        if job_id is None:
+            log_coalescer.forget(entry)
+        else:
+            log_coalescer.sent(entry, log_parts[-1], job_id=job_id)
+        return accepted_response(job_id)
 
+    try:
+        message_ids = await send_message_parts(chat_id, log_parts, topic_id, lane)
         if topic_id:
-            sent_message = loop.run_until_complete(
-                local_bot.send_message(
-                    chat_id=chat_id,
-                    message_thread_id=topic_id,
-                    text=log_message_text,
-                    parse_mode=ParseMode.HTML
-                )
-            )
-            logger.info(f"✅ Лог ({log_type.upper()}) отправлен в тот же топик {topic_id} (чат {chat_id})")
+            logger.info("✅ Лог (%s) отправлен в тот же топик %s (чат %s)", log_type.upper(), topic_id, chat_id)
         else:
-            sent_message = loop.run_until_complete(
-                local_bot.send_message(
-                    chat_id=chat_id,
-                    text=log_message_text,
-                    parse_mode=ParseMode.HTML
-                )
-            )
-            logger.info(f"✅ Лог ({log_type.upper()}) отправлен в чат {chat_id}")
+            logger.info("✅ Лог (%s) отправлен в чат %s", log_type.upper(), chat_id)
+
+        # Счетчик повторов дописывается в последнюю часть
+        log_coalescer.sent(entry, log_parts[-1], message_ids[-1])
+        return {"success": "Log sent", "message_id": message_ids[0], "message_ids": message_ids}, 200
+
+    except asyncio.CancelledError:
+        # Повторы, ждущие этот лог, не должны ждать вечно
+        log_coalescer.forget(entry)
+        raise
 
-        return jsonify({"success": "Log sent", "message_id": sent_message.message_id})
+    except RetryAfter as e:
+        log_coalescer.forget(entry)
+        logger.warning(f"⚠️ Лимит Telegram исчерпан для чата {chat_id}, повтор через {e.retry_after} с")
+        return retry_after_response(e)
+
+    except CircuitOpenError as e:
+        log_coalescer.forget(entry)
+        logger.warning(f"⚠️ Telegram недоступен, лог для чата {chat_id} отклонен: {str(e)}")
+        return circuit_open_response(e)
 
     except Exception as e:
+        log_coalescer.forget(entry)
         log_and_notify(logging.ERROR, f"❌ Ошибка при отправке лога ({log_type.upper()}) в чат {chat_id}: {str(e)}", chat_id, topic_id)
-        return jsonify({"error": str(e)}), 500
+        return {"error": str(e)}, 500
 
-    finally:
-        loop.close()
+
+@app.route('/log/<log_type>/<encoded_chat>', methods=['POST'])
+def log_message(log_type, encoded_chat):
+    """
+    Получает логи от Google Apps Script или других сервисов и отправляет их в нужный чат/топик.
+    """
+    data = request.get_json(silent=True)
+    return flask_response(run_in_bot_loop(idempotent(
+        request, data, api_log, log_type, encoded_chat, data, is_async_request(request), request.args.get("template")
+    )))
+
+
+def api_status(job_id):
+    """
+    Возвращает состояние задачи, принятой в асинхронном режиме:
+    queued → sent (с message_id) или failed (с текстом ошибки).
+    """
+    job = get_job(job_id)
+    if job is None:
+        return {"error": "Job not found"}, 404
+
+    job["job_id"] = job_id
+    return job, 200
+
+
+@app.route('/status/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """
+    Возвращает состояние задачи, принятой в асинхронном режиме.
+    """
+    return flask_response(api_status(job_id))
+
+
+def check_admin(authorization):
+    """
+    Проверяет заголовок Authorization: Bearer <ADMIN_TOKEN>.
+    Возвращает None, если доступ разрешен, иначе ответ с ошибкой.
+    """
+    if not ADMIN_TOKEN:
+        return {"error": "Admin API is disabled"}, 404
+    if not hmac.compare_digest(authorization or "", f"Bearer {ADMIN_TOKEN}"):
+        logger.warning("⚠️ Запрос к /templates с неверным токеном отклонен")
+        return {"error": "Forbidden"}, 403
+    return None
+
+
+def api_templates(method, name, data, authorization):
+    """
+    Управление шаблонами сообщений:
+    - GET /templates — все шаблоны,
+    - PUT /templates/<name> с {"template": "..."} — зарегистрировать или заменить,
+    - DELETE /templates/<name> — удалить.
+    """
+    denied = check_admin(authorization)
+    if denied:
+        return denied
+
+    if method == "GET":
+        return {"templates": payload_templates.sources()}, 200
+
+    if method == "DELETE":
+        if not payload_templates.remove(name):
+            return {"error": "Template not found"}, 404
+        logger.info(f"🗑 Шаблон '{name}' удален")
+        return {"success": f"Template {name} deleted"}, 200
+
+    source = data.get("template") if isinstance(data, dict) else None
+    if not isinstance(source, str) or not source.strip():
+        return {"error": "Invalid JSON, 'template' is required"}, 400
+    try:
+        payload_templates.register(name, source)
+    except ValueError as e:
+        return {"error": str(e)}, 400
+    logger.info(f"✅ Шаблон '{name}' зарегистрирован")
+    return {"success": f"Template {name} registered"}, 200
+
+
+@app.route('/templates', methods=['GET'])
+@app.route('/templates/<name>', methods=['PUT', 'DELETE'])
+def templates_endpoint(name=None):
+    """
+    Управление шаблонами сообщений (нужен ADMIN_TOKEN).
+    """
+    return flask_response(api_templates(
+        request.method, name, request.get_json(silent=True), request.headers.get("Authorization")
+    ))
+
+
+async def reply_command(message, text, **kwargs):
+    """
+    Отвечает на команду через global_bot с приоритетом "command" (см. DISPATCH_LANES).
+    В группах ответ цитирует команду, как message.reply_text.
+    Если Application работает в своем event loop (polling при SERVER_MODE=flask), вызов передается в общий.
+    """
+    reply_to = message.message_id if message.chat.type != ChatType.PRIVATE else None
+    coro = telegram_call("send_message", message.chat_id, lane="command", text=text, reply_to_message_id=reply_to, **kwargs)
+    if asyncio.get_running_loop() is get_bot_loop():
+        return await coro
+    return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, get_bot_loop()))
 
 
 async def start(update, context: ContextTypes.DEFAULT_TYPE):
@@ -510,7 +3677,8 @@ async def start(update, context: ContextTypes.DEFAULT_TYPE):
     thread_id = update.message.message_thread_id  # Может быть None
 
     try:
-        await update.message.reply_text(
+        await reply_command(
+            update.message,
             "👋 Привет! Вот доступные команды:\n\n"
             "📌 <b>Основные команды:</b>\n"
             "🔹 /commands - команды для работы с сообщениями\n"
@@ -540,14 +3708,16 @@ async def commands(update, context: ContextTypes.DEFAULT_TYPE):
     
     try:
         if encoded_topic:
-            await update.message.reply_text(
+            await reply_command(
+                update.message,
                 f"📩 Отправить в топик: \n{SERVER_URL}/post/{encoded_topic}\n"
                 f"✏️ Редактировать сообщение: \n{SERVER_URL}/edit/{encoded_chat}/<message_id>\n"
                 f"📄 Получить текст сообщения: \n{SERVER_URL}/get/{encoded_chat}/<message_id>\n"
             )
             logger.info(f"📢 Пользователь {username} запросил ссылки для топика {thread_id} в чате {chat_id}")
         else:
-            await update.message.reply_text(
+            await reply_command(
+                update.message,
                 f"📩 Отправить в общий чат: \n{SERVER_URL}/post/{encoded_general}\n"
                 f"✏️ Редактировать: \n{SERVER_URL}/edit/{encoded_chat}/<message_id>\n"
                 f"🗑 Удалить сообщение: \n{SERVER_URL}/delete/{encoded_chat}/<message_id>\n"
@@ -579,7 +3749,8 @@ async def logging_commands(update, context: ContextTypes.DEFAULT_TYPE):
 
     try:
         # Формируем ссылки для логирования
-        await update.message.reply_text(
+        await reply_command(
+            update.message,
             f"📌 <b>Логирование ошибок и предупреждений:</b>\n\n"
             f"🔴 <b>Отправить ERROR-лог:</b>\n"
             f"{SERVER_URL}/log/error/{encoded_logging_chat}\n\n"
@@ -595,15 +3766,361 @@ async def logging_commands(update, context: ContextTypes.DEFAULT_TYPE):
         log_and_notify(logging.ERROR, f"❌ Ошибка в logging_commands: {str(e)}", chat_id, thread_id)
 
 
+def build_application(builder):
+    """
+    Собирает PTB Application с обработчиками команд бота.
+    """
+    application = builder.build()
+    application.add_handler(CommandHandler("commands", commands))
+    application.add_handler(CommandHandler("logging_commands", logging_commands))
+    application.add_handler(CommandHandler("start", start))
+    return application
+
+
+# PTB Application в режиме webhook (в режиме polling обработчик webhook отвечает 404)
+webhook_application = None
+
+
+async def _start_webhook_application(register=True):
+    global webhook_application
+
+    # Application работает в общем event loop и использует общий global_bot с пулом соединений
+    application = build_application(Application.builder().bot(global_bot).updater(None))
+    await application.initialize()
+    await application.start()
+    webhook_application = application
+
+    if register:
+        await _register_webhook()
+
+
+async def _register_webhook():
+    base_url = SERVER_URL if SERVER_URL.startswith("http") else f"https://{SERVER_URL}"
+    await global_bot.set_webhook(url=f"{base_url}{WEBHOOK_PATH}", secret_token=WEBHOOK_SECRET)
+    logger.info(f"✅ Webhook зарегистрирован: {base_url}{WEBHOOK_PATH}")
+
+
+def start_webhook():
+    """
+    Запускает обработку обновлений через webhook: Application стартует в общем event loop,
+    а Telegram присылает обновления на WEBHOOK_PATH того же Flask-сервера.
+    """
+    run_in_bot_loop(_start_webhook_application())
+
+
+async def _start_polling_application():
+    # То же, что run_polling, но в общем event loop процесса, а не в главном потоке
+    application = build_application(Application.builder().bot(global_bot))
+    await application.initialize()
+    await application.updater.start_polling()
+    await application.start()
+
+
+def _become_leader():
+    """
+    Тело потока выборов лидера в воркере gunicorn.
+    - Блокируется на LEADER_LOCK_FILE, пока лидером является другой процесс.
+      Когда лидер завершается, ядро снимает его блокировку и лидером становится следующий воркер.
+    - Лидер восстанавливает outbox и получает обновления: в режиме polling только он
+      опрашивает Telegram, в режиме webhook только он регистрирует webhook.
+    """
+    fd = os.open(LEADER_LOCK_FILE, os.O_RDWR | os.O_CREAT, 0o644)
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    os.ftruncate(fd, 0)
+    os.write(fd, str(os.getpid()).encode())
+    logger.info(f"👑 Процесс {os.getpid()} стал лидером")
+
+    try:
+        replay_outbox()
+        if UPDATE_MODE == "webhook":
+            run_in_bot_loop(_register_webhook())
+        else:
+            run_in_bot_loop(_start_polling_application())
+    except Exception as e:
+        logger.error(f"❌ Ошибка запуска обработки обновлений в лидере: {str(e)}")
+
+    # Задачи воркеров, упавших уже после старта, тоже не должны потеряться
+    while True:
+        time.sleep(OUTBOX_RECOVERY_INTERVAL)
+        try:
+            replay_outbox()
+        except Exception as e:
+            logger.error(f"❌ Ошибка восстановления outbox: {str(e)}")
+
+
+def start_worker():
+    """
+    Запуск в воркере gunicorn (вызывается из gunicorn.conf.py после fork).
+    - bot.py импортируется в каждом воркере отдельно, поэтому пул соединений,
+      event loop, кеши и соединения SQLite у каждого процесса свои.
+    - В режиме webhook обновления принимает любой воркер: Telegram доставляет
+      каждое обновление один раз, поэтому дублей не бывает.
+    """
+    if fcntl is None:
+        raise RuntimeError("Multi-process mode requires fcntl (Linux/macOS)")
+
+    if UPDATE_MODE == "webhook":
+        run_in_bot_loop(_start_webhook_application(register=False))
+    threading.Thread(target=_become_leader, name="leader-election", daemon=True).start()
+
+
+def accept_update(secret, data):
+    """
+    Принимает обновление от Telegram и кладет его в очередь PTB Application.
+    Отвечает сразу, не дожидаясь обработки команды.
+    """
+    application = webhook_application
+    if application is None:
+        return {"error": "Webhook mode is disabled"}, 404
+
+    if not hmac.compare_digest(secret or "", WEBHOOK_SECRET):
+        logger.warning("⚠️ Webhook-запрос с неверным секретом отклонен")
+        return {"error": "Forbidden"}, 403
+
+    if not data:
+        return {"error": "Invalid JSON"}, 400
+
+    update = Update.de_json(data, application.bot)
+    get_bot_loop().call_soon_threadsafe(application.update_queue.put_nowait, update)
+    return {"ok": True}, 200
+
+
+@app.route(WEBHOOK_PATH, methods=['POST'])
+def telegram_webhook():
+    """
+    Принимает обновления от Telegram (режим webhook).
+    """
+    secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    return flask_response(accept_update(secret, request.get_json(silent=True)))
+
+
+class AsgiRequest:
+    """
+    Запрос ASGI-приложения с теми же атрибутами args/headers, что у запроса Flask.
+    """
+
+    def __init__(self, scope, receive):
+        self.method = scope["method"]
+        self.path = scope["path"]
+        self.args = MultiDict(parse_qsl(scope.get("query_string", b"").decode("latin-1")))
+        self.headers = Headers([(name.decode("latin-1"), value.decode("latin-1")) for name, value in scope["headers"]])
+        try:
+            self.content_length = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            self.content_length = None  # некорректный заголовок: запрос отклоняется с кодом 400
+        if self.content_length is not None and self.content_length < 0:
+            self.content_length = None
+        self._receive = receive
+
+    async def body(self):
+        """
+        Тело запроса. Чтение прекращается, как только тело превысило MAX_CONTENT_LENGTH.
+        """
+        chunks = []
+        size = 0
+        while True:
+            message = await self._receive()
+            chunk = message.get("body", b"")
+            size += len(chunk)
+            if size > MAX_CONTENT_LENGTH:
+                raise RequestEntityTooLarge()
+            chunks.append(chunk)
+            if not message.get("more_body"):
+                return b"".join(chunks)
+
+    async def get_json(self):
+        """
+        JSON тела запроса или None, если тело пустое или некорректное (как get_json(silent=True) во Flask).
+        """
+        try:
+            return json.loads(await self.body())
+        except ValueError:
+            return None
+
+
+class AsgiApp:
+    """
+    ASGI-вариант HTTP API (SERVER_MODE=asgi).
+    - Те же маршруты и обработчики api_*, что у Flask-приложения.
+    - Обработчик — корутина в общем event loop, где работают global_bot и PTB Application:
+      медленные вызовы Telegram не занимают по потоку на запрос.
+    """
+
+    def __init__(self):
+        self.routes = []  # (regex пути, шаблон маршрута для метрик, методы, обработчик)
+
+    def route(self, rule, methods=("GET",)):
+        pattern = re.compile("^" + re.sub(r"<(\w+)>", r"(?P<\1>[^/]+)", rule) + "$")
+
+        def decorator(handler):
+            self.routes.append((pattern, rule, methods, handler))
+            return handler
+
+        return decorator
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return
+
+        started = time.perf_counter()
+        req = AsgiRequest(scope, receive)
+        rule, result = "unmatched", ({"error": "Not Found"}, 404)
+        for pattern, route_rule, methods, handler in self.routes:
+            match = pattern.match(req.path)
+            if not match:
+                continue
+            rule = route_rule
+            if req.method not in methods:
+                result = {"error": "Method Not Allowed"}, 405
+                break
+            if req.content_length is None:
+                logger.warning(f"⚠️ Запрос к {rule} отклонен: некорректный Content-Length")
+                result = {"error": "Invalid Content-Length"}, 400
+                break
+            if req.content_length > MAX_CONTENT_LENGTH:
+                result = too_large_response(rule)
+                break
+            gate = admission_gates.get(ADMISSION_ROUTES.get(rule))
+            if gate is not None and not await gate.enter_async():
+                result = overloaded_response(gate)
+                break
+            try:
+                result = await handler(req, **match.groupdict())
+            except RequestEntityTooLarge:
+                result = too_large_response(rule)
+            except Exception as e:
+                logger.error(f"❌ Необработанная ошибка в {req.method} {req.path}: {str(e)}")
+                result = {"error": "Internal Server Error"}, 500
+            finally:
+                if gate is not None:
+                    gate.leave()
+            break
+
+        body, status, *rest = result
+        headers = rest[0] if rest else {}
+        if isinstance(body, (bytes, str)):
+            content_type = headers.pop("Content-Type", "text/plain; charset=utf-8")
+            payload = body.encode() if isinstance(body, str) else body
+        else:
+            content_type = "application/json"
+            payload = json.dumps(body, ensure_ascii=False).encode()
+
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [
+                (b"content-type", content_type.encode()),
+                (b"content-length", str(len(payload)).encode()),
+                *((name.lower().encode(), str(value).encode()) for name, value in headers.items()),
+            ],
+        })
+        await send({"type": "http.response.body", "body": payload})
+
+        metrics.inc("bot_http_requests_total", (("route", rule), ("method", req.method), ("status", status)))
+        metrics.observe("bot_http_request_duration_seconds", time.perf_counter() - started, (("route", rule),))
+        metrics.observe("bot_http_request_size_bytes", req.content_length or 0, (("route", rule),))
+
+
+asgi_app = AsgiApp()
+
+
+@asgi_app.route('/post/<encoded_params>', methods=('POST',))
+async def asgi_post_to_chat(req, encoded_params):
+    data = await req.get_json()
+    return await idempotent(
+        req, data, api_post, encoded_params, data, is_async_request(req), req.args.get("template"),
+        req.args.get("send_at"), req.args.get("delete_after")
+    )
+
+
+@asgi_app.route('/post_batch', methods=('POST',))
+async def asgi_post_batch(req):
+    return await api_post_batch(await req.get_json())
+
+
+@asgi_app.route('/edit/<encoded_params>/<message_id>', methods=('POST',))
+async def asgi_edit_message(req, encoded_params, message_id):
+    data = await req.get_json()
+    return await idempotent(req, data, api_edit, encoded_params, message_id, data, req.args.get("template"))
+
+
+@asgi_app.route('/delete/<encoded_params>/<message_id>', methods=('POST',))
+async def asgi_delete_message(req, encoded_params, message_id):
+    return await api_delete(encoded_params, message_id)
+
+
+@asgi_app.route('/delete_batch/<encoded_params>', methods=('POST',))
+async def asgi_delete_batch(req, encoded_params):
+    return await api_delete_batch(encoded_params, await req.get_json())
+
+
+@asgi_app.route('/get/<encoded_params>/<message_id>', methods=('GET',))
+async def asgi_get_message_text(req, encoded_params, message_id):
+    return await api_get(encoded_params, message_id)
+
+
+@asgi_app.route('/log/<log_type>/<encoded_chat>', methods=('POST',))
+async def asgi_log_message(req, log_type, encoded_chat):
+    data = await req.get_json()
+    return await idempotent(req, data, api_log, log_type, encoded_chat, data, is_async_request(req), req.args.get("template"))
+
+
+@asgi_app.route('/status/<job_id>', methods=('GET',))
+async def asgi_job_status(req, job_id):
+    return api_status(job_id)
+
+
+@asgi_app.route('/templates', methods=('GET',))
+async def asgi_templates(req):
+    return api_templates(req.method, None, None, req.headers.get("Authorization"))
+
+
+@asgi_app.route('/templates/<name>', methods=('PUT', 'DELETE'))
+async def asgi_template(req, name):
+    return api_templates(req.method, name, await req.get_json(), req.headers.get("Authorization"))
+
+
+@asgi_app.route('/metrics', methods=('GET',))
+async def asgi_metrics(req):
+    return metrics.render(), 200, {"Content-Type": "text/plain; version=0.0.4"}
+
+
+@asgi_app.route(WEBHOOK_PATH, methods=('POST',))
+async def asgi_telegram_webhook(req):
+    return accept_update(req.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), await req.get_json())
+
+
 def run_flask():
     app.run(host="0.0.0.0", port=PORT)
 
+
+def run_asgi():
+    """
+    Запускает ASGI-сервер (uvicorn) прямо в общем event loop, рядом с global_bot и Application.
+    """
+    import uvicorn  # нужен только в режиме SERVER_MODE=asgi
+
+    server = uvicorn.Server(uvicorn.Config(asgi_app, host="0.0.0.0", port=PORT, lifespan="off"))
+    run_in_bot_loop(server.serve())
+
+
 if __name__ == "__main__":
-    flask_thread = threading.Thread(target=run_flask)
-    flask_thread.start()
+    replay_outbox()
 
-    application = Application.builder().token(TOKEN).build()
-    application.add_handler(CommandHandler("commands", commands))
-    application.add_handler(CommandHandler("logging_commands", logging_commands))
-    application.add_handler(CommandHandler("start", start))
-    application.run_polling()
+    if SERVER_MODE == "asgi":
+        # HTTP API, бот и обработка обновлений работают в одном event loop
+        if UPDATE_MODE == "webhook":
+            start_webhook()
+        else:
+            run_in_bot_loop(_start_polling_application())
+        run_asgi()
+    elif UPDATE_MODE == "webhook":
+        # Обновления приходят на тот же порт, что и HTTP API
+        start_webhook()
+        run_flask()
+    else:
+        flask_thread = threading.Thread(target=run_flask)
+        flask_thread.start()
+
+        application = build_application(Application.builder().token(TOKEN).base_url(TELEGRAM_BASE_URL))
+        application.run_polling()
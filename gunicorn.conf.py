@@ -0,0 +1,23 @@
+"""
+Запуск HTTP API в нескольких процессах:
+    gunicorn -c gunicorn.conf.py bot:app
+
+- Каждый воркер импортирует bot.py сам (preload_app выключен), поэтому пул соединений
+  к Telegram, event loop, кеши и соединения SQLite создаются уже после fork.
+- Обновления Telegram (polling или регистрацию webhook) и восстановление outbox
+  берет на себя один воркер-лидер, выбранный через блокировку LEADER_LOCK_FILE.
+"""
+import os
+
+bind = f"0.0.0.0:{os.environ.get('SERVER_PORT', 5000)}"
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+# Обработчики ждут ответа Telegram, поэтому в каждом воркере несколько потоков
+worker_class = "gthread"
+threads = int(os.environ.get("WEB_THREADS", 8))
+preload_app = False
+
+
+def post_worker_init(worker):
+    import bot
+
+    bot.start_worker()
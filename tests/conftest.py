@@ -0,0 +1,11 @@
+import os
+import sys
+
+# bot.py читает настройки при импорте: задаем минимальное окружение без сети и файлов на диске
+os.environ.setdefault("BOT_TOKEN", "123:test")
+os.environ.setdefault("RAILWAY_PUBLIC_DOMAIN", "example.test")
+os.environ.setdefault("TELEGRAM_BASE_URL", "http://127.0.0.1:9/bot")
+os.environ.setdefault("OUTBOX_DB", "")
+os.environ.setdefault("LOG_QUEUE_SIZE", "0")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
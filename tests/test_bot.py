@@ -0,0 +1,247 @@
+import asyncio
+import re
+import threading
+import time
+import types
+
+import bot
+
+
+def visible_text(part):
+    return re.sub(r"<[^>]*>", "", part).strip()
+
+
+def test_tagged_word_longer_than_limit_is_split_inside_tag():
+    parts = bot.format_json_as_html_parts({"text": "<b>" + "x" * 10000 + "</b>"}, limit=4096)
+
+    assert len(parts) == 3
+    assert all(len(part) <= 4096 for part in parts)
+    assert all(visible_text(part) for part in parts)
+    assert all(part.startswith("<b>") and part.endswith("</b>") for part in parts)
+    assert "".join(visible_text(part) for part in parts) == "x" * 10000
+
+
+def test_label_is_not_left_alone_before_long_word():
+    parts = bot.format_json_as_html_parts({"message": "y" * 200}, limit=100)
+
+    assert all(len(part) <= 100 for part in parts)
+    assert "message" in parts[0] and "y" in parts[0]
+
+
+class StubBot:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append(chat_id)
+        return types.SimpleNamespace(message_id=len(self.sent))
+
+
+def test_circuit_probe_is_not_held_by_waiting_chat(monkeypatch):
+    stub = StubBot()
+    breaker = bot.CircuitBreaker(0.5, 10, 30, 5, 120)
+    breaker.state = breaker.OPEN
+    breaker.open_until = time.monotonic() - 1
+    client = bot.BotClient("", stub, bot.RateLimiter(), dict.fromkeys(bot.BotRegistry.RESULTS, 0))
+    monkeypatch.setattr(bot, "circuit_breaker", breaker)
+    monkeypatch.setitem(bot.bot_registry.clients, "", client)
+
+    async def scenario():
+        # Бюджет первого чата исчерпан: его запрос ждет в ограничителе
+        client.rate_limiter.penalize("-1001", 5)
+        waiting = asyncio.ensure_future(bot.telegram_call("send_message", "-1001", text="a"))
+        await asyncio.sleep(0.05)
+        assert not breaker.probing
+
+        await bot.telegram_call("send_message", "-1002", text="b")
+        waiting.cancel()
+
+    asyncio.run(scenario())
+    assert stub.sent == ["-1002"]
+    assert breaker.state == breaker.CLOSED
+
+
+def test_metrics_threads_use_different_stripes():
+    metrics = bot.Metrics()
+    metrics.describe("bot_test_total", "counter", "Test counter")
+    stripes = set()
+    lock = threading.Lock()
+
+    def worker():
+        metrics.inc("bot_test_total")
+        with lock:
+            stripes.add(id(metrics._stripe()))
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(stripes) > 1
+    assert "bot_test_total 8" in metrics.render()
+
+
+def test_batch_delete_does_not_claim_skipped_messages_deleted(monkeypatch):
+    calls = []
+
+    async def fake_call(method, chat_id, **kwargs):
+        calls.append(method)
+        return True
+
+    monkeypatch.setattr(bot.Bot, "delete_messages", lambda *args, **kwargs: None, raising=False)
+    monkeypatch.setattr(bot, "telegram_call", fake_call)
+
+    async def scenario():
+        return await bot._delete_chunk("-1001", [1, 2], asyncio.Semaphore(1))
+
+    results = asyncio.run(scenario())
+    assert calls == ["delete_messages"]
+    assert [result["status"] for result in results] == ["unknown", "unknown"]
+
+
+def test_coalesced_async_log_is_accepted(monkeypatch):
+    coalescer = bot.LogCoalescer(60, 5, 100)
+    monkeypatch.setattr(bot, "log_coalescer", coalescer)
+    data = {"message": "disk full"}
+    text = "".join(bot.format_json_as_html_parts(
+        data, bot.MessageLimit.MAX_TEXT_LENGTH - bot.LOG_COALESCE_SUFFIX_RESERVE, "🔴 ERROR\n📝 "
+    ))
+    entry, _ = coalescer.register("-1001", None, "error", text)
+    coalescer.sent(entry, text, job_id="job-1")
+    entry["flush_scheduled"] = True
+
+    body, status = asyncio.run(bot.api_log("error", bot.encode_params("-1001"), data, async_mode=True))
+    assert (body["success"], body["count"], body["job_id"], status) == ("Log coalesced", 2, "job-1", 202)
+
+    body, status = asyncio.run(bot.api_log("error", bot.encode_params("-1001"), data))
+    assert (body["count"], status) == (3, 200)
+
+
+def test_evicted_tenant_bot_leaves_no_open_clients(monkeypatch):
+    registry = bot.BotRegistry({"shop": "456:tenant"}, bot.global_bot, bot.rate_limiter)
+    monkeypatch.setattr(bot, "BOT_IDLE_TTL", 0)
+
+    async def scenario():
+        client = registry.get("shop")
+        registry.sweeper.cancel()
+        registry._sweep()
+        await asyncio.sleep(0)
+        return client
+
+    client = asyncio.run(scenario())
+    assert "shop" not in registry.clients
+    assert all(request._client.is_closed for request in client.bot._request)
+
+
+def test_asgi_malformed_content_length_is_bad_request():
+    scope = {
+        "type": "http", "method": "POST", "path": "/log/error/" + bot.encode_params("-1001"),
+        "query_string": b"", "headers": [(b"content-length", b"12abc")],
+    }
+    sent = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"{}", "more_body": False}
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(bot.asgi_app(scope, receive, send))
+    assert sent[0]["status"] == 400
+    assert b"Invalid Content-Length" in sent[1]["body"]
+
+
+def test_send_at_out_of_range_is_rejected_before_scheduling(monkeypatch):
+    added = []
+
+    async def fake_add(*args, **kwargs):
+        added.append(args)
+        return "timer"
+
+    monkeypatch.setattr(bot.scheduler, "add", fake_add)
+    target = bot.encode_params("-1001")
+    for send_at in ("1792273886836", "inf", "1e300", "nan", "9999-01-01T00:00:00Z"):
+        body, status = asyncio.run(bot.api_post(target, {"text": "hi"}, send_at=send_at))
+        assert status == 400, send_at
+    assert added == []
+
+    body, status = asyncio.run(bot.api_post(target, {"text": "hi"}, send_at=str(time.time() + 3600)))
+    assert status == 202 and len(added) == 1
+
+
+def balanced_tags(part):
+    stack = []
+    for match in re.finditer(r"<(/?)(\w+)[^>]*>", part):
+        if match.group(1):
+            if not stack or stack.pop() != match.group(2):
+                return False
+        else:
+            stack.append(match.group(2))
+    return not stack
+
+
+def test_tag_span_crossing_part_boundary_stays_balanced():
+    line = "z" * 60
+    text = "<b>" + "\n".join([line] * 70) + "</b>\n<i>" + "\n".join([line] * 70) + "</i>"
+    parts = bot.format_json_as_html_parts({"text": text}, limit=4096)
+
+    assert len(parts) > 1
+    assert all(len(part) <= 4096 for part in parts)
+    assert all(balanced_tags(part) for part in parts)
+    assert "".join(visible_text(part) for part in parts).count(line) == 140
+
+
+def test_parts_with_tag_spans_never_exceed_limit():
+    text = "\n".join(f"<b>{'w' * 50} {'q' * 10}</b>{'w' * 60} q\n<i>{'w' * 40}" for _ in range(5)) + "</i>" * 5
+    for limit in range(40, 200, 7):
+        parts = bot.format_json_as_html_parts({"text": text}, limit=limit)
+        assert all(len(part) <= limit for part in parts), limit
+        assert all(balanced_tags(part) for part in parts), limit
+
+
+def test_log_repeat_during_failed_first_send_is_sent_itself(monkeypatch):
+    monkeypatch.setattr(bot, "log_coalescer", bot.LogCoalescer(60, 5, 100))
+    calls = []
+
+    async def fake_send(chat_id, parts, topic_id=None, lane=None):
+        calls.append(chat_id)
+        if len(calls) == 1:
+            await asyncio.sleep(0.05)
+            raise bot.BadRequest("Chat not found")
+        return [77]
+
+    monkeypatch.setattr(bot, "send_message_parts", fake_send)
+    monkeypatch.setattr(bot, "log_and_notify", lambda *args, **kwargs: None)
+    target = bot.encode_params("-1001")
+
+    async def scenario():
+        first = asyncio.ensure_future(bot.api_log("error", target, {"message": "disk full"}))
+        await asyncio.sleep(0.01)
+        repeat = await bot.api_log("error", target, {"message": "disk full"})
+        return await first, repeat
+
+    (first_body, first_status), (body, status) = asyncio.run(scenario())
+    assert first_status == 500
+    assert (body["success"], body["message_id"], status) == ("Log sent", 77, 200)
+    assert len(calls) == 2
+
+
+def test_log_repeat_during_first_send_waits_for_its_message(monkeypatch):
+    monkeypatch.setattr(bot, "log_coalescer", bot.LogCoalescer(60, 3600, 100))
+
+    async def fake_send(chat_id, parts, topic_id=None, lane=None):
+        await asyncio.sleep(0.05)
+        return [41]
+
+    monkeypatch.setattr(bot, "send_message_parts", fake_send)
+    target = bot.encode_params("-1001")
+
+    async def scenario():
+        first = asyncio.ensure_future(bot.api_log("error", target, {"message": "disk full"}))
+        await asyncio.sleep(0.01)
+        repeat = await bot.api_log("error", target, {"message": "disk full"})
+        return await first, repeat
+
+    _, (body, status) = asyncio.run(scenario())
+    assert (body["success"], body["message_id"], body["count"], status) == ("Log coalesced", 41, 2, 200)